@@ -1,10 +1,37 @@
 __version__ = '1.2.4'
 
-from .smax_client import SmaxData, SmaxInt, SmaxFloat, SmaxBool, SmaxStr, \
-    SmaxStrArray, SmaxArray, SmaxStruct, SmaxInt8, SmaxInt16, SmaxInt32, \
-    SmaxInt64, SmaxFloat32, SmaxFloat64, SmaxBool, SmaxBytes, \
-    _TYPE_MAP, _REVERSE_TYPE_MAP, _SMAX_TYPE_MAP, _REVERSE_SMAX_TYPE_MAP, \
-    SmaxConnectionError, SmaxKeyError, SmaxUnderflowWarning, \
-    optional_metadata, join, normalize_pair, print_smax, print_tree
-from .smax_redis_client import SmaxRedisClient
+import importlib
 
+# The public names of the package, and the submodule defining each of them.
+# Submodules (and with them numpy and redis) are only imported when one of
+# their names is first used, so that `import smax` itself is cheap.
+_lazy_imports = {
+    **dict.fromkeys(["SmaxData", "SmaxInt", "SmaxFloat", "SmaxBool", "SmaxStr",
+                     "SmaxStrArray", "SmaxArray", "SmaxStruct", "SmaxInt8", "SmaxInt16",
+                     "SmaxInt32", "SmaxInt64", "SmaxFloat32", "SmaxFloat64", "SmaxBytes",
+                     "_TYPE_MAP", "_REVERSE_TYPE_MAP", "_SMAX_TYPE_MAP", "_REVERSE_SMAX_TYPE_MAP",
+                     "SmaxConnectionError", "SmaxKeyError", "SmaxUnderflowWarning",
+                     "optional_metadata", "join", "normalize_pair", "print_smax", "print_tree",
+                     "smax_unavailable"],
+                    "smax_client"),
+    "SmaxRedisClient": "smax_redis_client",
+    "SmaxClientConfig": "smax_redis_client",
+    "SmaxPartitionedClient": "smax_partitioned_client",
+    "AsyncSmaxRedisClient": "smax_async_redis_client",
+    "connection_pool_stats": "smax_connection_pool",
+}
+
+__all__ = [name for name in _lazy_imports if not name.startswith("_")]
+
+
+def __getattr__(name):
+    if name in _lazy_imports:
+        module = importlib.import_module(f".{_lazy_imports[name]}", __name__)
+        value = getattr(module, name)
+        globals()[name] = value
+        return value
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+def __dir__():
+    return sorted(set(globals()) | set(_lazy_imports))
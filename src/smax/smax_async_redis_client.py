@@ -0,0 +1,429 @@
+import asyncio
+import functools
+import logging
+import socket
+import time
+
+from redis.asyncio import Redis
+from redis.asyncio.retry import Retry
+from redis.exceptions import NoScriptError, BusyLoadingError, ConnectionError, TimeoutError
+from redis.backoff import ExponentialBackoff
+
+from .smax_client import SmaxConnectionError, join, normalize_pair
+from .smax_channel_matcher import channel_name
+from .smax_redis_client import pubsub_prefix, _script_cache_for, _check_scripts, _program_name, \
+        _check_lua_pull_response, _is_struct_response, _parse_lua_pull_response, \
+        _parse_lua_struct_response, _parse_lua_batch_responses, _share_commands
+
+logger = logging.getLogger(__name__)
+
+
+def _with_deadline(method):
+    """
+    Private decorator bounding a client coroutine, including the retries of
+    its failed commands, by its timeout keyword argument, or else by the
+    client's default timeout. A coroutine that runs out of time is cancelled,
+    and raises SmaxConnectionError.
+    """
+    @functools.wraps(method)
+    async def wrapper(self, *args, **kwargs):
+        timeout = kwargs.get("timeout")
+        timeout = self._timeout if timeout is None else timeout
+        if timeout is None:
+            return await method(self, *args, **kwargs)
+        try:
+            return await asyncio.wait_for(method(self, *args, **kwargs), timeout)
+        except asyncio.TimeoutError:
+            self._logger.error(f"{method.__name__}() did not complete within {timeout} s")
+            raise SmaxConnectionError(f"Deadline of {timeout} s exceeded")
+    return wrapper
+
+
+class AsyncSmaxRedisClient:
+    def __init__(self, redis_ip="localhost", redis_port=6379, redis_db=0,
+                 program_name=None, hostname=None, timeout=None, logger=logger):
+        """
+        Constructor for AsyncSmaxRedisClient, an asyncio version of
+        SmaxRedisClient built on redis.asyncio. Construction does not touch the
+        network: the connection is made and the script SHAs are loaded by
+        smax_connect(), which is also called on entering an `async with` block.
+
+        All the requests made by the coroutines of one client are multiplexed
+        on the connection pool of a single redis.asyncio client, so many
+        concurrent pulls can be in flight on one event loop.
+
+        Args:
+            redis_ip (str): IP address of redis-server.
+            redis_port (int): Port of redis-server.
+            redis_db (int): Database index to connect to.
+            program_name (str): Optional program name gets appended to hostname.
+            hostname (str): Optional hostname, obtained automatically otherwise.
+            timeout (float): Default time limit in seconds of pulls and
+                             shares, including the retries of failed
+                             commands, as for SmaxRedisClient.
+        """
+        self._logger = logger
+        self._timeout = timeout
+
+        self._redis_ip = redis_ip
+        self._redis_port = redis_port
+        self._redis_db = redis_db
+
+        # SHAs of the LUA scripts by name, shared with the other clients of the
+        # same server in this process (see SmaxRedisClient._get_scripts()).
+        self._scripts = _script_cache_for(redis_ip, redis_port, redis_db)
+
+        self._client = None
+        self._pubsub = None
+
+        # Obtain _hostname automatically, unless '_hostname' argument is passed.
+        self._hostname = socket.gethostname() if hostname is None else hostname
+        self._hostname += ':' + (program_name or _program_name())
+
+    async def __aenter__(self):
+        await self.smax_connect()
+        return self
+
+    async def __aexit__(self, *args):
+        await self.smax_disconnect()
+
+    @_with_deadline
+    async def smax_connect(self):
+        """
+        Create the redis.asyncio client and load the LUA script SHAs from the
+        server, unless another client of the same server already did, within
+        the client's default timeout.
+
+        Returns:
+            Redis: The redis.asyncio client object.
+        """
+        retry = Retry(ExponentialBackoff(cap=30, base=0.05), 30)
+        self._client = Redis(host=self._redis_ip,
+                             port=self._redis_port,
+                             db=self._redis_db,
+                             retry=retry,
+                             retry_on_error=[BusyLoadingError, ConnectionError, TimeoutError, OSError],
+                             health_check_interval=30)
+        try:
+            if len(self._scripts) == 0:
+                await self._get_scripts()
+        except (ConnectionError, TimeoutError) as e:
+            self._logger.error(f"Connecting to redis and getting scripts failed with {e}")
+            raise SmaxConnectionError(e.args)
+        self._logger.info(f"Connected to redis server {self._redis_ip}:{self._redis_port} db={self._redis_db}")
+        return self._client
+
+    async def _get_scripts(self, *names):
+        """
+        Get the SHAs of the cached scripts with a single HGETALL, or refresh
+        only the named ones with a single HMGET.
+
+        Args:
+            *names (str): Only refresh the SHAs of these scripts.
+
+        Raises:
+            SmaxKeyError: if one of the named scripts is not on the server.
+        """
+        if len(names) > 0:
+            self._logger.info(f"Refreshing script SHAs for {names} from server")
+            scripts = dict(zip(names, await self._client.hmget('scripts', names)))
+        else:
+            self._logger.info(f"Pulling script SHAs from server")
+            scripts = {name.decode("utf-8"): sha for name, sha in (await self._client.hgetall('scripts')).items()}
+        self._scripts.update({name: sha for name, sha in scripts.items() if sha is not None})
+        _check_scripts(names, scripts)
+
+    async def smax_disconnect(self):
+        """
+        Close the pub/sub connection, if any, and the connection pool.
+        """
+        if self._pubsub is not None:
+            await self._pubsub.aclose()
+            self._pubsub = None
+        if self._client is not None:
+            await self._client.aclose()
+        self._logger.info(f"Disconnected redis server {self._redis_ip}:{self._redis_port} db={self._redis_db}")
+
+    async def _script_shas(self, *names):
+        """
+        Private coroutine returning the SHAs of the named LUA scripts, loading
+        those not cached yet from the server with a single HMGET.
+
+        Args:
+            *names (str): Names of the scripts, e.g. HGetWithMeta.
+
+        Returns:
+            dict: SHA of each script by name.
+
+        Raises:
+            SmaxKeyError: if one of the scripts is not on the server.
+        """
+        missing = [name for name in names if self._scripts.get(name) is None]
+        if len(missing) > 0:
+            await self._get_scripts(*missing)
+        return {name: self._scripts[name] for name in names}
+
+    async def _evalsha(self, script, *args):
+        """
+        Private coroutine that runs one of the SMA-X LUA scripts, reloading the
+        script SHAs once if the server does not know the cached one.
+
+        Args:
+            script (str): Name of the script to call, e.g. HGetWithMeta.
+            *args: Arguments to evalsha() after the SHA.
+        """
+        try:
+            return await self._client.evalsha((await self._script_shas(script))[script], *args)
+        except NoScriptError:
+            await self._get_scripts(script)
+            return await self._client.evalsha(self._scripts[script], *args)
+
+    @_with_deadline
+    async def smax_pull(self, table, key, raw=False, *, timeout=None):
+        """
+        Get data stored with HSetWithMeta along with its metadata. See
+        SmaxRedisClient.smax_pull().
+
+        Args:
+            table (str): SMAX table name
+            key (str): SMAX key name
+            raw (bool): Return the unparsed data in a SmaxBytes object
+            timeout (float): Time limit in seconds, including retries, instead
+                             of the client's default.
+
+        Returns:
+            Smax<type>: Populated Smax<type> dataclass object, or a SmaxStruct.
+        """
+        table, key = normalize_pair(table, key)
+        try:
+            lua_data = await self._evalsha("HGetWithMeta", '1', table, key)
+            _check_lua_pull_response(lua_data, table, key, logger=self._logger)
+            if _is_struct_response(lua_data):
+                lua_struct = await self._evalsha("GetStruct", '1', f"{table}:{key}")
+                return _parse_lua_struct_response(lua_data, lua_struct, table, key, logger=self._logger)
+        except (ConnectionError, TimeoutError) as e:
+            self._logger.error(f"Reading {join(table, key)} from Redis failed")
+            raise SmaxConnectionError(e.args)
+
+        return _parse_lua_pull_response(lua_data, f"{table}:{key}", raw=raw, logger=self._logger)
+
+    @_with_deadline
+    async def smax_pull_batch(self, names, raw=False, *, timeout=None):
+        """
+        Pull several SMA-X values in a single round trip. See
+        SmaxRedisClient.smax_pull_batch().
+
+        Args:
+            names (list): SMA-X names to pull, either as full "table:key"
+                          strings or as (table, key) pairs.
+            raw (bool): Return the unparsed data in SmaxBytes objects
+            timeout (float): Time limit in seconds, including retries, instead
+                             of the client's default.
+
+        Returns:
+            list: Smax<type> objects or SmaxStructs, in the same order as names.
+        """
+        pairs = [normalize_pair(*n) if isinstance(n, (tuple, list)) else normalize_pair(n) for n in names]
+        if len(pairs) == 0:
+            return []
+
+        try:
+            responses = await self._execute_pipeline(
+                [("HGetWithMeta", '1', table, key) for table, key in pairs], transaction=False)
+            structs = [i for i, lua_data in enumerate(responses)
+                       if lua_data is not None and lua_data[0] is not None and _is_struct_response(lua_data)]
+            struct_responses = {}
+            if len(structs) > 0:
+                struct_data = await self._execute_pipeline(
+                    [("GetStruct", '1', join(*pairs[i])) for i in structs], transaction=False)
+                struct_responses = dict(zip(structs, struct_data))
+        except (ConnectionError, TimeoutError) as e:
+            self._logger.error(f"Reading batch of {len(pairs)} values from Redis failed")
+            raise SmaxConnectionError(e.args)
+
+        return _parse_lua_batch_responses(pairs, responses, struct_responses, raw=raw,
+                                          logger=self._logger)
+
+    @_with_deadline
+    async def smax_share(self, table, key, value, smax_type=None, *, timeout=None):
+        """
+        Send data to redis using HSetWithMeta, or HMSetWithMeta in a MULTI/EXEC
+        pipeline for (nested) dicts. See SmaxRedisClient.smax_share().
+
+        Args:
+            table (str): SMAX table name
+            key (str): SMAX key name
+            value: data to store, takes supported types, including (nested) dicts.
+            smax_type (str): Force casting to smax_type before sharing.
+            timeout (float): Time limit in seconds, including retries, instead
+                             of the client's default.
+
+        Returns:
+            return value from evalsha(), or a list of them for a struct.
+        """
+        table, key = normalize_pair(table, key)
+        commands = _share_commands(table, key, value, smax_type=smax_type)
+        try:
+            if len(commands) == 1 and commands[0][0] == "HSetWithMeta":
+                _, id, args = commands[0]
+                return await self._evalsha("HSetWithMeta", '1', id, self._hostname, *args)
+            return await self._execute_pipeline(self._share_calls(commands))
+        except (ConnectionError, TimeoutError) as e:
+            self._logger.error(f"Sharing {join(table, key)} to Redis failed")
+            raise SmaxConnectionError(e.args)
+
+    @_with_deadline
+    async def smax_share_batch(self, values, smax_type=None, *, timeout=None):
+        """
+        Share several SMA-X values atomically in a single round trip. See
+        SmaxRedisClient.smax_share_batch().
+
+        Args:
+            values (dict): SMA-X names, either as full "table:key" strings or as
+                           (table, key) tuples, mapped to the values to share.
+            smax_type (str): Force casting of the single (non-dict) values to
+                             smax_type before sharing.
+            timeout (float): Time limit in seconds, including retries, instead
+                             of the client's default.
+
+        Returns:
+            list: return values of the LUA script calls.
+        """
+        commands = []
+        for name, value in values.items():
+            table, key = normalize_pair(*name) if isinstance(name, tuple) else normalize_pair(name)
+            commands.extend(_share_commands(table, key, value, smax_type=smax_type))
+        if len(commands) == 0:
+            return []
+
+        try:
+            return await self._execute_pipeline(self._share_calls(commands))
+        except (ConnectionError, TimeoutError) as e:
+            self._logger.error("Unable to share batch of values.")
+            raise SmaxConnectionError(e.args)
+
+    def _share_calls(self, commands):
+        """Private function converting share commands into evalsha() calls"""
+        return [(script, '1', id, self._hostname, *args) for script, id, args in commands]
+
+    async def _execute_pipeline(self, calls, transaction=True):
+        """
+        Private coroutine that runs a list of evalsha() calls in one pipeline,
+        loading the script SHAs first if not cached, and reloading them once if
+        the server does not know the cached ones.
+
+        Args:
+            calls (list): tuples of (script name, *evalsha args)
+            transaction (bool): Wrap the pipeline in MULTI/EXEC.
+        """
+        for attempt in range(2):
+            shas = await self._script_shas(*set(call[0] for call in calls))
+            async with self._client.pipeline(transaction=transaction) as pipeline:
+                for script, *args in calls:
+                    pipeline.evalsha(shas[script], *args)
+                try:
+                    return await pipeline.execute()
+                except NoScriptError:
+                    if attempt > 0:
+                        raise
+                    await self._get_scripts(*set(call[0] for call in calls))
+
+    async def smax_subscribe(self, pattern):
+        """
+        Subscribe to a SMA-X field, or to a pattern ending in '*'. Use
+        smax_wait_on_any_subscribed() or iterate over smax_iter_subscribed() to
+        receive the updates.
+
+        Args:
+            pattern (str): Either full name of smax field, or use a wildcard '*'
+                           at the end of the pattern to be notified for anything
+                           underneath.
+        """
+        if self._pubsub is None:
+            self._pubsub = self._client.pubsub(ignore_subscribe_messages=True)
+
+        if pattern.endswith("*"):
+            await self._pubsub.psubscribe(f"{pubsub_prefix}:{pattern}")
+        else:
+            await self._pubsub.subscribe(f"{pubsub_prefix}:{pattern}")
+        self._logger.info(f"Subscribed to {pattern}")
+
+    async def smax_unsubscribe(self, pattern=None):
+        """
+        Unsubscribe from all subscribed channels, or pass a pattern argument
+        to unsubscribe from specific channels.
+
+        Args:
+            pattern (str): Either full name of smax field, or use a wildcard '*'
+                           at the end of the pattern to be notified for anything
+                           underneath.
+        """
+        if self._pubsub is None:
+            return
+        if pattern is None:
+            await self._pubsub.punsubscribe()
+            await self._pubsub.unsubscribe()
+        elif pattern.endswith("*"):
+            await self._pubsub.punsubscribe(f"{pubsub_prefix}:{pattern}")
+        else:
+            await self._pubsub.unsubscribe(f"{pubsub_prefix}:{pattern}")
+        self._logger.info(f"Unsubscribed from {pattern if pattern else 'all tables'}")
+
+    async def _next_notification(self, timeout=None):
+        """
+        Private coroutine returning the next SMA-X notification from the pubsub
+        connection, or raising redis TimeoutError after timeout seconds.
+        """
+        # Messages on other channels do not restart the timeout.
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            # get_message() with timeout=None blocks until a message arrives.
+            remaining = None if deadline is None else max(deadline - time.monotonic(), 0)
+            message = await self._pubsub.get_message(ignore_subscribe_messages=True, timeout=remaining)
+            if message is None:
+                if deadline is None:
+                    continue
+                if remaining > 0:
+                    # A subscribe confirmation, which does not end the wait.
+                    continue
+                raise TimeoutError("Timed out waiting for redis message.")
+            if message["type"] not in ("message", "pmessage"):
+                continue
+            name = channel_name(message["channel"], pubsub_prefix)
+            if name is not None:
+                message["channel"] = name
+                message["data"] = message["data"].decode("utf-8")
+                return message
+
+    async def smax_wait_on_any_subscribed(self, timeout=None, notification_only=False):
+        """
+        Wait for an update on any of the subscribed channels.
+
+        Args:
+            timeout (float): Value in seconds to wait before raising timeout exception.
+            notification_only (bool): If True, only returns the notification from redis.
+
+        Returns:
+            Either a (dict) notification, or the actual pulled data.
+        """
+        message = await self._next_notification(timeout=timeout)
+        if notification_only:
+            return message
+        return await self.smax_pull(*normalize_pair(message["channel"]))
+
+    async def smax_iter_subscribed(self, notification_only=False):
+        """
+        Asynchronous iterator over the updates on the subscribed channels.
+
+            async for value in client.smax_iter_subscribed():
+                ...
+
+        Args:
+            notification_only (bool): If True, yield the notifications from
+                                      redis instead of pulling the values.
+
+        Yields:
+            Either a (dict) notification, or the actual pulled data.
+        """
+        while self._pubsub is not None:
+            yield await self.smax_wait_on_any_subscribed(notification_only=notification_only)
@@ -0,0 +1,190 @@
+import logging
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future, TimeoutError as FutureTimeoutError
+
+from redis.exceptions import ConnectionError, TimeoutError
+
+from .smax_connection_pool import SmaxReplyTimeout, deadline
+
+logger = logging.getLogger(__name__)
+
+
+class SmaxAutoPipeline:
+    def __init__(self, client, window=0.0, max_batch=512, logger=logger):
+        """
+        Coalesces commands issued concurrently from many threads into single
+        pipeline writes to Redis, and hands each reply back to the thread
+        waiting for it.
+
+        A single writer thread sends whatever commands are queued as one
+        non-transactional pipeline. While that round trip is in flight, new
+        commands accumulate in the queue and go out together in the next one,
+        so a lone caller sees no added latency, while many concurrent callers
+        share round trips. A non-zero window makes the writer wait that long
+        for more commands before each write, trading latency for larger batches.
+
+        Each write is bounded by the earliest deadline of its commands (see
+        execute_command()). Commands whose callers stopped waiting before they
+        were written are not sent.
+
+        Args:
+            client (Redis): redis-py client used to create the pipelines.
+            window (float): Seconds to wait for more commands before each write.
+            max_batch (int): Maximum number of commands in one pipeline.
+        """
+        self._client = client
+        self._window = window
+        self._max_batch = max_batch
+        self._logger = logger
+
+        self._queue = deque()
+        self._condition = threading.Condition()
+        self._closed = False
+        self._write_failed = False
+
+        # Counters for smax_stats()
+        self.commands = 0
+        self.batches = 0
+        self.max_batch_size = 0
+
+        self._thread = threading.Thread(target=self._run, name="smax-auto-pipeline", daemon=True)
+        self._thread.start()
+
+    def execute_command(self, *args, timeout=None, send_timeout=None):
+        """
+        Queue a command for the next pipeline write, and block until its reply
+        arrives.
+
+        Args:
+            *args: Redis command and its arguments, as for Redis.execute_command().
+            timeout (float): Seconds to wait for the reply, or None to wait
+                             until it arrives.
+            send_timeout (float): Seconds to wait for the command to be
+                                  written to Redis, including the retries of
+                                  the connection, or None for no limit but
+                                  timeout.
+
+        Returns:
+            The reply to the command. Errors replied by Redis for this command,
+            or connection errors for the whole pipeline, are raised.
+
+        Raises:
+            TimeoutError: if the command was not written in time, and is not
+                          sent.
+            SmaxReplyTimeout: if the command was written, and may have run,
+                              but its reply did not arrive in time.
+        """
+        future = Future()
+        now = time.monotonic()
+        reply_by = None if timeout is None else now + timeout
+        send_by = None if send_timeout is None else now + send_timeout
+        with self._condition:
+            if self._closed:
+                raise RuntimeError("Auto-pipeline is closed")
+            self._queue.append((args, future, reply_by, send_by))
+            self._condition.notify()
+        try:
+            return future.result(timeout=_remaining(reply_by, send_by))
+        except FutureTimeoutError:
+            pass
+        # A command not yet taken by the writer is cancelled, and skipped.
+        if future.cancel():
+            raise TimeoutError(f"Command not sent within {_remaining(send_by, reply_by, since=now):.3f} s "
+                               f"by auto-pipeline")
+        try:
+            return future.result(timeout=_remaining(reply_by))
+        except FutureTimeoutError:
+            raise SmaxReplyTimeout(f"No reply within {timeout} s from auto-pipeline")
+
+    def close(self):
+        """
+        Stop the writer thread, once the queued commands have been sent, or
+        right away if the last write failed, with the queued commands failing
+        rather than waiting for Redis.
+        """
+        with self._condition:
+            self._closed = True
+            if self._write_failed:
+                while self._queue:
+                    args, future, reply_by, send_by = self._queue.popleft()
+                    if future.set_running_or_notify_cancel():
+                        future.set_exception(ConnectionError("Auto-pipeline closed after a failed write, "
+                                                             "command not sent"))
+            self._condition.notify()
+        if threading.current_thread() is not self._thread:
+            self._thread.join()
+
+    def stats(self):
+        """
+        Returns:
+            dict: number of commands and pipelines sent, and the largest batch.
+        """
+        return {"commands": self.commands,
+                "batches": self.batches,
+                "max_batch_size": self.max_batch_size,
+                "queued": len(self._queue)}
+
+    def _next_batch(self):
+        with self._condition:
+            while not self._queue and not self._closed:
+                self._condition.wait()
+            if self._window > 0:
+                window_end = time.monotonic() + self._window
+                while len(self._queue) < self._max_batch and not self._closed:
+                    remaining = window_end - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self._condition.wait(remaining)
+            n = min(len(self._queue), self._max_batch)
+            return [self._queue.popleft() for i in range(n)]
+
+    def _run(self):
+        pipeline = self._client.pipeline(transaction=False)
+        while True:
+            batch = self._next_batch()
+            if not batch:
+                # Only happens once closed and drained.
+                return
+
+            # The commands whose callers stopped waiting are skipped.
+            batch = [command for command in batch if command[1].set_running_or_notify_cancel()]
+            if not batch:
+                continue
+
+            for args, future, reply_by, send_by in batch:
+                pipeline.execute_command(*args)
+            try:
+                with deadline(_remaining(*[command[2] for command in batch])), \
+                        deadline(_remaining(*[command[3] for command in batch]), connect_only=True):
+                    results = pipeline.execute(raise_on_error=False)
+            except Exception as e:
+                self._logger.error(f"Auto-pipeline write of {len(batch)} commands failed with {e!r}")
+                self._write_failed = True
+                for args, future, reply_by, send_by in batch:
+                    future.set_exception(e)
+                continue
+
+            self._write_failed = False
+            self.commands += len(batch)
+            self.batches += 1
+            self.max_batch_size = max(self.max_batch_size, len(batch))
+
+            for (args, future, reply_by, send_by), result in zip(batch, results):
+                if isinstance(result, Exception):
+                    future.set_exception(result)
+                else:
+                    future.set_result(result)
+
+
+def _remaining(*times, since=None):
+    """
+    Private function returning the seconds left, never negative, to the
+    earliest of some time.monotonic() values, or None if they are all None.
+    With since, the seconds from since to it instead.
+    """
+    times = [t for t in times if t is not None]
+    if len(times) == 0:
+        return None
+    return max(min(times) - (time.monotonic() if since is None else since), 0)
@@ -0,0 +1,209 @@
+import logging
+import threading
+import time
+from collections import OrderedDict, deque
+
+logger = logging.getLogger(__name__)
+
+# What to do with a notification when the queue is full. With "coalesce", a
+# notification also replaces one for the same key that is still queued.
+_policies = ("coalesce", "drop_oldest", "drop_newest", "block")
+
+
+class SmaxCallbackDispatcher:
+    def __init__(self, workers=4, max_queue=1000, policy="coalesce", logger=logger):
+        """
+        Runs subscription callbacks on a pool of worker threads, so that a slow
+        callback does not hold up the notifications of other keys.
+
+        Notifications are queued by key, and the notifications of a key are
+        handled one at a time, in the order they arrived, while different keys
+        are handled concurrently by the workers.
+
+        Args:
+            workers (int): Number of worker threads.
+            max_queue (int): Maximum number of queued notifications.
+            policy (str): "coalesce" keeps only the latest queued notification
+                          of each key, since the callback pulls the latest
+                          value anyway, and drops the oldest notification when
+                          the queue is full; "drop_oldest" and "drop_newest"
+                          drop the oldest queued or the new notification when
+                          the queue is full; "block" makes the pub/sub thread
+                          wait for room in the queue.
+        """
+        if policy not in _policies:
+            raise ValueError(f"Unknown callback queue policy {policy!r}, expected one of {_policies}")
+        self._max_queue = max_queue
+        self._policy = policy
+        self._logger = logger
+
+        # Queued (function, args, time queued) of each key, and the keys ready
+        # to run, that have queued notifications and none running.
+        self._pending = OrderedDict()
+        self._ready = deque()
+        self._running = set()
+        self._size = 0
+        self._condition = threading.Condition()
+        self._closed = False
+
+        # Counters for smax_stats()
+        self.dispatched = 0
+        self.coalesced = 0
+        self.dropped = 0
+        self.completed = 0
+        self.errors = 0
+        self.max_queue_depth = 0
+        self._wait_time = 0.0
+        self._max_wait_time = 0.0
+        self._run_time = 0.0
+        self._max_run_time = 0.0
+
+        self._threads = [threading.Thread(target=self._run, name=f"smax-callback-{i}", daemon=True)
+                         for i in range(workers)]
+        for thread in self._threads:
+            thread.start()
+
+    def submit(self, key, function, *args, discard=None):
+        """
+        Queue a call of function(*args), after the queued calls of key.
+
+        Args:
+            key: Key of the notification, e.g. the (callback, SMA-X name).
+            function (func): Function to call on a worker thread.
+            *args: Arguments of the function.
+            discard (func): Function called, with coalesced=True if it was
+                            replaced by a newer call of the key, if the call
+                            is dropped from the queue later on.
+
+        Returns:
+            bool: False if the call was dropped.
+        """
+        item = (function, args, time.monotonic(), discard)
+        with self._condition:
+            if self._closed:
+                return False
+            self.dispatched += 1
+
+            queued = self._pending.get(key)
+            if self._policy == "coalesce" and queued:
+                _discard(queued[-1], coalesced=True)
+                queued[-1] = item
+                # The key now has the newest queued notification, for drop_oldest.
+                self._pending.move_to_end(key)
+                self.coalesced += 1
+                return True
+
+            while self._size >= self._max_queue:
+                if self._policy == "block":
+                    self._condition.wait()
+                    if self._closed:
+                        return False
+                elif self._policy == "drop_newest":
+                    self.dropped += 1
+                    return False
+                else:
+                    self._drop_oldest()
+
+            if key not in self._pending:
+                self._pending[key] = deque()
+                if key not in self._running:
+                    self._ready.append(key)
+            self._pending[key].append(item)
+            self._size += 1
+            self.max_queue_depth = max(self.max_queue_depth, self._size)
+            self._condition.notify_all()
+            return True
+
+    def _drop_oldest(self):
+        """Private method dropping the oldest queued call. Called with the lock held."""
+        key, queued = next(iter(self._pending.items()))
+        _discard(queued.popleft(), coalesced=False)
+        if not queued:
+            del self._pending[key]
+            if key in self._ready:
+                self._ready.remove(key)
+        self._size -= 1
+        self.dropped += 1
+
+    def close(self):
+        """Stop the worker threads, once the queued calls have been made."""
+        with self._condition:
+            self._closed = True
+            self._condition.notify_all()
+        for thread in self._threads:
+            if threading.current_thread() is not thread:
+                thread.join()
+
+    def stats(self):
+        """
+        Returns:
+            dict: current and largest queue depth, numbers of dispatched,
+                  coalesced, dropped and completed calls and of errors, and
+                  the mean and maximum time calls waited in the queue and ran,
+                  in seconds.
+        """
+        completed = max(self.completed, 1)
+        return {"queue_depth": self._size,
+                "max_queue_depth": self.max_queue_depth,
+                "dispatched": self.dispatched,
+                "coalesced": self.coalesced,
+                "dropped": self.dropped,
+                "completed": self.completed,
+                "errors": self.errors,
+                "mean_wait_time": self._wait_time / completed,
+                "max_wait_time": self._max_wait_time,
+                "mean_run_time": self._run_time / completed,
+                "max_run_time": self._max_run_time}
+
+    def _next(self):
+        """Private method taking the next call to make, or None once closed and drained."""
+        with self._condition:
+            while not self._ready and not self._closed:
+                self._condition.wait()
+            if not self._ready:
+                return None
+            key = self._ready.popleft()
+            queued = self._pending[key]
+            item = queued.popleft()
+            if not queued:
+                del self._pending[key]
+            self._size -= 1
+            self._running.add(key)
+            self._condition.notify_all()
+            return key, item
+
+    def _run(self):
+        while True:
+            next_call = self._next()
+            if next_call is None:
+                return
+            key, (function, args, queued, discard) = next_call
+
+            start = time.monotonic()
+            failed = False
+            try:
+                function(*args)
+            except Exception as e:
+                failed = True
+                self._logger.error(f"Callback for {key} failed with {e!r}")
+            end = time.monotonic()
+
+            with self._condition:
+                self.completed += 1
+                self.errors += failed
+                self._wait_time += start - queued
+                self._max_wait_time = max(self._max_wait_time, start - queued)
+                self._run_time += end - start
+                self._max_run_time = max(self._max_run_time, end - start)
+
+                self._running.discard(key)
+                if key in self._pending:
+                    self._ready.append(key)
+                    self._condition.notify_all()
+
+
+def _discard(item, coalesced):
+    """Private function calling the discard function of a dropped call, if any."""
+    discard = item[3]
+    if discard is not None:
+        discard(coalesced=coalesced)
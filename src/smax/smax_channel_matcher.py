@@ -0,0 +1,127 @@
+import functools
+import re
+from fnmatch import translate
+
+from .smax_client import normalize_pair
+
+# Size of the caches of channel names, and of compiled pattern matchers.
+channel_cache_size = 4096
+
+_wildcard = re.compile(r"[*?\[]")
+
+
+class SmaxChannelMatcher:
+    def __init__(self, patterns=()):
+        """
+        Matches SMA-X names against any number of fnmatch-style patterns at
+        once, as smax_subscribe() patterns are matched by Redis.
+
+        Names without wildcards are looked up in a set. The patterns with
+        wildcards are compiled to regular expressions, and filed in a trie by
+        the tables of their literal prefix, e.g. "weather:*" and
+        "weather:wind*" under "weather", so that a name is only tested against
+        the patterns of the tables it is in.
+
+        Args:
+            patterns (str or list): Patterns to match, which can also be added
+                                    and removed later.
+        """
+        if isinstance(patterns, str):
+            patterns = [patterns]
+        self._names = set()
+        # Each node of the trie is a pair of its children by table name, and
+        # the compiled patterns filed under it.
+        self._trie = ({}, {})
+        for pattern in patterns:
+            self.add(pattern)
+
+    def add(self, pattern):
+        """Add a pattern, or SMA-X name, to match."""
+        wildcard = _wildcard.search(pattern)
+        if wildcard is None:
+            self._names.add(pattern)
+            return
+        node = self._trie
+        for table in pattern[:wildcard.start()].split(":")[:-1]:
+            node = node[0].setdefault(table, ({}, {}))
+        node[1][pattern] = re.compile(translate(pattern)).match
+
+    def remove(self, pattern):
+        """Remove a pattern, or SMA-X name, added earlier."""
+        wildcard = _wildcard.search(pattern)
+        if wildcard is None:
+            self._names.discard(pattern)
+            return
+        node = self._trie
+        for table in pattern[:wildcard.start()].split(":")[:-1]:
+            node = node[0].get(table)
+            if node is None:
+                return
+        node[1].pop(pattern, None)
+
+    def match(self, name):
+        """
+        Args:
+            name (str): SMA-X name, e.g. from a notification.
+
+        Returns:
+            list: The patterns matching name.
+        """
+        patterns = [name] if name in self._names else []
+        node = self._trie
+        for table in name.split(":"):
+            patterns.extend(pattern for pattern, match in node[1].items() if match(name))
+            node = node[0].get(table)
+            if node is None:
+                break
+        return patterns
+
+    def matches(self, name):
+        """
+        Returns:
+            bool: True if name matches any of the patterns.
+        """
+        if name in self._names:
+            return True
+        node = self._trie
+        for table in name.split(":"):
+            if any(match(name) for match in node[1].values()):
+                return True
+            node = node[0].get(table)
+            if node is None:
+                return False
+        return False
+
+
+@functools.lru_cache(maxsize=channel_cache_size)
+def compile_patterns(patterns):
+    """
+    Returns:
+        SmaxChannelMatcher: Matcher of a pattern, or of a tuple of patterns,
+                            compiled once for all the notifications.
+    """
+    return SmaxChannelMatcher(patterns)
+
+
+@functools.lru_cache(maxsize=channel_cache_size)
+def channel_name(channel, prefix):
+    """
+    Returns:
+        str: SMA-X name notified on a pub/sub channel (bytes) with prefix, or
+             None if the channel does not have the prefix.
+    """
+    channel = channel.decode("utf-8")
+    if not channel.startswith(f"{prefix}:"):
+        return None
+    return channel[len(prefix) + 1:]
+
+
+@functools.lru_cache(maxsize=channel_cache_size)
+def channel_pair(channel, prefix):
+    """
+    Returns:
+        tuple: (table, key) notified on a pub/sub channel (bytes) with prefix,
+               or None if the channel does not have the prefix.
+    """
+    name = channel_name(channel, prefix)
+    return None if name is None else tuple(normalize_pair(name))
@@ -21,6 +21,18 @@ class SmaxKeyError(RuntimeError):
 class SmaxUnderflowWarning(RuntimeWarning):
     pass
 
+class _SmaxUnavailable:
+    """Type of smax_unavailable."""
+    def __repr__(self):
+        return "smax_unavailable"
+
+    def __bool__(self):
+        return False
+
+# Value of pulls in fail-fast mode, when Redis could not be reached in time and
+# no earlier value of the name is known.
+smax_unavailable = _SmaxUnavailable()
+
 class SmaxClient(ABC):
 
     def __init__(self, *args, **kwargs):
@@ -0,0 +1,323 @@
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+from redis import ConnectionPool, BlockingConnectionPool
+from redis.connection import Connection, SENTINEL
+from redis.exceptions import BusyLoadingError, ConnectionError, TimeoutError
+from redis.backoff import ExponentialBackoff
+from redis.retry import Retry
+
+logger = logging.getLogger(__name__)
+
+# Process-wide registry of shared connection pools, keyed by (host, port, db),
+# with the number of clients using each one.
+_pools = {}
+_pool_clients = {}
+_pools_lock = threading.Lock()
+
+
+def _after_fork_in_child():
+    # Another thread of the parent may have held the lock at the time of the
+    # fork. The pools themselves replace their connections in the child.
+    global _pools_lock
+    _pools_lock = threading.Lock()
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_after_fork_in_child)
+
+# Deadline of the Redis commands of each thread, and the deadline to reach
+# Redis only, as time.monotonic() values.
+_deadlines = threading.local()
+
+
+class SmaxReplyTimeout(TimeoutError):
+    """
+    The reply to a command sent to Redis did not arrive in time. Unlike a
+    failure to connect, the command may have run, so it is neither retried
+    nor sent again in any other way.
+    """
+
+
+@contextmanager
+def deadline(timeout, connect_only=False):
+    """
+    Context manager bounding the total time of the Redis commands made by
+    this thread within it, including their retries. A command that fails
+    gives up with a TimeoutError rather than retrying after the deadline.
+    Nested deadlines can only shorten the outer one.
+
+    Args:
+        timeout (float): Seconds from now to the deadline, or None for no
+                         deadline (beyond the outer one, if any).
+        connect_only (bool): Only bound the time spent reaching Redis, i.e.
+                             connecting and retrying, and not the wait for
+                             the replies of the commands sent, which may be
+                             running.
+    """
+    attribute = "connect_value" if connect_only else "value"
+    previous = getattr(_deadlines, attribute, None)
+    if timeout is not None:
+        value = time.monotonic() + timeout
+        setattr(_deadlines, attribute, value if previous is None else min(value, previous))
+    try:
+        yield
+    finally:
+        setattr(_deadlines, attribute, previous)
+
+
+def deadline_remaining(connect=False):
+    """
+    Args:
+        connect (bool): Include the deadline to reach Redis (see deadline()).
+
+    Returns:
+        float: Seconds left to the deadline of this thread (possibly negative),
+               or None if there is no deadline.
+    """
+    values = [getattr(_deadlines, "value", None)]
+    if connect:
+        values.append(getattr(_deadlines, "connect_value", None))
+    values = [v for v in values if v is not None]
+    if len(values) == 0:
+        return None
+    return min(values) - time.monotonic()
+
+
+def _reply_timed_out(error):
+    """
+    Private function checking whether an error, or one it was raised from,
+    is a SmaxReplyTimeout, after which a command may have run.
+    """
+    while error is not None:
+        if isinstance(error, SmaxReplyTimeout):
+            return True
+        error = error.__cause__ or error.__context__
+    return False
+
+
+class SmaxRetry(Retry):
+    """
+    Retry of failed commands with a backoff, which gives up when the next
+    attempt would be after the deadline of the calling thread (see deadline()).
+    Commands whose reply timed out are not retried (see SmaxReplyTimeout).
+    """
+    def call_with_retry(self, do, fail, is_retryable=None, with_failure_count=False):
+        def fail_before_deadline(error, failures):
+            if with_failure_count:
+                fail(error, failures)
+            else:
+                fail(error)
+            if isinstance(error, SmaxReplyTimeout):
+                raise error
+            remaining = deadline_remaining(connect=True)
+            if remaining is not None and remaining <= self._backoff.compute(failures):
+                raise TimeoutError(f"Deadline exceeded after {failures} attempts: {error}") from error
+
+        return super().call_with_retry(do, fail_before_deadline, is_retryable, with_failure_count=True)
+
+
+def _deadline_timeout(timeout, connect=False):
+    """
+    Private function returning a socket timeout shortened to the deadline of
+    the calling thread, if any, and no shorter than a millisecond, so that a
+    socket is never made non-blocking.
+    """
+    remaining = deadline_remaining(connect)
+    if remaining is None:
+        return timeout
+    remaining = max(remaining, 0.001)
+    return remaining if timeout is None else min(timeout, remaining)
+
+
+class SmaxConnection(Connection):
+    """
+    Connection whose connect and read timeouts are shortened to the deadline
+    of the calling thread, if any (see deadline()), so that a server that
+    accepts connections but does not reply cannot hold a call past it. Reads
+    that time out raise SmaxReplyTimeout.
+    """
+    def connect(self):
+        # A connection is only used by one thread at a time.
+        socket_connect_timeout = self.socket_connect_timeout
+        self.socket_connect_timeout = _deadline_timeout(socket_connect_timeout, connect=True)
+        try:
+            super().connect()
+        finally:
+            self.socket_connect_timeout = socket_connect_timeout
+
+    def read_response(self, *args, timeout=SENTINEL, **kwargs):
+        if timeout is SENTINEL and deadline_remaining() is not None:
+            timeout = _deadline_timeout(self.socket_timeout)
+        try:
+            return super().read_response(*args, timeout=timeout, **kwargs)
+        except TimeoutError as e:
+            raise SmaxReplyTimeout(*e.args) from e
+
+
+class SmaxBlockingConnectionPool(BlockingConnectionPool):
+    """
+    BlockingConnectionPool whose wait for a free connection also ends at the
+    deadline of the calling thread, if any (see deadline()).
+    """
+    @property
+    def timeout(self):
+        return _deadline_timeout(self._timeout, connect=True)
+
+    @timeout.setter
+    def timeout(self, value):
+        self._timeout = value
+
+
+def _server_address(server, redis_port=6379):
+    """
+    Private function returning the (host, port) address of a Redis server
+    given as "host", "host:port" or (host, port).
+    """
+    if isinstance(server, str):
+        host, _, port = server.partition(":")
+        return host, int(port) if port else redis_port
+    host, port = server
+    return host, int(port)
+
+
+def create_connection_pool(redis_ip, redis_port, redis_db, max_connections=None,
+                           blocking=False, timeout=20, retries=30, socket_timeout=None,
+                           socket_connect_timeout=5):
+    """
+    Create a new redis-py connection pool, configured with the retry, timeout
+    and health check settings used by SMA-X clients. No connections are made
+    until they are first needed.
+
+    The socket timeouts, and the wait of a blocking pool for a free
+    connection, are shortened to the deadline of the calling thread, if any
+    (see deadline()).
+
+    Replies are waited for without a timeout by default, as a command that
+    times out is sent again by the retries, and the SMA-X scripts are not
+    idempotent: a slow share would be applied twice. Reads are bounded by the
+    deadline of the call instead, after which the command is not retried.
+
+    Args:
+        redis_ip (str): IP address of redis-server.
+        redis_port (int): Port of redis-server.
+        redis_db (int): Database index to connect to.
+        max_connections (int): Maximum number of connections in the pool.
+        blocking (bool): Use a BlockingConnectionPool, which waits for a free
+                         connection rather than raising when all are in use.
+        timeout (float): Seconds a blocking pool waits for a free connection.
+        retries (int): Number of retries, with exponential backoff, of
+                       commands failing on connection errors. Retries also
+                       stop at the deadline of the calling thread, if any
+                       (see deadline()).
+        socket_timeout (float): Seconds to wait for each reply from the
+                                server, or None to wait until the deadline
+                                of the call, if any.
+        socket_connect_timeout (float): Seconds to wait for a connection to
+                                        be made, or None to wait forever.
+
+    Returns:
+        ConnectionPool: the new connection pool.
+    """
+    retry = SmaxRetry(ExponentialBackoff(cap=30, base=0.05), retries)
+    kwargs = dict(host=redis_ip,
+                  port=redis_port,
+                  db=redis_db,
+                  retry=retry,
+                  retry_on_error=[BusyLoadingError, ConnectionError, TimeoutError, OSError],
+                  health_check_interval=30,
+                  socket_timeout=socket_timeout,
+                  socket_connect_timeout=socket_connect_timeout,
+                  connection_class=SmaxConnection)
+    if blocking:
+        return SmaxBlockingConnectionPool(max_connections=max_connections or 50, timeout=timeout, **kwargs)
+    return ConnectionPool(max_connections=max_connections, **kwargs)
+
+
+def get_connection_pool(redis_ip, redis_port, redis_db, **kwargs):
+    """
+    Get the connection pool shared by all clients of a Redis server and
+    database in this process, creating it on first use. Each call must be
+    balanced by a call to release_connection_pool().
+
+    Args:
+        redis_ip (str): IP address of redis-server.
+        redis_port (int): Port of redis-server.
+        redis_db (int): Database index to connect to.
+        **kwargs: Options passed to create_connection_pool() when the pool is
+                  created. They are ignored if the pool already exists.
+
+    Returns:
+        ConnectionPool: the shared connection pool.
+    """
+    key = (redis_ip, int(redis_port), int(redis_db))
+    with _pools_lock:
+        pool = _pools.get(key)
+        if pool is None:
+            pool = create_connection_pool(redis_ip, redis_port, redis_db, **kwargs)
+            _pools[key] = pool
+            _pool_clients[key] = 0
+            logger.debug(f"Created shared connection pool for {redis_ip}:{redis_port} db={redis_db}")
+        _pool_clients[key] += 1
+        return pool
+
+
+def release_connection_pool(pool):
+    """
+    Release a shared connection pool obtained from get_connection_pool(). The
+    pool's connections are closed when its last client releases it.
+
+    Args:
+        pool (ConnectionPool): the shared connection pool.
+    """
+    with _pools_lock:
+        for key, shared in _pools.items():
+            if shared is pool:
+                _pool_clients[key] -= 1
+                if _pool_clients[key] <= 0:
+                    del _pools[key]
+                    del _pool_clients[key]
+                    pool.disconnect()
+                    logger.debug(f"Closed shared connection pool for {key}")
+                return
+    # Not a shared pool (or already released)
+    pool.disconnect()
+
+
+def connection_pool_stats(pool=None):
+    """
+    Connection usage statistics.
+
+    Args:
+        pool (ConnectionPool): Pool to report on. Default is all the shared pools.
+
+    Returns:
+        dict: For a single pool, the number of clients sharing it, the number
+              of connections created, in use and idle, and the maximum allowed.
+              Without a pool, a dict of these keyed by "host:port/db".
+    """
+    if pool is None:
+        with _pools_lock:
+            pools = list(_pools.items())
+        return {f"{host}:{port}/{db}": connection_pool_stats(p) for (host, port, db), p in pools}
+
+    with _pools_lock:
+        clients = sum(n for key, n in _pool_clients.items() if _pools[key] is pool)
+
+    if isinstance(pool, BlockingConnectionPool):
+        created = len(pool._connections)
+        idle = len([c for c in list(pool.pool.queue) if c is not None])
+        in_use = created - idle
+    else:
+        created = pool._created_connections
+        idle = len(pool._available_connections)
+        in_use = len(pool._in_use_connections)
+
+    return {"clients": clients,
+            "created": created,
+            "in_use": in_use,
+            "idle": idle,
+            "max_connections": pool.max_connections}
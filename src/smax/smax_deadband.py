@@ -0,0 +1,134 @@
+import logging
+import threading
+
+import numpy as np
+
+from .smax_client import SmaxBool
+from .smax_sequence_tracker import _leaves
+
+logger = logging.getLogger(__name__)
+
+# The last delivered value of a name that has none yet.
+_missing = object()
+
+
+class SmaxDeadband:
+    def __init__(self, absolute=None, relative=None, logger=logger):
+        """
+        Suppresses the values of a callback subscription that did not move
+        significantly from the last value delivered, for smax_subscribe().
+
+        A numeric value, scalar or array, is delivered when any of its
+        elements differs from the last one delivered for its name by more
+        than absolute + relative * abs(last), as in numpy.isclose(). Arrays
+        that changed shape, and values becoming or ceasing to be NaN, are
+        always delivered. Other values (strings, booleans) are delivered when
+        they change. A struct is delivered when any of its leaves is, and then
+        becomes the last delivered value of all of them.
+
+        Since the values are compared to the last one delivered, rather than
+        the last one received, a slow drift is delivered once it adds up to
+        more than the deadband.
+
+        Args:
+            absolute (float): Absolute tolerance, in the units of the values.
+            relative (float): Tolerance relative to the last delivered value,
+                              e.g. 0.01 for 1%.
+        """
+        if absolute is None and relative is None:
+            raise ValueError("A deadband needs an absolute or a relative tolerance")
+        if (absolute or 0) < 0 or (relative or 0) < 0:
+            raise ValueError(f"Deadband tolerances must be positive, not {absolute} and {relative}")
+        self.absolute = absolute or 0.0
+        self.relative = relative or 0.0
+        self._logger = logger
+
+        # The last delivered value of each name.
+        self._last = {}
+        self._lock = threading.Lock()
+
+        # Counters for smax_stats()
+        self.checked = 0
+        self.suppressed = 0
+
+    def exceeds(self, value):
+        """
+        Check a pulled value against the last one delivered, recording it as
+        delivered if it is outside the deadband.
+
+        Args:
+            value (Smax<type> or SmaxStruct): Pulled value.
+
+        Returns:
+            bool: True if the value is to be delivered.
+        """
+        leaves = list(_leaves(value))
+        with self._lock:
+            self.checked += 1
+            if len(leaves) > 0 and not any(self._exceeds(leaf) for leaf in leaves):
+                self.suppressed += 1
+                return False
+            for leaf in leaves:
+                name = getattr(leaf, "smaxname", None)
+                if name is not None:
+                    self._last[name] = _copy(leaf)
+            return True
+
+    def _exceeds(self, value):
+        """Private method comparing a leaf to the last one delivered. Called with the lock held."""
+        name = getattr(value, "smaxname", None)
+        last = self._last.get(name, _missing)
+        if last is _missing:
+            return True
+        if not (_is_numeric(value) and _is_numeric(last)):
+            return not _equal(value, last)
+        new = np.asarray(value, dtype=float)
+        if new.shape != last.shape:
+            return True
+        if np.any(np.isnan(new) != np.isnan(last)):
+            return True
+        return bool(np.any(np.abs(new - last) > self.absolute + self.relative * np.abs(last)))
+
+    def stats(self):
+        """
+        Returns:
+            dict: numbers of values checked against the deadband, and of
+                  values suppressed.
+        """
+        return {"checked": self.checked,
+                "suppressed": self.suppressed}
+
+
+def _is_numeric(value):
+    """Private function telling whether a value is compared with the tolerances."""
+    if isinstance(value, (bool, np.bool_, SmaxBool)):
+        return False
+    if isinstance(value, np.ndarray):
+        return np.issubdtype(value.dtype, np.number)
+    return isinstance(value, (int, float, np.number))
+
+
+def _copy(value):
+    """
+    Private function returning the value kept as the last delivered one,
+    without the metadata, which SMA-X types compare as well.
+    """
+    if _is_numeric(value):
+        return np.array(value, dtype=float)
+    if isinstance(value, (bool, np.bool_, SmaxBool)):
+        return bool(value)
+    if isinstance(value, str):
+        return str(value)
+    if isinstance(value, bytes):
+        return bytes(value)
+    if isinstance(value, list):
+        return list(value)
+    return value
+
+
+def _equal(value, last):
+    """Private function comparing values that are not compared with the tolerances."""
+    try:
+        return bool(np.all(_copy(value) == last))
+    except (TypeError, ValueError):
+        return False
@@ -0,0 +1,237 @@
+import logging
+import threading
+import time
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+# What to do with a new name when the buffer is full.
+_policies = ("drop_oldest", "drop_newest", "error")
+
+# Seconds a share or replay tries to reach Redis, including retries, before
+# it is buffered, or put back in the buffer. The replies of the shares sent
+# are waited for, as without the buffer.
+outage_timeout = 1.0
+
+
+class SmaxOutageBuffer:
+    def __init__(self, max_keys=1000, max_bytes=None, policy="drop_oldest", retry_interval=1.0,
+                 timeout=outage_timeout, logger=logger):
+        """
+        A bounded buffer of the shares made while Redis is unreachable, to be
+        replayed once it is back.
+
+        Only the latest value of each SMA-X name is kept, as the LUA script
+        calls that share it. A name shared again while buffered replaces its
+        earlier value, and moves to the end of the replay order.
+
+        Args:
+            max_keys (int): Maximum number of buffered names.
+            max_bytes (int): Maximum total size of the buffered arguments, or
+                             None for no limit.
+            policy (str): What to do with a new name when the buffer is full:
+                          "drop_oldest" drops the names buffered longest ago,
+                          "drop_newest" drops the new name, and "error" makes
+                          the share raise as without a buffer.
+            retry_interval (float): Seconds between attempts to replay the
+                                    buffer while Redis is down.
+            timeout (float): Seconds a share or a replay tries to reach
+                             Redis before giving up, instead of the full
+                             backoff of the connection retries, so that
+                             shares are buffered promptly. It does not bound
+                             the wait for the reply of a share sent, which
+                             may be slow rather than lost.
+        """
+        if policy not in _policies:
+            raise ValueError(f"Unknown outage buffer policy {policy!r}, expected one of {_policies}")
+        self.max_keys = max_keys
+        self.max_bytes = max_bytes
+        self.policy = policy
+        self.retry_interval = retry_interval
+        self.timeout = timeout
+        self._logger = logger
+
+        # Commands and size of each buffered name, in replay order.
+        self._buffer = OrderedDict()
+        self._bytes = 0
+        # Names taken from the buffer whose replay is not finished.
+        self._replaying = 0
+        self._next_replay = 0.0
+        self._lock = threading.Lock()
+
+        # Counters for smax_stats()
+        self.buffered = 0
+        self.replaced = 0
+        self.dropped = 0
+        self.replayed = 0
+        self.replay_failures = 0
+        self.unknown = 0
+        self.outage_start = None
+
+    def __len__(self):
+        return len(self._buffer)
+
+    def pending(self):
+        """
+        Returns:
+            bool: True if there are buffered shares, or shares being replayed,
+                  which a new share must not overtake.
+        """
+        with self._lock:
+            return len(self._buffer) > 0 or self._replaying > 0
+
+    def add(self, name, commands):
+        """
+        Buffer the share of a SMA-X name.
+
+        Args:
+            name (str): Full SMA-X name.
+            commands (list): (script, id, args) LUA script calls sharing the
+                             value, from _share_commands().
+
+        Returns:
+            bool: True if the share was buffered, False if the buffer is full
+                  and the policy is "error".
+        """
+        size = _commands_size(commands)
+        with self._lock:
+            if self.outage_start is None:
+                self.outage_start = time.monotonic()
+                self._next_replay = self.outage_start + self.retry_interval
+
+            if name in self._buffer:
+                self._bytes -= self._buffer.pop(name)[1]
+                self.replaced += 1
+            elif not self._make_room(size):
+                if self.policy == "error":
+                    return False
+                self.dropped += 1
+                self._logger.warning(f"Outage buffer full, dropped share of {name}")
+                return True
+
+            self._buffer[name] = (commands, size)
+            self._bytes += size
+            self.buffered += 1
+            return True
+
+    def _make_room(self, size):
+        """
+        Private method dropping the oldest names, if the policy allows it, until
+        a new name of size bytes fits. Called with the lock held.
+
+        Returns:
+            bool: True if the new name fits.
+        """
+        while self._exceeds(1, size) and self.policy == "drop_oldest" and len(self._buffer) > 0:
+            name, (commands, dropped_size) = self._buffer.popitem(last=False)
+            self._bytes -= dropped_size
+            self.dropped += 1
+            self._logger.warning(f"Outage buffer full, dropped share of {name}")
+        return not self._exceeds(1, size)
+
+    def _exceeds(self, keys, size):
+        """
+        Private method checking whether adding keys names, of size bytes in
+        all, would exceed max_keys or max_bytes. Called with the lock held.
+        """
+        return len(self._buffer) + keys > self.max_keys or \
+            (self.max_bytes is not None and self._bytes + size > self.max_bytes)
+
+    def replay_due(self):
+        """
+        Returns:
+            bool: True if there are buffered shares and it is time to try
+                  replaying them.
+        """
+        return len(self._buffer) > 0 and time.monotonic() >= self._next_replay
+
+    def take(self, n):
+        """
+        Remove the n oldest names from the buffer, to replay them.
+
+        Returns:
+            list: (name, commands) of the names, oldest first.
+        """
+        with self._lock:
+            items = []
+            while len(items) < n and len(self._buffer) > 0:
+                name, (commands, size) = self._buffer.popitem(last=False)
+                self._bytes -= size
+                items.append((name, commands))
+            self._replaying += len(items)
+            return items
+
+    def replayed_ok(self, items):
+        """Record the successful replay of items taken from the buffer."""
+        with self._lock:
+            self._replaying -= len(items)
+            self.replayed += len(items)
+            if len(self._buffer) == 0 and self.outage_start is not None:
+                self._logger.info(f"Replayed the shares buffered during "
+                                  f"{time.monotonic() - self.outage_start:.1f} s outage")
+                self.outage_start = None
+
+    def replay_failed(self, items):
+        """
+        Put back items taken from the buffer whose replay failed, ahead of the
+        rest, unless a newer value of the name was buffered in the meantime.
+
+        The items are put back within max_keys and max_bytes, as new names,
+        while the names buffered in the meantime are kept: with the
+        "drop_oldest" policy, the oldest items are dropped, and with the
+        others, the newest items.
+        """
+        with self._lock:
+            self._replaying -= len(items)
+            self.replay_failures += 1
+            self._next_replay = time.monotonic() + self.retry_interval
+            items = [(name, commands, _commands_size(commands)) for name, commands in items
+                     if name not in self._buffer]
+            while len(items) > 0 and self._exceeds(len(items), sum(size for name, commands, size in items)):
+                name = items.pop(0 if self.policy == "drop_oldest" else -1)[0]
+                self.dropped += 1
+                self._logger.warning(f"Outage buffer full, dropped share of {name}")
+            for name, commands, size in reversed(items):
+                self._buffer[name] = (commands, size)
+                self._buffer.move_to_end(name, last=False)
+                self._bytes += size
+
+    def replay_unknown(self, items):
+        """
+        Record items taken from the buffer whose replay was sent, but not
+        answered in time, so that they may or may not have been made. They
+        are not put back, so as not to make them twice.
+        """
+        with self._lock:
+            self._replaying -= len(items)
+            self.unknown += len(items)
+
+    def clear(self):
+        """Drop all the buffered shares, e.g. in a child process after a fork."""
+        self._lock = threading.Lock()
+        self._buffer.clear()
+        self._bytes = 0
+        self._replaying = 0
+        self.outage_start = None
+
+    def stats(self):
+        """
+        Returns:
+            dict: Numbers of buffered names and bytes, and counters of buffered,
+                  replaced, dropped and replayed shares, and of replayed shares
+                  whose outcome is unknown.
+        """
+        return {"keys": len(self._buffer),
+                "bytes": self._bytes,
+                "buffered": self.buffered,
+                "replaced": self.replaced,
+                "dropped": self.dropped,
+                "replayed": self.replayed,
+                "replay_failures": self.replay_failures,
+                "unknown": self.unknown,
+                "outage_seconds": 0.0 if self.outage_start is None else time.monotonic() - self.outage_start}
+
+
+def _commands_size(commands):
+    """Private function estimating the memory used by buffered commands, in bytes."""
+    return sum(len(id) + sum(len(str(a)) for a in args) for script, id, args in commands)
@@ -0,0 +1,417 @@
+import bisect
+import hashlib
+import logging
+import selectors
+import time
+
+from redis.exceptions import TimeoutError
+
+from .smax_client import SmaxClient, join, normalize_pair
+from .smax_connection_pool import _server_address
+from .smax_redis_client import SmaxRedisClient, pubsub_sleep
+
+logger = logging.getLogger(__name__)
+
+# Characters that make a pattern match more than one name.
+_wildcards = "*?["
+
+
+class SmaxPartitionedClient(SmaxClient):
+    def __init__(self, servers, table_map=None, redis_db=0, points_per_server=100,
+                 logger=logger, **kwargs):
+        """
+        A SMA-X client for tables partitioned over several Redis servers.
+
+        Each top-level SMA-X table (the first component of a SMA-X name) lives
+        on one server, given by table_map if it is listed there, or else by
+        consistent hashing of the table name over the servers. All the fields
+        of a top-level table, including its structs, are therefore on the
+        same server. Adding a server to the hash only moves about 1/N of the
+        tables.
+
+        Pulls, shares and metadata go to the server of their table. Batch
+        pulls and shares are split by server, with one round trip to each
+        (batch shares are then atomic on each server, not across servers).
+        Subscriptions to patterns whose top-level table contains wildcards,
+        and the purge and list functions, are fanned out to all the servers
+        and their results merged.
+
+        Args:
+            servers (list): Redis servers as "host", "host:port" or (host, port).
+            table_map (dict): Server for some top-level tables, in the same
+                              form, by table name. These servers need not be
+                              in servers.
+            redis_db (int): Database index to connect to on each server.
+            points_per_server (int): Points (virtual nodes) of each server on
+                                     the hash ring.
+            **kwargs: Other SmaxRedisClient arguments, used for all servers,
+                      e.g. program_name.
+        """
+        self._logger = logger
+        self._redis_db = redis_db
+        self._points_per_server = points_per_server
+        self._client_options = dict(kwargs, logger=logger)
+
+        super().__init__(servers, table_map)
+        self._shards = self._client
+
+    def smax_connect_to(self, servers, table_map=None):
+        """
+        Create a SmaxRedisClient for each server, and the hash ring of the
+        servers. This function is called automatically by the SmaxClient
+        parent class.
+
+        Args:
+            servers (list): Redis servers as "host", "host:port" or (host, port).
+            table_map (dict): Server for some top-level tables, by table name.
+
+        Returns:
+            dict: SmaxRedisClient for each server, by "host:port".
+        """
+        clients = {}
+        ring_servers = []
+        for server in list(servers) + list((table_map or {}).values()):
+            host, port = _server_address(server)
+            name = f"{host}:{port}"
+            if name not in clients:
+                clients[name] = SmaxRedisClient(host, port, self._redis_db, **self._client_options)
+            if server in servers and name not in ring_servers:
+                ring_servers.append(name)
+
+        self._table_map = {table: "%s:%d" % _server_address(server)
+                           for table, server in (table_map or {}).items()}
+
+        # Consistent hash ring, with several points for each server to spread
+        # the tables evenly.
+        self._ring = sorted((_hash(f"{name}#{i}"), name)
+                            for name in ring_servers for i in range(self._points_per_server))
+        self._ring_keys = [h for h, name in self._ring]
+
+        self._logger.info(f"Partitioning SMA-X tables over {list(clients)}")
+        return clients
+
+    def smax_server(self, table, key=None):
+        """
+        The server of a SMA-X table or name.
+
+        Args:
+            table (str): SMA-X table, or full name.
+            key (str): Optional SMA-X key in table.
+
+        Returns:
+            str: "host:port" of the server.
+        """
+        top = join(table, key).lstrip(":").split(":", 1)[0]
+        server = self._table_map.get(top)
+        if server is None:
+            i = bisect.bisect(self._ring_keys, _hash(top)) % len(self._ring)
+            server = self._ring[i][1]
+        return server
+
+    def _shard(self, table, key=None):
+        """Private method returning the SmaxRedisClient for a SMA-X table or name."""
+        return self._shards[self.smax_server(table, key)]
+
+    def _shards_for_pattern(self, pattern):
+        """
+        Private method returning the SmaxRedisClients that may have names
+        matching pattern: all of them if its top-level table has wildcards.
+        """
+        if pattern is None:
+            return list(self._shards.values())
+        top = pattern.split(":", 1)[0]
+        if any(c in top for c in _wildcards):
+            return list(self._shards.values())
+        return [self._shard(top)]
+
+    def smax_disconnect(self):
+        """Disconnect from all the servers."""
+        for client in self._shards.values():
+            client.smax_disconnect()
+
+    def smax_stats(self):
+        """
+        Returns:
+            dict: smax_stats() of each server's client, by "host:port".
+        """
+        return {name: client.smax_stats() for name, client in self._shards.items()}
+
+    def smax_missed_updates(self):
+        """
+        Updates missed by the subscribers, from all the servers. See
+        SmaxRedisClient.smax_missed_updates().
+        """
+        missed = {}
+        for client in self._shards.values():
+            missed.update(client.smax_missed_updates())
+        return missed
+
+    def smax_pull(self, table, key, pull_meta=False, raw=False, *, timeout=None):
+        """
+        Pull a SMA-X value or struct from the server of its table. See
+        SmaxRedisClient.smax_pull().
+        """
+        return self._shard(table, key).smax_pull(table, key, pull_meta=pull_meta, raw=raw, timeout=timeout)
+
+    def smax_pull_batch(self, names, raw=False, *, timeout=None):
+        """
+        Pull several SMA-X values, with one round trip to each server. See
+        SmaxRedisClient.smax_pull_batch().
+
+        Returns:
+            list: Smax<type> objects or SmaxStructs, in the same order as names.
+        """
+        by_server = {}
+        for i, name in enumerate(names):
+            table, key = normalize_pair(*name) if isinstance(name, (tuple, list)) else normalize_pair(name)
+            by_server.setdefault(self.smax_server(table, key), []).append((i, (table, key)))
+
+        results = [None] * len(names)
+        for server, items in by_server.items():
+            values = self._shards[server].smax_pull_batch([pair for i, pair in items], raw=raw, timeout=timeout)
+            for (i, pair), value in zip(items, values):
+                results[i] = value
+        return results
+
+    def smax_share(self, table, key, value, push_meta=False, maintain_type=False, smax_type=None, *,
+                   timeout=None):
+        """
+        Share a SMA-X value or struct on the server of its table. See
+        SmaxRedisClient.smax_share().
+        """
+        return self._shard(table, key).smax_share(table, key, value, push_meta=push_meta,
+                                                  maintain_type=maintain_type, smax_type=smax_type,
+                                                  timeout=timeout)
+
+    def smax_share_batch(self, values, smax_type=None, *, timeout=None):
+        """
+        Share several SMA-X values, with one atomic MULTI/EXEC pipeline on each
+        server. See SmaxRedisClient.smax_share_batch().
+
+        Returns:
+            dict: pipeline.execute() results of each server, by "host:port".
+        """
+        by_server = {}
+        for name, value in values.items():
+            table, key = normalize_pair(*name) if isinstance(name, tuple) else normalize_pair(name)
+            by_server.setdefault(self.smax_server(table, key), {})[(table, key)] = value
+        return {server: self._shards[server].smax_share_batch(batch, smax_type=smax_type, timeout=timeout)
+                for server, batch in by_server.items()}
+
+    def smax_replay_buffer(self, force=False, batch_size=500, *, timeout=None):
+        """
+        Replay the shares buffered on each server's client while it was
+        unreachable. See SmaxRedisClient.smax_replay_buffer().
+
+        Returns:
+            bool: True if no shares are still buffered for any server.
+        """
+        results = [client.smax_replay_buffer(force=force, batch_size=batch_size, timeout=timeout)
+                   for client in self._shards.values()]
+        return all(results)
+
+    def smax_subscribe(self, pattern, callback=None, pubsub_sleep=pubsub_sleep, incremental=False,
+                       lag_threshold=None, lag_policy="coalesce", deadband=None, relative_deadband=None,
+                       group_structs=False):
+        """
+        Subscribe to a SMA-X name or pattern on the server of its table, or on
+        all servers if the top-level table has wildcards. See
+        SmaxRedisClient.smax_subscribe().
+        """
+        for client in self._shards_for_pattern(pattern):
+            client.smax_subscribe(pattern, callback=callback, pubsub_sleep=pubsub_sleep, incremental=incremental,
+                                  lag_threshold=lag_threshold, lag_policy=lag_policy, deadband=deadband,
+                                  relative_deadband=relative_deadband, group_structs=group_structs)
+
+    def smax_unsubscribe(self, pattern=None, callback=None):
+        """
+        Unsubscribe from a SMA-X name or pattern, or from everything. See
+        SmaxRedisClient.smax_unsubscribe().
+        """
+        for client in self._shards_for_pattern(pattern):
+            client.smax_unsubscribe(pattern, callback=callback)
+
+    def _wait(self, clients, wait, timeout):
+        """
+        Private method waiting for the first notification from any of clients.
+        If there are several, the pub/sub connections of all of them are
+        watched at once with a selector, and each client is asked for a
+        notification, without waiting, whenever any of them has data to read.
+
+        Args:
+            clients (list): SmaxRedisClients to wait on.
+            wait (func): Wait function taking a client and a timeout.
+            timeout (float): Seconds to wait in total, or None to wait forever.
+
+        Raises:
+            RuntimeError: if none of clients has subscriptions without a
+                          callback, made by any thread.
+        """
+        clients = [c for c in clients if c._has_wait_subscriptions()]
+        if len(clients) == 0:
+            raise RuntimeError("No subscriptions to wait on, call smax_subscribe() without a callback first")
+        if len(clients) == 1:
+            return wait(clients[0], timeout)
+
+        deadline = None if timeout is None else time.monotonic() + timeout
+        sockets = {}
+        with selectors.DefaultSelector() as selector:
+            while True:
+                # Messages buffered by redis-py are read here, as the selector
+                # only sees those still on the sockets.
+                for client in clients:
+                    try:
+                        return wait(client, 0)
+                    except TimeoutError:
+                        pass
+
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    raise TimeoutError("Timed out waiting for redis message.")
+                if _watch_sockets(selector, sockets, clients):
+                    selector.select(remaining)
+                else:
+                    # A connection is being made again: check back for its socket.
+                    time.sleep(pubsub_sleep if remaining is None else min(remaining, pubsub_sleep))
+
+    def smax_wait_on_subscribed(self, pattern, timeout=None, notification_only=False, incremental=False):
+        """
+        Wait for a notification matching pattern, from the servers it was
+        subscribed on. See SmaxRedisClient.smax_wait_on_subscribed().
+        """
+        return self._wait(self._shards_for_pattern(pattern),
+                          lambda client, t: client.smax_wait_on_subscribed(pattern, timeout=t,
+                                                                           notification_only=notification_only,
+                                                                           incremental=incremental),
+                          timeout)
+
+    def smax_wait_on_any_subscribed(self, timeout=None, notification_only=False):
+        """
+        Wait for a notification from any server. See
+        SmaxRedisClient.smax_wait_on_any_subscribed().
+        """
+        return self._wait(list(self._shards.values()),
+                          lambda client, t: client.smax_wait_on_any_subscribed(timeout=t,
+                                                                               notification_only=notification_only),
+                          timeout)
+
+    def smax_wait_on_many(self, max_items=100, window=0.05, timeout=None, pattern=None,
+                          notification_only=False):
+        """
+        Collect the updates of a burst from the first server to notify one.
+        See SmaxRedisClient.smax_wait_on_many().
+        """
+        if pattern is None or isinstance(pattern, str):
+            clients = self._shards_for_pattern(pattern)
+        else:
+            clients = list({id(c): c for p in pattern for c in self._shards_for_pattern(p)}.values())
+        return self._wait(clients,
+                          lambda client, t: client.smax_wait_on_many(max_items, window, timeout=t, pattern=pattern,
+                                                                     notification_only=notification_only),
+                          timeout)
+
+    def smax_purge(self, table, key=None):
+        """
+        Purge a table or key, from all the servers that may have names
+        matching it. Use with ultimate caution.
+
+        Returns:
+            int: number of SMA-X keys purged, on all servers.
+        """
+        pattern = "*" if table is None else table
+        if key is not None:
+            pattern = f"{pattern}:{key}"
+        return sum(client.smax_purge(table, key) for client in self._shards_for_pattern(pattern))
+
+    def smax_purge_volatile(self):
+        """Purge all volatile tables and keys from all the servers."""
+        for client in self._shards.values():
+            client.smax_purge_volatile()
+
+    def smax_dsm_get_table(self, target, key, host=None):
+        """
+        Get the SMA-X name that maps to a DSM target, key, and (optionally)
+        host, from the first server that knows it.
+        """
+        for client in self._shards.values():
+            table = client.smax_dsm_get_table(target, key, host)
+            if table:
+                return table
+        return None
+
+    def smax_list_newer_than(self, dt):
+        """List the SMA-X keys newer than dt on all servers."""
+        return [kp for client in self._shards.values() for kp in client.smax_list_newer_than(dt)]
+
+    def smax_list_older_than(self, dt):
+        """List the SMA-X keys older than dt on all servers."""
+        return [kp for client in self._shards.values() for kp in client.smax_list_older_than(dt)]
+
+    def smax_list_higher_than(self, table, value):
+        """List the fields in table with values higher than value."""
+        return self._shard(table).smax_list_higher_than(table, value)
+
+    def smax_list_zeroes(self, key):
+        """List the fields in key equal to zero."""
+        return self._shard(key).smax_list_zeroes(key)
+
+    def smax_set_description(self, table, description):
+        return self.smax_push_meta("description", table, description)
+
+    def smax_get_description(self, table):
+        return self.smax_pull_meta("description", table)
+
+    def smax_set_units(self, table, unit):
+        return self.smax_push_meta("units", table, unit)
+
+    def smax_get_units(self, table):
+        return self.smax_pull_meta("units", table)
+
+    def smax_set_coordinate_system(self, table, coordinate_system):
+        self.smax_push_meta("coords", table, coordinate_system)
+
+    def smax_get_coordinate_system(self, table):
+        return self.smax_pull_meta("coords", table)
+
+    def smax_create_coordinate_system(self, n_axis):
+        raise NotImplementedError("Available in C API, not in python")
+
+    def smax_push_meta(self, meta, table, value):
+        """Set metadata for a SMA-X name, on the server of its table."""
+        return self._shard(table).smax_push_meta(meta, table, value)
+
+    def smax_pull_meta(self, meta, table):
+        """Pull metadata for a SMA-X name, from the server of its table."""
+        return self._shard(table).smax_pull_meta(meta, table)
+
+
+def _watch_sockets(selector, sockets, clients):
+    """
+    Private function registering the sockets of the pub/sub connections of
+    the calling thread on clients with selector, replacing those of
+    connections made again since, as kept in sockets by client.
+
+    Returns:
+        bool: True if all the clients have a connected socket.
+    """
+    connected = True
+    for client in clients:
+        pubsub = client._wait_pubsub()
+        connection = None if pubsub is None else pubsub.connection
+        sock = getattr(connection, "_sock", None)
+        if sock is not sockets.get(client):
+            if sockets.get(client) is not None:
+                try:
+                    selector.unregister(sockets[client])
+                except (KeyError, ValueError):
+                    pass
+            if sock is not None:
+                selector.register(sock, selectors.EVENT_READ)
+            sockets[client] = sock
+        connected = connected and sock is not None
+    return connected
+
+
+def _hash(name):
+    """Private function returning a stable hash of a name for the hash ring."""
+    return int.from_bytes(hashlib.md5(name.encode("utf-8")).digest()[:8], "big")
@@ -0,0 +1,387 @@
+import heapq
+import itertools
+import logging
+import selectors
+import socket
+import threading
+import time
+from collections import deque
+
+from redis.exceptions import ConnectionError, TimeoutError
+
+logger = logging.getLogger(__name__)
+
+# The types of the messages published to the subscribed channels and
+# patterns, rather than replies to the commands of the pub/sub connection,
+# e.g. the pong of its reconnection.
+_message_types = ("message", "pmessage")
+
+
+class SmaxPubSubDispatcher:
+    def __init__(self, client, sleep_time=0.010, polling=False, coalesce=False, max_coalesce=1000,
+                 owns_pool=False, logger=logger):
+        """
+        A single thread owning a pub/sub connection, which routes each message
+        to the handlers of its channel or pattern.
+
+        Channels and patterns can be subscribed and unsubscribed at any time,
+        from any thread, with any number of handlers each. The subscribe and
+        unsubscribe commands are run by the dispatcher thread itself, between
+        messages, so the pub/sub object is only ever used by that thread. The
+        thread starts with the first subscription.
+
+        The thread blocks until the pub/sub socket is readable, or a command
+        is queued, so it handles messages as soon as they arrive and uses no
+        CPU while idle. With polling, it instead waits for messages for
+        sleep_time at a time, running the queued commands in between.
+
+        Handlers can also schedule calls in the dispatcher thread, with
+        call_later(), e.g. to deliver what they held back.
+
+        With coalesce, the messages already received when the thread gets to
+        them are read together, and only the newest of each channel (and
+        pattern) is dispatched, so handlers that fall behind catch up with
+        the latest state rather than handle every intermediate message.
+
+        Args:
+            client (Redis): redis-py client used to create the pub/sub object.
+            sleep_time (float): Seconds to wait for a message before running
+                                the queued commands, when polling.
+            polling (bool): Poll for messages rather than block on the socket.
+            coalesce (bool): Dispatch only the newest of the pending messages
+                             of each channel.
+            max_coalesce (int): Maximum number of messages read together.
+            owns_pool (bool): The connection pool of the client is the
+                              dispatcher's own, and is disconnected when it
+                              is closed.
+        """
+        self._pubsub = client.pubsub(ignore_subscribe_messages=True)
+        self._sleep_time = sleep_time
+        self._polling = polling
+        self._coalesce = coalesce
+        self._max_coalesce = max_coalesce
+        self._owns_pool = owns_pool
+        self._logger = logger
+
+        if not polling:
+            # Queued commands wake the thread by writing to this socket pair.
+            self._wakeup_read, self._wakeup_write = socket.socketpair()
+            self._wakeup_read.setblocking(False)
+            self._wakeup_write.setblocking(False)
+            self._selector = selectors.DefaultSelector()
+            self._selector.register(self._wakeup_read, selectors.EVENT_READ)
+            self._socket = None
+
+        # Handlers of each subscribed channel or pattern, by key.
+        self._handlers = {}
+        self._patterns = set()
+        self._commands = deque()
+        # Heap of the (time, count, function) of the calls scheduled by call_later().
+        self._timers = []
+        self._timer_count = itertools.count()
+        self._lock = threading.Lock()
+        self._thread = None
+        self._closed = False
+
+        # Counters for smax_stats()
+        self.messages = 0
+        self.coalesced = 0
+        self.errors = 0
+
+    def subscribe(self, channel, key, handler, pattern=False, sleep_time=None):
+        """
+        Add a handler for the messages of a channel or pattern, subscribing to
+        it if it has no handler yet.
+
+        Args:
+            channel (str): Redis channel, or pattern with pattern=True.
+            key: Key of the handler, to unsubscribe it. A handler with the same
+                 key replaces the earlier one.
+            handler (func): Function called with each message, in the
+                            dispatcher thread.
+            pattern (bool): Whether channel is a pattern.
+            sleep_time (float): Shortens the dispatcher's wait for messages.
+        """
+        with self._lock:
+            if self._closed:
+                raise RuntimeError("Pub/sub dispatcher is closed")
+            if sleep_time is not None:
+                self._sleep_time = min(self._sleep_time, sleep_time)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="smax-pubsub", daemon=True)
+                self._thread.start()
+            handlers = self._handlers.setdefault(channel, {})
+            done = None
+            if len(handlers) == 0:
+                if pattern:
+                    self._patterns.add(channel)
+                done = self._queue_command(self._pubsub.psubscribe if pattern else self._pubsub.subscribe, channel)
+            handlers[key] = handler
+        self._wait(done)
+
+    def unsubscribe(self, channel=None, key=None):
+        """
+        Remove a handler, or all of them, of a channel or pattern, or of all,
+        unsubscribing from those left without a handler.
+
+        Args:
+            channel (str): Redis channel or pattern, or None for all.
+            key: Key of the handler to remove, or None for all.
+        """
+        with self._lock:
+            channels = list(self._handlers) if channel is None else [channel]
+            done = []
+            for c in channels:
+                handlers = self._handlers.get(c, {})
+                if key is None:
+                    handlers.clear()
+                else:
+                    handlers.pop(key, None)
+                if len(handlers) == 0 and c in self._handlers:
+                    del self._handlers[c]
+                    pattern = c in self._patterns
+                    self._patterns.discard(c)
+                    done.append(self._queue_command(self._pubsub.punsubscribe if pattern else self._pubsub.unsubscribe, c))
+        for d in done:
+            self._wait(d)
+
+    def channels(self):
+        """
+        Returns:
+            list: The subscribed channels and patterns.
+        """
+        with self._lock:
+            return list(self._handlers)
+
+    def call_later(self, delay, function):
+        """
+        Call a function in the dispatcher thread, between messages, after a
+        delay.
+
+        Args:
+            delay (float): Seconds from now to the call.
+            function (func): Function called without arguments.
+        """
+        with self._lock:
+            heapq.heappush(self._timers, (time.monotonic() + delay, next(self._timer_count), function))
+        if threading.current_thread() is not self._thread:
+            self._wakeup()
+
+    def _queue_command(self, function, *args):
+        """
+        Private method queueing a pub/sub command for the dispatcher thread.
+        Called with the lock held.
+
+        Returns:
+            Event: Set once the command was sent.
+        """
+        done = threading.Event()
+        self._commands.append((function, args, done))
+        self._wakeup()
+        return done
+
+    def _wakeup(self):
+        """Private method waking the dispatcher thread if it is blocked on the socket."""
+        if not self._polling:
+            try:
+                self._wakeup_write.send(b"\0")
+            except (BlockingIOError, OSError):
+                # Already woken up, or closed.
+                pass
+
+    def _wait(self, done):
+        """
+        Private method waiting until a queued command was sent, unless called
+        from the dispatcher thread itself (e.g. by a handler subscribing), which
+        sends it before reading the next message.
+        """
+        if done is None or threading.current_thread() is self._thread:
+            return
+        while not done.wait(self._sleep_time + 0.1):
+            if not self._thread.is_alive():
+                raise RuntimeError("Pub/sub dispatcher thread has stopped")
+
+    def close(self):
+        """
+        Stop the dispatcher thread and close its pub/sub connection, and its
+        connection pool if it owns it.
+        """
+        with self._lock:
+            self._closed = True
+            thread = self._thread
+        self._wakeup()
+        if thread is not None and thread is not threading.current_thread():
+            thread.join()
+        if thread is None:
+            self._close()
+
+    def _close(self):
+        """
+        Private method closing the pub/sub connection, the connection pool it
+        owns, and the wakeup sockets.
+        """
+        self._pubsub.close()
+        if self._owns_pool:
+            self._pubsub.connection_pool.disconnect()
+        if not self._polling:
+            self._selector.close()
+            self._wakeup_read.close()
+            self._wakeup_write.close()
+
+    def stats(self):
+        """
+        Returns:
+            dict: number of subscribed channels and patterns, and of messages
+                  dispatched, messages coalesced with newer ones, and handlers
+                  that raised.
+        """
+        return {"channels": len(self._handlers),
+                "messages": self.messages,
+                "coalesced": self.coalesced,
+                "errors": self.errors}
+
+    def _run_commands(self):
+        """Private method running the queued subscribe and unsubscribe commands."""
+        while self._commands:
+            function, args, done = self._commands.popleft()
+            try:
+                function(*args)
+            except Exception as e:
+                self._logger.error(f"Pub/sub command {function.__name__}{args} failed with {e!r}")
+            done.set()
+
+    def _run_timers(self):
+        """
+        Private method calling the functions scheduled by call_later() that
+        are due.
+
+        Returns:
+            float: Seconds to the next scheduled call, or None if there is none.
+        """
+        while True:
+            with self._lock:
+                if len(self._timers) == 0:
+                    return None
+                remaining = self._timers[0][0] - time.monotonic()
+                if remaining > 0:
+                    return remaining
+                function = heapq.heappop(self._timers)[2]
+            try:
+                function()
+            except Exception as e:
+                self.errors += 1
+                self._logger.error(f"Scheduled call of {function} failed with {e!r}")
+
+    def _wait_readable(self, timeout=None):
+        """
+        Private method blocking until the pub/sub connection has data to read,
+        a command is queued, or timeout seconds have passed.
+        """
+        connection = self._pubsub.connection
+        sock = getattr(connection, "_sock", None)
+        if sock is not self._socket:
+            if self._socket is not None:
+                try:
+                    self._selector.unregister(self._socket)
+                except (KeyError, ValueError):
+                    pass
+            if sock is not None:
+                self._selector.register(sock, selectors.EVENT_READ)
+            self._socket = sock
+
+        # Messages already read from the socket, and buffered by redis-py.
+        if sock is not None and connection.can_read(timeout=0):
+            return
+
+        # Without a socket (e.g. while reconnecting) keep checking for one.
+        if sock is None and self._pubsub.subscribed:
+            timeout = self._sleep_time if timeout is None else min(timeout, self._sleep_time)
+        for key, events in self._selector.select(timeout):
+            if key.fileobj is self._wakeup_read:
+                try:
+                    while self._wakeup_read.recv(4096):
+                        pass
+                except BlockingIOError:
+                    pass
+
+    def _pending_messages(self, message):
+        """
+        Private method reading the messages already received after message,
+        and keeping the newest of each channel and pattern.
+
+        Returns:
+            list: The messages to dispatch, in the order of their newest.
+        """
+        messages = {}
+        n = 0
+        while message is not None:
+            if message["type"] not in _message_types:
+                message = self._pubsub.get_message(timeout=0)
+                continue
+            key = (message["pattern"], message["channel"])
+            if messages.pop(key, None) is not None:
+                self.coalesced += 1
+            messages[key] = message
+            n += 1
+            if n >= self._max_coalesce:
+                break
+            message = self._pubsub.get_message(timeout=0)
+        return list(messages.values())
+
+    def _dispatch(self, message):
+        """Private method calling the handlers of a message."""
+        name = message["pattern"] if message["pattern"] is not None else message["channel"]
+        with self._lock:
+            handlers = list(self._handlers.get(name.decode("utf-8"), {}).values())
+        self.messages += 1
+        for handler in handlers:
+            try:
+                handler(message)
+            except Exception as e:
+                self.errors += 1
+                self._logger.error(f"Handler for {name} failed with {e!r}")
+
+    def _run(self):
+        while True:
+            self._run_commands()
+            if self._closed:
+                break
+            timer = self._run_timers()
+            try:
+                if self._polling:
+                    message = self._pubsub.get_message(timeout=self._sleep_time if timer is None
+                                                       else min(timer, self._sleep_time))
+                else:
+                    self._wait_readable(timer)
+                    message = self._pubsub.get_message(timeout=0)
+            except (ConnectionError, TimeoutError):
+                # Reconnect, which subscribes again to the channels and patterns.
+                self._logger.info("Pubsub lost connection")
+                try:
+                    self._pubsub.connection.retry.call_with_retry(self._pubsub.ping, lambda error: None)
+                    self._pubsub.on_connect(self._pubsub.connection)
+                    self._logger.info("Pubsub reconnected")
+                except (ConnectionError, TimeoutError) as e:
+                    self._logger.error(f"Pubsub could not reconnect: {e!r}")
+                continue
+            except Exception as e:
+                # e.g. a reply that does not parse, which should not stop the
+                # thread either.
+                self.errors += 1
+                self._logger.error(f"Pubsub read failed with {e!r}")
+                time.sleep(self._sleep_time)
+                continue
+            if message is None or message["type"] not in _message_types:
+                continue
+            # The handlers' errors are caught by _dispatch(), but nothing may
+            # stop the thread, which would silence all the subscriptions.
+            try:
+                if self._coalesce:
+                    for message in self._pending_messages(message):
+                        self._dispatch(message)
+                else:
+                    self._dispatch(message)
+            except Exception as e:
+                self.errors += 1
+                self._logger.error(f"Dispatching {message} failed with {e!r}")
+        self._close()
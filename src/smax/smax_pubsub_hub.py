@@ -0,0 +1,159 @@
+import logging
+import os
+import threading
+
+from redis import Redis
+
+from .smax_connection_pool import create_connection_pool
+from .smax_pubsub_dispatcher import SmaxPubSubDispatcher
+
+logger = logging.getLogger(__name__)
+
+# Process-wide registry of shared pub/sub dispatchers, keyed by (host, port,
+# db, polling, coalesce), with the hubs using each one.
+_dispatchers = {}
+_dispatcher_hubs = {}
+_dispatchers_lock = threading.Lock()
+
+
+def _after_fork_in_child():
+    # The dispatcher threads of the parent do not exist in the child, whose
+    # clients subscribe again on new hubs.
+    global _dispatchers_lock
+    _dispatchers_lock = threading.Lock()
+    _dispatchers.clear()
+    _dispatcher_hubs.clear()
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_after_fork_in_child)
+
+
+class SmaxPubSubHub:
+    def __init__(self, redis_ip, redis_port, redis_db, sleep_time=0.010, polling=False, coalesce=False,
+                 logger=logger):
+        """
+        A client's view of the pub/sub dispatcher shared by all the clients of
+        a Redis server and database in this process, with shared_pubsub.
+
+        The shared dispatcher (see SmaxPubSubDispatcher) has a single pub/sub
+        connection, on a connection pool of its own, and a single thread. It
+        subscribes once to each channel or pattern, however many clients
+        subscribed to it, so Redis sends each message once, and the thread
+        calls each handler of the clients once per message. The handlers of
+        each hub are kept apart from the others', so that a client
+        unsubscribing, or closing its hub, only removes its own. The
+        dispatcher is closed with the last hub using it.
+
+        Clients with different polling or coalesce settings use different
+        dispatchers. The sleep_time of a polling dispatcher is not part of
+        its key: the dispatcher waits for the shortest sleep_time of the hubs
+        and subscriptions using it, so that none of them polls less often
+        than it asked for. The dispatcher logs to the logger of the hub that
+        created it.
+
+        Args:
+            redis_ip (str): IP address of redis-server.
+            redis_port (int): Port of redis-server.
+            redis_db (int): Database index to connect to.
+            sleep_time (float): Seconds to wait for a message before running
+                                the queued commands, when polling.
+            polling (bool): Poll for messages rather than block on the socket.
+            coalesce (bool): Dispatch only the newest of the pending messages
+                             of each channel.
+        """
+        self._key = (redis_ip, int(redis_port), int(redis_db), polling, coalesce)
+        self._logger = logger
+        with _dispatchers_lock:
+            dispatcher = _dispatchers.get(self._key)
+            if dispatcher is None:
+                pool = create_connection_pool(redis_ip, redis_port, redis_db)
+                dispatcher = SmaxPubSubDispatcher(Redis(connection_pool=pool), sleep_time=sleep_time,
+                                                  polling=polling, coalesce=coalesce, owns_pool=True,
+                                                  logger=logger)
+                _dispatchers[self._key] = dispatcher
+                _dispatcher_hubs[self._key] = 0
+                logger.debug(f"Created shared pubsub dispatcher for {redis_ip}:{redis_port} db={redis_db}")
+            _dispatcher_hubs[self._key] += 1
+        self._dispatcher = dispatcher
+        self._sleep_time = sleep_time
+
+        # The (channel, key) of the handlers of this hub.
+        self._handlers = set()
+        self._lock = threading.Lock()
+        self._closed = False
+
+    def subscribe(self, channel, key, handler, pattern=False, sleep_time=None):
+        """
+        Add a handler for the messages of a channel or pattern, as
+        SmaxPubSubDispatcher.subscribe(), with keys of this hub only. The
+        sleep_time defaults to that of the hub.
+        """
+        with self._lock:
+            if self._closed:
+                raise RuntimeError("Pub/sub hub is closed")
+            self._handlers.add((channel, key))
+        self._dispatcher.subscribe(channel, (self, key), handler, pattern=pattern,
+                                   sleep_time=self._sleep_time if sleep_time is None else sleep_time)
+
+    def unsubscribe(self, channel=None, key=None):
+        """
+        Remove a handler of this hub, or all of them, of a channel or pattern,
+        or of all, as SmaxPubSubDispatcher.unsubscribe().
+        """
+        with self._lock:
+            handlers = [(c, k) for c, k in self._handlers
+                        if channel in (None, c) and key in (None, k)]
+            self._handlers.difference_update(handlers)
+        for c, k in handlers:
+            self._dispatcher.unsubscribe(c, (self, k))
+
+    def call_later(self, delay, function):
+        """
+        Call a function in the shared dispatcher thread after a delay, as
+        SmaxPubSubDispatcher.call_later().
+        """
+        self._dispatcher.call_later(delay, function)
+
+    def channels(self):
+        """
+        Returns:
+            list: The channels and patterns subscribed by this hub.
+        """
+        with self._lock:
+            return list({c for c, k in self._handlers})
+
+    def close(self):
+        """
+        Remove the handlers of this hub, and close the shared dispatcher and
+        its connection if this was the last hub using it.
+        """
+        with self._lock:
+            if self._closed:
+                return
+            self._closed = True
+        self.unsubscribe()
+        with _dispatchers_lock:
+            if _dispatchers.get(self._key) is not self._dispatcher:
+                # Inherited from the parent process.
+                return
+            _dispatcher_hubs[self._key] -= 1
+            if _dispatcher_hubs[self._key] > 0:
+                return
+            del _dispatchers[self._key]
+            del _dispatcher_hubs[self._key]
+        self._dispatcher.close()
+        self._logger.debug(f"Closed shared pubsub dispatcher for {self._key[:3]}")
+
+    def stats(self):
+        """
+        Returns:
+            dict: number of channels and patterns subscribed by this hub, and
+                  of messages dispatched, coalesced and failed by the shared
+                  dispatcher, with the number of clients sharing it.
+        """
+        stats = self._dispatcher.stats()
+        stats["channels"] = len(self.channels())
+        with _dispatchers_lock:
+            stats["shared"] = _dispatcher_hubs.get(self._key, 0)
+        return stats
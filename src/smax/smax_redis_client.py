@@ -1,40 +1,196 @@
 import os
+import functools
 from math import ceil, log
-from collections.abc import Container, Sequence
+from collections.abc import Container, Mapping, Sequence
 import logging
 import socket
+import threading
+import time
+import weakref
+from dataclasses import dataclass
 from datetime import datetime, timezone
-from fnmatch import fnmatch
 
-import psutil
 import numpy as np
 from numpy._core._exceptions import UFuncTypeError
 
 from redis import Redis
-from redis.exceptions import NoScriptError, BusyLoadingError, ConnectionError, TimeoutError
-from redis.backoff import ExponentialBackoff
-from redis.retry import Retry
+from redis.exceptions import NoScriptError, ConnectionError, TimeoutError, ResponseError
 
 from .smax_client import SmaxClient, SmaxData, SmaxInt, SmaxFloat, SmaxBool, SmaxStr, \
         SmaxStrArray, SmaxArray, SmaxStruct, SmaxInt8, SmaxInt16, SmaxInt32, \
         SmaxInt64, SmaxFloat32, SmaxFloat64, SmaxBool, SmaxBytes, \
         _TYPE_MAP, _REVERSE_TYPE_MAP, _SMAX_TYPE_MAP, _REVERSE_SMAX_TYPE_MAP, \
         optional_metadata, SmaxConnectionError, SmaxKeyError, SmaxUnderflowWarning, \
-        join, normalize_pair, print_smax, print_tree
-        
+        join, normalize_pair, print_smax, print_tree, smax_unavailable
+from .smax_auto_pipeline import SmaxAutoPipeline
+from .smax_connection_pool import get_connection_pool, create_connection_pool, \
+        release_connection_pool, connection_pool_stats, deadline, deadline_remaining, _reply_timed_out
+from .smax_replicas import SmaxReplicaSet, _is_replica_failure
+from .smax_outage_buffer import SmaxOutageBuffer
+from .smax_callback_dispatcher import SmaxCallbackDispatcher
+from .smax_pubsub_dispatcher import SmaxPubSubDispatcher
+from .smax_pubsub_hub import SmaxPubSubHub
+from .smax_struct_cache import SmaxStructCache
+from .smax_channel_matcher import compile_patterns, channel_name, channel_pair
+from .smax_subscription_monitor import SmaxSubscriptionMonitor
+from .smax_sequence_tracker import SmaxSequenceTracker, _leaves
+from .smax_deadband import SmaxDeadband
+from .smax_struct_grouper import SmaxStructGrouper
+
 # This prefix is used on SMA-X pub/sub channels to identify the messages/notification
 # channels relevant to SMA-X
 pubsub_prefix = "smax"
-# Default to looping the pubsub threads on 10 ms cadence.
+# Default to waiting for pubsub messages on 10 ms cadence.
 pubsub_sleep = 0.010
 
+# Process-wide cache of the SMA-X LUA script SHAs, keyed by (host, port, db), each
+# a dict of SHAs by the script names in the 'scripts' hash on the server.
+_script_cache = {}
+_script_cache_lock = threading.Lock()
+
+# The clients of this process, to be re-initialized in the child after a fork.
+_clients = weakref.WeakSet()
+
 loglevel = logging.WARNING
-logging.basicConfig(level=loglevel)
 logger = logging.getLogger(__name__)
 
+# Name of this program, looked up once per process by _program_name().
+_program = None
+
+
+def _program_name():
+    """
+    Private function returning the name of this program, as reported by
+    psutil.Process().name(), for the origin of the values shared by clients.
+
+    The name is looked up once per process. On Linux it is read from
+    /proc/self/comm, so psutil is only imported for the names that the kernel
+    truncates to 15 characters, or on other platforms.
+    """
+    global _program
+    if _program is None:
+        try:
+            with open("/proc/self/comm") as f:
+                name = f.read().rstrip("\n")
+        except OSError:
+            name = ""
+        if not 0 < len(name) < 15:
+            import psutil
+            name = psutil.Process(os.getpid()).name()
+        _program = name
+    return _program
+
+
+def _script_cache_for(redis_ip, redis_port, redis_db):
+    """
+    Private function returning the dict of script SHAs cached for a server and
+    database, shared by all the clients of this process.
+    """
+    with _script_cache_lock:
+        return _script_cache.setdefault((redis_ip, int(redis_port), int(redis_db)), {})
+
+
+def _check_scripts(names, scripts):
+    """
+    Private function raising SmaxKeyError if one of the named LUA scripts has
+    no SHA in scripts, as read from the 'scripts' hash of the server.
+    """
+    missing = [name for name in names if scripts.get(name) is None]
+    if len(missing) > 0:
+        raise SmaxKeyError(f"LUA scripts {missing} are not loaded in the 'scripts' hash of the Redis server, "
+                           f"is it set up for SMA-X?")
+
+
+def _after_fork_in_child():
+    """
+    Private function called in the child process after a fork. Locks that
+    other threads of the parent may have held are replaced, and each client
+    stops using the connections and threads inherited from the parent.
+    """
+    global _script_cache_lock
+    _script_cache_lock = threading.Lock()
+    for client in list(_clients):
+        try:
+            client._after_fork()
+        except Exception as e:
+            client._logger.error(f"Re-initializing client after fork failed with {e!r}")
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_after_fork_in_child)
+
+
+def _with_deadline(method):
+    """
+    Private decorator running a client method within the deadline given by its
+    timeout keyword argument, or else by the client's default timeout.
+    """
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        self._restore_after_fork()
+        timeout = kwargs.get("timeout")
+        with deadline(self._timeout if timeout is None else timeout):
+            return method(self, *args, **kwargs)
+    return wrapper
+
+
+@dataclass
+class SmaxClientConfig:
+    """
+    The settings of a SmaxRedisClient, without its connections and threads.
+
+    A config is cheap to pickle, so it can be sent to the workers of a process
+    pool, which each call connect() to get a client of their own. Pickling a
+    SmaxRedisClient pickles its config, so clients can also be passed to the
+    workers directly. Subscriptions are not part of the config.
+    """
+    redis_ip: str = "localhost"
+    redis_port: int = 6379
+    redis_db: int = 0
+    program_name: str | None = None
+    hostname: str | None = None
+    debug: bool = False
+    logger: logging.Logger | None = None
+    auto_pipeline: bool = False
+    auto_pipeline_window: float = 0.0
+    shared_pool: bool = True
+    max_connections: int | None = None
+    blocking_pool: bool = False
+    pool_timeout: float = 20
+    replicas: list | None = None
+    replica_retry_interval: float = 5.0
+    timeout: float | None = None
+    fail_fast: bool = False
+    outage_buffer: int = 0
+    outage_buffer_bytes: int | None = None
+    outage_buffer_policy: str = "drop_oldest"
+    callback_workers: int = 0
+    callback_queue_size: int = 1000
+    callback_queue_policy: str = "coalesce"
+    pubsub_polling: bool = False
+    coalesce_notifications: bool = False
+    track_sequences: bool = False
+    on_sequence_gap: object | None = None
+    shared_pubsub: bool = False
+
+    def connect(self):
+        """
+        Returns:
+            SmaxRedisClient: A new client with these settings.
+        """
+        return SmaxRedisClient(**vars(self))
+
+
 class SmaxRedisClient(SmaxClient):
     def __init__(self, redis_ip="localhost", redis_port=6379, redis_db=0,
-                 program_name=None, hostname=None, debug=False, logger=logger):
+                 program_name=None, hostname=None, debug=False, logger=logger,
+                 auto_pipeline=False, auto_pipeline_window=0.0,
+                 shared_pool=True, max_connections=None, blocking_pool=False, pool_timeout=20,
+                 replicas=None, replica_retry_interval=5.0, timeout=None, fail_fast=False,
+                 outage_buffer=0, outage_buffer_bytes=None, outage_buffer_policy="drop_oldest",
+                 callback_workers=0, callback_queue_size=1000, callback_queue_policy="coalesce",
+                 pubsub_polling=False, coalesce_notifications=False,
+                 track_sequences=False, on_sequence_gap=None, shared_pubsub=False):
         """
         Constructor for SmaxRedisClient, automatically establishes connection
         and sets the redis-py connection object to 'self._client'. This magic
@@ -45,9 +201,104 @@ class SmaxRedisClient(SmaxClient):
             redis_db (int): Database index to connect to.
             program_name (str): Optional program name gets appended to hostname.
             hostname (str): Optional hostname, obtained automatically otherwise.
+            auto_pipeline (bool): Coalesce the LUA script calls made concurrently
+                                  from many threads into shared pipeline writes
+                                  (see SmaxAutoPipeline).
+            auto_pipeline_window (float): Seconds the auto-pipeline waits for
+                                          more calls before each write.
+            shared_pool (bool): Share the connection pool with the other clients
+                                of the same server and database in this process.
+            max_connections (int): Maximum number of connections in the pool.
+            blocking_pool (bool): When max_connections are in use, wait for a
+                                  connection to be released instead of raising.
+            pool_timeout (float): Seconds to wait for a connection with
+                                  blocking_pool, before raising.
+            replicas (list): Read replicas of the server, as "host",
+                             "host:port" or (host, port). Pulls are spread over
+                             the replicas in turn, while shares and
+                             subscriptions use the primary server.
+            replica_retry_interval (float): Seconds during which a replica
+                                            that failed a read is not used,
+                                            with reads going to the others
+                                            or to the primary instead.
+            timeout (float): Default time limit in seconds of pulls and
+                             shares, including the retries of failed
+                             commands. Without it, a call may retry for
+                             minutes while Redis is unreachable.
+            fail_fast (bool): When a pull fails or runs out of time, return the
+                              value last pulled for the name by this client, or
+                              smax_unavailable if there is none, instead of
+                              raising SmaxConnectionError.
+            outage_buffer (int): Maximum number of SMA-X names whose shares are
+                                 buffered while Redis is unreachable, instead
+                                 of raising SmaxConnectionError, and replayed
+                                 once it is back (see SmaxOutageBuffer). 0
+                                 disables the buffer.
+            outage_buffer_bytes (int): Maximum total size of the buffered
+                                       shares, or None for no limit.
+            outage_buffer_policy (str): What to do with a new name when the
+                                        buffer is full: "drop_oldest",
+                                        "drop_newest" or "error".
+            callback_workers (int): Number of threads running the pulls and
+                                    callbacks of subscriptions, instead of the
+                                    pub/sub thread (see SmaxCallbackDispatcher).
+                                    The notifications of each name and
+                                    callback are still handled in order. 0
+                                    runs them in the pub/sub thread.
+            callback_queue_size (int): Maximum number of notifications queued
+                                       for the callback workers.
+            callback_queue_policy (str): "coalesce", "drop_oldest",
+                                         "drop_newest" or "block", for
+                                         notifications arriving when the queue
+                                         is full. "block" stalls the pub/sub
+                                         thread, and cannot be used with
+                                         shared_pubsub.
+            pubsub_polling (bool): Poll for the notifications of callback
+                                   subscriptions every pubsub_sleep, rather
+                                   than block on the pub/sub socket until they
+                                   arrive (see SmaxPubSubDispatcher).
+            coalesce_notifications (bool): When callbacks fall behind, collapse
+                                           the pending notifications of each
+                                           name, so that the value is pulled
+                                           once, in its newest state.
+            track_sequences (bool): Track the seq of the values delivered to
+                                    subscribers, to count the updates they
+                                    missed (see SmaxSequenceTracker and
+                                    smax_missed_updates()).
+            on_sequence_gap (func): Function called with the name, the last
+                                    seq seen and the new seq of each value
+                                    delivered after missed updates, with
+                                    track_sequences.
+            shared_pubsub (bool): Share the pub/sub connection and thread of
+                                  the callback subscriptions and streams with
+                                  the other clients of the same server and
+                                  database in this process that also have
+                                  shared_pubsub (see SmaxPubSubHub). Each
+                                  channel is then subscribed, and each
+                                  notification received, once for all of
+                                  them, but a slow callback also delays the
+                                  callbacks of the other clients.
+
+        No network traffic happens until the client is first used.
         """
 
-        # Logging convention for messages to have module names in them.
+        if shared_pubsub and callback_workers and callback_queue_policy == "block":
+            # The pub/sub thread waiting for the queue would also stall the
+            # callbacks of the other clients sharing it.
+            raise ValueError("The 'block' callback_queue_policy cannot be used with shared_pubsub")
+
+        self._config = SmaxClientConfig(redis_ip, redis_port, redis_db, program_name, hostname,
+                                        debug, logger, auto_pipeline, auto_pipeline_window,
+                                        shared_pool, max_connections, blocking_pool, pool_timeout,
+                                        replicas, replica_retry_interval, timeout, fail_fast,
+                                        outage_buffer, outage_buffer_bytes, outage_buffer_policy,
+                                        callback_workers, callback_queue_size, callback_queue_policy,
+                                        pubsub_polling, coalesce_notifications,
+                                        track_sequences, on_sequence_gap, shared_pubsub)
+
+        # Logging convention for messages to have module names in them. This is
+        # configured by the first client, rather than on importing the module.
+        logging.basicConfig(level=loglevel)
         if debug:
             logging.basicConfig(level=logging.DEBUG)
         else:
@@ -62,50 +313,128 @@ class SmaxRedisClient(SmaxClient):
         self._redis_ip = redis_ip
         self._redis_port = redis_port
         self._redis_db = redis_db
-
-        self._getSHA = None
-        self._setSHA = None
-        self._multi_getSHA = None
-        self._multi_setSHA = None
-        self._get_structSHA = None
-
-        self._list_zeroesSHA = None
-        self._list_higher_thanSHA = None
-        self._list_newer_thanSHA = None
-        
-        self._dsm_get_tableSHA = None
-        
-        self._purgeSHA = None
-        self._purge_volatileSHA = None
-        self._del_structSHA = None
-
-        self._pubsub = None
+        self._shared_pool = shared_pool
+        self._pool_released = False
+        self._pool_options = {"max_connections": max_connections,
+                              "blocking": blocking_pool,
+                              "timeout": pool_timeout}
+        self._timeout = timeout
+        self._fail_fast = fail_fast
+        # Values last pulled by name, returned by failed pulls in fail-fast mode.
+        self._last_values = {}
+
+        # SHAs of the SMA-X LUA scripts, by script name. These are loaded from
+        # the server on first use, so that constructing a client is cheap, and
+        # shared with the other clients of the same server in this process.
+        self._scripts = _script_cache_for(redis_ip, redis_port, redis_db)
+
+        # The pubsub objects of the subscriptions without a callback, one per
+        # thread (see _wait_pubsub()), to close them on disconnecting.
+        self._wait_pubsubs = weakref.WeakSet()
+        # Changed with the subscriptions without a callback, which the pubsub
+        # object of each thread is brought up to date with.
+        self._wait_version = 0
+        # The single thread dispatching the notifications of all callback
+        # subscriptions (see SmaxPubSubDispatcher), or the client's view of
+        # the one shared by the clients of the server (see SmaxPubSubHub),
+        # created with the first.
         self._callback_pubsub = None
-        self._pipeline = None
-
-        self._threads = []
+        # The smax_subscribe() arguments of each subscribed (pattern,
+        # callback), to subscribe again after a fork.
+        self._subscriptions = {}
+        # The subscriptions inherited from the parent process, made again on
+        # the first use of the client in the child, or None.
+        self._forked_subscriptions = None
+        # The cached struct of each incremental (pattern, callback) subscription.
+        self._struct_caches = {}
+        # The metrics of each (pattern, callback) subscription with a callback.
+        self._monitors = {}
+        # The deadband of each (pattern, callback) subscription with one.
+        self._deadbands = {}
+        # The grouper of the struct shares of each (pattern, callback)
+        # subscription with group_structs.
+        self._groupers = {}
+
+        # Pipelines buffer commands until execute(), and pubsub objects read
+        # the messages of their connection, so each thread gets its own.
+        # Everything else is backed by the thread-safe redis-py connection pool.
+        self._local = threading.local()
+        # Guards lazy creation of the shared pubsub objects and script reloading.
+        self._lock = threading.RLock()
+        # Held by the thread replaying the outage buffer.
+        self._replay_lock = threading.Lock()
 
         # Obtain _hostname automatically, unless '_hostname' argument is passed.
         self._hostname = socket.gethostname() if hostname is None else hostname
-        
-        program_name = psutil.Process(os.getpid()).name()
-        self._hostname += ':' + program_name
+        self._hostname += ':' + (program_name or _program_name())
 
         # Call parent constructor, which calls smax_connect_to() and sets the
         # returned client as self._client.
         super().__init__(redis_ip, redis_port, redis_db)
 
-        # load the script SHAs from the server
-        self._get_scripts()
+        if auto_pipeline:
+            self._auto_pipeline = SmaxAutoPipeline(self._client, window=auto_pipeline_window,
+                                                   logger=self._logger)
+        else:
+            self._auto_pipeline = None
+
+        if replicas:
+            self._replicas = SmaxReplicaSet(replicas, redis_port, redis_db,
+                                            retry_interval=replica_retry_interval, logger=self._logger)
+        else:
+            self._replicas = None
+
+        if outage_buffer:
+            self._outage_buffer = SmaxOutageBuffer(outage_buffer, max_bytes=outage_buffer_bytes,
+                                                   policy=outage_buffer_policy, logger=self._logger)
+        else:
+            self._outage_buffer = None
+
+        self._callback_workers = self._create_callback_workers()
+
+        if track_sequences:
+            self._sequences = SmaxSequenceTracker(on_gap=on_sequence_gap, logger=self._logger)
+        else:
+            self._sequences = None
+
+        _clients.add(self)
+
+    def _create_callback_workers(self):
+        """
+        Private method creating the worker pool for subscription callbacks, if
+        the client has callback workers.
+        """
+        if not self._config.callback_workers:
+            return None
+        return SmaxCallbackDispatcher(self._config.callback_workers, max_queue=self._config.callback_queue_size,
+                                      policy=self._config.callback_queue_policy, logger=self._logger)
+
+    def __reduce__(self):
+        # Pickled clients reconnect with the same settings when unpickled.
+        return (SmaxClientConfig.connect, (self._config,))
+
+    def smax_config(self):
+        """
+        The settings this client was created with, e.g. to create clients in
+        other processes.
+
+        Returns:
+            SmaxClientConfig: The client settings.
+        """
+        return self._config
 
 
     def smax_connect_to(self, redis_ip, redis_port, redis_db):
         """
-        Uses the redis-py library to establish a connection to redis, then
-        obtains and stores the LUA scripts in the object (ex self._getSHA). This
+        Creates the redis-py client object for the server, on a connection pool
+        shared with the other clients of the same server and database in this
+        process (unless shared_pool=False was given to the constructor). This
         function is called automatically by the SmaxClient parent class, so
         there shouldn't be a need to call this explicitly.
 
+        The connections are only made when they are first needed, and the LUA
+        script SHAs are loaded with the first script call.
+
         Args:
             redis_ip (str): IP address of redis-server.
             redis_port (int): Port of redis-server.
@@ -114,52 +443,292 @@ class SmaxRedisClient(SmaxClient):
         Returns:
             Redis: A Redis client object configured from the given args.
         """
-        retry = Retry(ExponentialBackoff(cap=30, base=0.05), 30)
-        try:
-            # Connect to redis-server, and store LUA scripts on the object.
-            # StrictRedis and Redis are now identical, so let's be explicit
-            redis_client = Redis(host=redis_ip,
-                                       port=redis_port,
-                                       db=redis_db,
-                                       retry=retry,
-                                       retry_on_error=[BusyLoadingError, ConnectionError, TimeoutError, OSError],
-                                       health_check_interval=30)
-            self._logger.info(f"Connected to redis server {redis_ip}:{redis_port} db={redis_db}")
-            return redis_client
-        except (ConnectionError, TimeoutError) as e:
-            self._logger.error(f"Connecting to redis and getting scripts failed with {e}")
-            raise SmaxConnectionError(e.args)
+        if self._shared_pool:
+            pool = get_connection_pool(redis_ip, redis_port, redis_db, **self._pool_options)
+        else:
+            pool = create_connection_pool(redis_ip, redis_port, redis_db, **self._pool_options)
+        self._logger.info(f"Using connection pool for redis server {redis_ip}:{redis_port} db={redis_db}")
+        return Redis(connection_pool=pool)
 
+    def _get_scripts(self, *names):
+        """
+        Get the SHAs of the cached scripts from the 'scripts' hash on the server.
+        All of them are read with a single HGETALL, and kept in a process-wide
+        cache shared by all clients of the same server and database.
+
+        The SHAs are read without holding the lock of the cache, so that the
+        clients of other servers are not held up, and stored under it.
+
+        Args:
+            *names (str): Only refresh the SHAs of these scripts (with a single
+                          HMGET), e.g. after a NoScriptError.
 
-    def _get_scripts(self):
+        Raises:
+            SmaxKeyError: if one of the named scripts is not on the server.
         """
-        Get the SHAs of the cached scripts using the Redis.hget methods
+        if len(names) > 0:
+            self._logger.info(f"Refreshing script SHAs for {names} from server")
+            scripts = dict(zip(names, self._client.hmget('scripts', names)))
+        else:
+            self._logger.info(f"Pulling script SHAs from server")
+            scripts = {name.decode("utf-8"): sha for name, sha in self._client.hgetall('scripts').items()}
+        with _script_cache_lock:
+            self._scripts.update({name: sha for name, sha in scripts.items() if sha is not None})
+        _check_scripts(names, scripts)
+
+    def _script_sha(self, name):
         """
-        self._logger.info(f"Pulling script SHAs from server")
-        
-        self._getSHA = self._client.hget('scripts', 'HGetWithMeta')
-        self._setSHA = self._client.hget('scripts', 'HSetWithMeta')
-        self._multi_getSHA = self._client.hget('scripts', 'HMGetWithMeta')
-        self._multi_setSHA = self._client.hget('scripts', 'HMSetWithMeta')
-        self._get_structSHA = self._client.hget('scripts', 'GetStruct')
-        self._purgeSHA = self._client.hget('scripts', 'Purge')
-        self._purge_volatileSHA = self._client.hget('scripts', 'PurgeVolatile')
-        self._list_newer_thanSHA = self._client.hget('scripts', 'ListNewerThan')
-        self._list_newer_thanSHA = self._client.hget('scripts', 'ListOlderThan')
-        self._list_higher_thanSHA = self._client.hget('scripts', 'ListHigherThan')
-        self._list_zeroesSHA = self._client.hget('scripts', 'ListZeroes')
-        self._dsm_get_tableSHA = self._client.hget('scripts', 'DSMGetTable')
+        Private function returning the SHA of the named LUA script, loading the
+        SHAs from the server if this is the first use.
+
+        Args:
+            name (str): Name of the script in the 'scripts' hash, e.g. HGetWithMeta.
+
+        Returns:
+            bytes: SHA of the script.
+
+        Raises:
+            SmaxKeyError: if the script is not on the server.
+        """
+        sha = self._scripts.get(name)
+        if sha is None:
+            if len(self._scripts) == 0:
+                self._get_scripts()
+                _check_scripts([name], self._scripts)
+            else:
+                self._get_scripts(name)
+            sha = self._scripts[name]
+        return sha
 
     def smax_disconnect(self):
         """
         Python manages a connection pool automatically, if somehow that fails
         release the connection, this disconnect function will do it.
-        """
 
-        if self._client.connection:
-            self._client.connection.disconnect()
+        The connections of a shared pool are closed once the last client using
+        it disconnects.
+        """
+        if self._auto_pipeline is not None:
+            self._auto_pipeline.close()
+            self._auto_pipeline = None
+
+        if self._replicas is not None:
+            self._replicas.disconnect()
+
+        if self._callback_pubsub is not None:
+            self._callback_pubsub.close()
+            self._callback_pubsub = None
+
+        if self._callback_workers is not None:
+            self._callback_workers.close()
+
+        for pubsub in list(self._wait_pubsubs):
+            pubsub.close()
+
+        with self._lock:
+            self._subscriptions = {}
+            self._forked_subscriptions = None
+            self._struct_caches = {}
+            self._monitors = {}
+            self._deadbands = {}
+            self._groupers = {}
+        _clients.discard(self)
+
+        if self._shared_pool:
+            # Only the first disconnect releases the pool, which other clients
+            # may still be using.
+            if not self._pool_released:
+                release_connection_pool(self._client.connection_pool)
+                self._pool_released = True
+        else:
+            self._client.connection_pool.disconnect()
         self._logger.info(f"Disconnected redis server {self._redis_ip}:{self._redis_port} db={self._redis_db}")
 
+    def _after_fork(self):
+        """
+        Private method called in the child process after a fork. The child
+        gets its own locks and pipelines, and stops using the threads and
+        pub/sub connections inherited from the parent, which are left alone.
+        The connection pool creates new connections for the child by itself.
+
+        Only state is reset here: the auto-pipeline and callback threads, and
+        the subscriptions, are made again by _restore_after_fork() on the
+        first use of the client in the child.
+        """
+        self._local = threading.local()
+        self._lock = threading.RLock()
+        self._replay_lock = threading.Lock()
+
+        # The parent replays its own buffered shares.
+        if self._outage_buffer is not None:
+            self._outage_buffer.clear()
+
+        self._wait_pubsubs = weakref.WeakSet()
+        self._callback_pubsub = None
+        self._forked_subscriptions = self._subscriptions
+        self._subscriptions = {}
+        self._struct_caches = {}
+        self._monitors = {}
+        self._deadbands = {}
+        self._groupers = {}
+        self._auto_pipeline = None
+        self._callback_workers = None
+
+    def _restore_after_fork(self):
+        """
+        Private method starting the auto-pipeline and callback threads of the
+        client again in a child process, and making the subscriptions of the
+        parent again, on the first use of the client after a fork.
+        """
+        if self._forked_subscriptions is None:
+            return
+        with self._lock:
+            subscriptions = self._forked_subscriptions
+            if subscriptions is None:
+                return
+            self._forked_subscriptions = None
+            if self._config.auto_pipeline:
+                self._auto_pipeline = SmaxAutoPipeline(self._client, window=self._config.auto_pipeline_window,
+                                                       logger=self._logger)
+            self._callback_workers = self._create_callback_workers()
+            for (pattern, callback), kwargs in subscriptions.items():
+                self.smax_subscribe(pattern, callback, **kwargs)
+        self._logger.debug(f"Re-initialized client in child process {os.getpid()}")
+
+    def _evalsha(self, script, *args):
+        """
+        Private function that calls a LUA script with evalsha(), through the
+        auto-pipeline if it is enabled.
+
+        Args:
+            script (str): Name of the script to call, e.g. HGetWithMeta.
+            *args: number of keys, keys and arguments to the script.
+
+        Returns:
+            return value from the LUA script.
+        """
+        sha = self._script_sha(script)
+        if self._auto_pipeline is not None:
+            return self._auto_pipeline.execute_command('EVALSHA', sha, *args, timeout=deadline_remaining(),
+                                                       send_timeout=deadline_remaining(connect=True))
+        return self._client.evalsha(sha, *args)
+
+    def _evalsha_read(self, replica, script, *args):
+        """
+        Private function that calls a read-only LUA script on a replica, or on
+        the primary server if there is no replica or the call fails on it.
+
+        Args:
+            replica (SmaxReplica): Replica selected for the read, or None.
+            script (str): Name of the script to call, e.g. HGetWithMeta.
+            *args: number of keys, keys and arguments to the script.
+
+        Returns:
+            return value from the LUA script.
+        """
+        if replica is not None and replica.available():
+            try:
+                try:
+                    return replica.evalsha(self._script_sha(script), *args)
+                except NoScriptError:
+                    # The cached SHA may be stale, as on the primary.
+                    self._get_scripts(script)
+                    return replica.evalsha(self._script_sha(script), *args)
+            except (ConnectionError, TimeoutError, ResponseError) as e:
+                if not _is_replica_failure(e):
+                    raise
+                self._replicas.failed(replica, e)
+        return self._evalsha(script, *args)
+
+    def _execute_read(self, replica, *args):
+        """
+        Private function that runs a read-only Redis command on a replica, or
+        on the primary server, through the auto-pipeline if it is enabled, if
+        there is no replica or the command fails on it.
+
+        Args:
+            replica (SmaxReplica): Replica selected for the read, or None.
+            *args: Redis command and its arguments.
+
+        Returns:
+            The reply to the command.
+        """
+        if replica is not None and replica.available():
+            try:
+                reply = replica.client.execute_command(*args)
+                replica.reads += 1
+                return reply
+            except (ConnectionError, TimeoutError, ResponseError) as e:
+                if not _is_replica_failure(e):
+                    raise
+                self._replicas.failed(replica, e)
+        if self._auto_pipeline is not None:
+            return self._auto_pipeline.execute_command(*args, timeout=deadline_remaining(),
+                                                       send_timeout=deadline_remaining(connect=True))
+        return self._client.execute_command(*args)
+
+    def smax_stats(self):
+        """
+        Usage statistics of the optional client features.
+
+        Returns:
+            dict: statistics of the connection pool, and of each enabled
+                  feature, e.g. "auto_pipeline".
+        """
+        stats = {"connection_pool": connection_pool_stats(self._client.connection_pool)}
+        if self._auto_pipeline is not None:
+            stats["auto_pipeline"] = self._auto_pipeline.stats()
+        if self._replicas is not None:
+            stats["replicas"] = self._replicas.stats()
+        if self._outage_buffer is not None:
+            stats["outage_buffer"] = self._outage_buffer.stats()
+        if self._callback_pubsub is not None:
+            stats["pubsub"] = self._callback_pubsub.stats()
+        if self._callback_workers is not None:
+            stats["callbacks"] = self._callback_workers.stats()
+        if self._sequences is not None:
+            stats["sequences"] = self._sequences.stats()
+        if len(self._monitors) > 0:
+            stats["subscriptions"] = [self._subscription_stats(k, monitor) for k, monitor in self._monitors.items()]
+        if len(self._struct_caches) > 0:
+            caches = [cache.stats() for cache in self._struct_caches.values()]
+            stats["incremental"] = {"subscriptions": len(caches)}
+            stats["incremental"].update({k: sum(c[k] for c in caches) for k in caches[0]})
+        return stats
+
+    def _subscription_stats(self, subscription, monitor):
+        """
+        Private method returning the statistics of a (pattern, callback)
+        subscription, with those of its deadband and grouper, if any.
+        """
+        stats = monitor.stats()
+        if subscription in self._deadbands:
+            stats.update(self._deadbands[subscription].stats())
+        if subscription in self._groupers:
+            stats.update(self._groupers[subscription].stats())
+        return stats
+
+    def smax_missed_updates(self):
+        """
+        Updates missed by the subscribers of this client, with
+        track_sequences: those of the names whose values were delivered with
+        a seq more than one above the last one delivered.
+
+        Returns:
+            dict: Number of updates missed of each SMA-X name that missed some.
+        """
+        if self._sequences is None:
+            raise RuntimeError("Missed updates are only tracked with track_sequences=True")
+        return self._sequences.missed_updates()
+
+    def _check_sequences(self, value):
+        """
+        Private method checking the seq of a value delivered to a subscriber,
+        with track_sequences.
+        """
+        if self._sequences is not None:
+            self._sequences.check(value)
+
     def _parse_lua_pull_response(self, lua_data, smaxname, pull_meta=False, raw=False):
         """
         Private method to parse the response from calling the HGetWithMeta LUA
@@ -173,74 +742,29 @@ class SmaxRedisClient(SmaxClient):
         Returns:
             Smax<var>: Populated Smax<var> dataclass object.
         """
-
-        # Extract the type out of the meta data, and map string to real type object.
-        type_name = lua_data[1].decode("utf-8")
-        self._logger.debug(f"_parse_lua_pull_response() got type {type_name}")
-
-        if raw:
-            data_type = SmaxBytes
-        elif type_name in _SMAX_TYPE_MAP:
-            data_type = _SMAX_TYPE_MAP[type_name]
-        else:
-            self._logger.warning(f"I can't deal with data of type {type_name}, defaulting to 'string'")
-            type_name = "string"
-            data_type = SmaxStr
-
-        # Extract data, origin and sequence from meta data.
-        data_date = datetime.fromtimestamp(float(lua_data[3]), timezone.utc)
-        origin = lua_data[4].decode("utf-8")
-        sequence = int(lua_data[5])
-        
-        # Extract dimension information from meta data.
-        data_dim = tuple(int(s) for s in lua_data[2].decode("utf-8").split())
-        # If only one dimension convert to a single value (rather than list)
-        if len(data_dim) == 1:
-            data_dim = data_dim[0]
-
-        # If there is only a single value, cast to the appropriate type and return.
-        if raw:
-            data = data_type(lua_data[0], type=type_name, dim=data_dim, timestamp=data_date, \
-                            origin=origin, seq=sequence, smaxname=smaxname)
-        elif data_dim == 1:
-            if type_name == 'string':
-                strdata = lua_data[0].decode("utf-8")
-                data = data_type(strdata, type=type_name, dim=data_dim, timestamp=data_date, \
-                                origin=origin, seq=sequence, smaxname=smaxname)
-            else:
-                # Use the builtin base type's conversion from string to that type
-                data = data_type(lua_data[0], type=type_name, dim=data_dim, timestamp=data_date, origin=origin, seq=sequence, smaxname=smaxname)
-
-        # This is some kind of array.
-        else:
-            # If this is a list of strings, just clean up string and return.
-            if type_name == 'string':
-                data = lua_data[0].decode("utf-8").split("\r")
-                # Remove the leading and trailing \' in each string in the list.
-                data = [s.strip("\'") for s in data]
-                return SmaxStrArray(data, type=type_name, dim=data_dim, timestamp=data_date, \
-                        origin=origin, seq=sequence, smaxname=smaxname)
-            else:
-                data = lua_data[0].decode("utf-8").split(" ")
-                # Use numpy for all other numerical types
-                data = SmaxArray(data, type=type_name, dim=data_dim, \
-                        timestamp=data_date, origin=origin, seq=sequence, smaxname=smaxname)
+        data = _parse_lua_pull_response(lua_data, smaxname, raw=raw, logger=self._logger)
 
         # Get additional meta data.
         if pull_meta:
-            for meta in optional_metadata:
-                m = None
-                try:
-                    m = self.smax_pull_meta(meta, smaxname)
-                except:
-                    continue
-                if m is not None:
-                    setattr(data, meta, m)
+            self._pull_optional_meta(data, smaxname)
 
-        self._logger.debug(f"_parse_lua_pull: returning {data}, {data.metadata}")
         return data
 
-    def smax_pull(self, table, key, pull_meta=False, raw=False):
+    def _pull_optional_meta(self, data, smaxname):
+        """
+        Private method to attach the optional metadata for smaxname to data.
+        """
+        for meta in optional_metadata:
+            m = None
+            try:
+                m = self.smax_pull_meta(meta, smaxname)
+            except:
+                continue
+            if m is not None:
+                setattr(data, meta, m)
+
+    @_with_deadline
+    def smax_pull(self, table, key, pull_meta=False, raw=False, *, timeout=None):
         """
         Get data which was stored with the smax macro HSetWithMeta along with
         the associated metadata. The return value will an Smax<type> object
@@ -259,124 +783,172 @@ class SmaxRedisClient(SmaxClient):
             key (str): SMAX key name
             pull_meta (bool): Flag whether to pull optional metadata
             raw (bool): Return the unparsed data in a SmaxBytes object
+            timeout (float): Time limit in seconds, including retries, instead
+                             of the client's default.
 
         Returns:
             Smax<type>: Populated Smax<type> dataclass object.
         """
+        try:
+            data = self._pull(table, key, pull_meta=pull_meta, raw=raw)
+        except SmaxConnectionError:
+            if not self._fail_fast:
+                raise
+            return self._last_values.get(join(*normalize_pair(table, key)), smax_unavailable)
+
+        if self._fail_fast:
+            self._last_values[join(*normalize_pair(table, key))] = data
+        return data
+
+    def _pull(self, table, key, pull_meta=False, raw=False):
+        """
+        Private method pulling a value or struct for smax_pull().
+        """
         # Carry out a sanity check on (table, key) pair and normalize
         table, key = normalize_pair(table, key)
-        self._logger.debug(f"Calliing _getSHA with: '1', {table}, {key}")
+        self._logger.debug(f"Calling HGetWithMeta with: '1', {table}, {key}")
+        # The same replica (if any) is used for both calls of a struct pull.
+        replica = self._replicas.select() if self._replicas is not None else None
         try:
-            lua_data = self._client.evalsha(self._getSHA, '1', table, key)
+            lua_data = self._evalsha_read(replica, 'HGetWithMeta', '1', table, key)
         except NoScriptError:
-            self._get_scripts()
-            lua_data = self._client.evalsha(self._getSHA, '1', table, key)
+            self._get_scripts('HGetWithMeta')
+            lua_data = self._evalsha_read(replica, 'HGetWithMeta', '1', table, key)
         except (ConnectionError, TimeoutError) as e:
             self._logger.error(f"Reading {join(table, key)} from Redis {self._client} failed")
             raise SmaxConnectionError(e.args)
     
         self._logger.debug(f"Received response: {lua_data}")
-        
-        if lua_data is not None:
-            self._logger.info(f"Successfully pulled {join(table, key)}")
-        else:
-            self._logger.warning(f"Failed to pull valid data for {join(table, key)} from {self._client}")
-            raise SmaxKeyError(f"Unknown SMA-X error pulling {join(table, key)}")
-
-
-        # Check that we got a valid response
-        if lua_data[0] is None:
-            self._logger.error(f"Could not find {join(table, key)} in Redis")
-            raise SmaxKeyError(f"Could not find {join(table, key)} in Redis {self._client}")
+        _check_lua_pull_response(lua_data, table, key, logger=self._logger)
 
-        # Extract the type out of the meta data, and map string to real type object.
-        type_name = lua_data[1].decode("utf-8")
-        self._logger.debug(f"Type: {type_name}")
         # If the lua response says its a struct we have to now use another LUA
         # script to go back to redis and collect the struct.
-        if type_name == "struct":
-            lua_dim = int(lua_data[2])  # assuming that structs can't be multidimensional arrays
-            lua_date = datetime.fromtimestamp(float(lua_data[3]), timezone.utc)
-            if lua_data[4]:
-                lua_origin = lua_data[4].decode("utf-8")
-            else:
-                lua_origin = ""
-            if lua_data[5]:
-                lua_sequence = int(lua_data[5])
-            else:
-                lua_sequence = -1
+        if _is_struct_response(lua_data):
             try:
-                lua_struct = self._client.evalsha(self._get_structSHA, '1', f"{table}:{key}")
+                lua_struct = self._evalsha_read(replica, 'GetStruct', '1', f"{table}:{key}")
                 self._logger.info(f"Successfully pulled struct {table}:{key}")
             except NoScriptError:
-                self._get_scripts()
-                lua_struct = self._client.evalsha(self._get_structSHA, '1', f"{table}:{key}")
+                self._get_scripts('GetStruct')
+                lua_struct = self._evalsha_read(replica, 'GetStruct', '1', f"{table}:{key}")
                 self._logger.info(f"Successfully pulled struct {table}:{key}")
             except (ConnectionError, TimeoutError) as e:
                 self._logger.error(f"Reading {table}:{key} from Redis failed")
                 raise SmaxConnectionError(e.args)
 
-            # The struct will be parsed into a nested python dictionary.
-            tree = SmaxStruct({}, dim=lua_dim, timestamp=lua_date, origin=lua_origin, seq=lua_sequence, smaxname=f"{table}:{key}")
-            
+            tree = _parse_lua_struct_response(lua_data, lua_struct, table, key, logger=self._logger)
+
             if pull_meta:
-                for meta in optional_metadata:
-                    try:
-                        m = self.smax_pull_meta(meta, smaxname)
-                    except:
-                        continue
-                    if m is not None:
-                        setattr(tree, meta, m)
-            
-            for struct_name_index, struct_name in enumerate(lua_struct[0]):
-                t = tree
-                names = struct_name.decode("utf-8").replace(f"{table}:", "", 1).split(':')
-
-                for table_name_index, table_name in enumerate(names):
-                    offset = struct_name_index + struct_name_index + 1
-                    smaxname = join(struct_name.decode("utf-8"), table_name)
-                            
-                    # Grow a new hierarchical level with a blank dictionary.
-                    t = t.setdefault(table_name, SmaxStruct({}, dim=lua_dim, timestamp=lua_date, \
-                        origin=lua_origin, seq=lua_sequence, smaxname=smaxname))
-
-                    # If this is the last name in the path, add actual data.
-                    if table_name_index == len(names) - 1:
-
-                        # Create offset indices for more readable code.
-                        offset2 = struct_name_index + struct_name_index + 2
-
-                        # Process leaf node like it is a normal smax_pull.
-                        for leaf_index, leaf in enumerate(lua_struct[offset]):
-
-                            # If the leaf says its a struct, ignore it.
-                            lua_type = lua_struct[offset2][1][leaf_index]
-                            if lua_type.decode("utf-8") == "struct":
-                                continue
-
-                            # Extract data and metadata to pass into parser.
-                            lua_data = lua_struct[offset2][0][leaf_index]
-                            lua_dim = lua_struct[offset2][2][leaf_index]
-                            lua_date = lua_struct[offset2][3][leaf_index]
-                            lua_origin = lua_struct[offset2][4][leaf_index]
-                            lua_sequence = lua_struct[offset2][5][leaf_index]
-
-                            # Parser will return an SmaxData object.
-                            self._logger.debug(f"struct_name: {struct_name.decode('utf-8')}")
-                            smaxname = struct_name.decode("utf-8") + ":" + leaf.decode("utf-8")
-                            smax_data_object = self._parse_lua_pull_response(
-                                [lua_data, lua_type, lua_dim, lua_date,
-                                 lua_origin, lua_sequence], smaxname, pull_meta)
-
-                            # Add SmaxData object into the nested dictionary.
-                            t.setdefault(lua_struct[offset][leaf_index].decode("utf-8"),
-                                         smax_data_object)
-            
+                self._pull_optional_meta(tree, f"{table}:{key}")
+                for leaf in _struct_leaves(tree):
+                    self._pull_optional_meta(leaf, leaf.smaxname)
+
             return tree
 
         return self._parse_lua_pull_response(lua_data, f"{table}:{key}", raw=raw)
 
-    def smax_share(self, table, key, value, push_meta=False, maintain_type=False, smax_type=None):
+    @_with_deadline
+    def smax_pull_batch(self, names, raw=False, *, timeout=None):
+        """
+        Pull several SMA-X values with a single round trip to Redis. The
+        HGetWithMeta calls for all the names are sent in one pipeline, followed
+        by a second pipeline of GetStruct calls for any names that turn out to
+        be structs.
+
+        Args:
+            names (list): SMA-X names to pull, either as full "table:key"
+                          strings or as (table, key) pairs.
+            raw (bool): Return the unparsed data in SmaxBytes objects
+            timeout (float): Time limit in seconds, including retries, instead
+                             of the client's default.
+
+        Returns:
+            list: Smax<type> objects or SmaxStructs, in the same order as names.
+        """
+        pairs = [normalize_pair(*n) if isinstance(n, (tuple, list)) else normalize_pair(n) for n in names]
+        if len(pairs) == 0:
+            return []
+
+        try:
+            values = self._pull_batch(pairs, raw=raw)
+        except SmaxConnectionError:
+            if not self._fail_fast:
+                raise
+            return [self._last_values.get(join(*pair), smax_unavailable) for pair in pairs]
+
+        if self._fail_fast:
+            self._last_values.update((join(*pair), value) for pair, value in zip(pairs, values))
+        return values
+
+    def _pull_batch(self, pairs, raw=False):
+        """
+        Private method pulling the (table, key) pairs for smax_pull_batch().
+        """
+        replica = self._replicas.select() if self._replicas is not None else None
+        try:
+            if replica is not None:
+                try:
+                    responses, struct_responses = self._pull_batch_responses(replica.client, pairs,
+                                                                             replica.evalsha_command)
+                    replica.reads += len(pairs)
+                except (ConnectionError, TimeoutError, ResponseError) as e:
+                    if not _is_replica_failure(e):
+                        raise
+                    self._replicas.failed(replica, e)
+                    replica = None
+            if replica is None:
+                responses, struct_responses = self._pull_batch_responses(self._client, pairs)
+        except (ConnectionError, TimeoutError) as e:
+            self._logger.error(f"Reading batch of {len(pairs)} values from Redis {self._client} failed")
+            raise SmaxConnectionError(e.args)
+
+        self._logger.info(f"Successfully pulled batch of {len(pairs)} values")
+        return _parse_lua_batch_responses(pairs, responses, struct_responses, raw=raw, logger=self._logger)
+
+    def _pull_batch_responses(self, client, pairs, command='EVALSHA'):
+        """
+        Private method calling HGetWithMeta for each of the (table, key) pairs
+        in one pipeline, and then GetStruct for the structs among them in a
+        second one.
+
+        Args:
+            client (Redis): Redis client of the server to pull from.
+            pairs (list): (table, key) pairs to pull.
+            command (str): EVALSHA, or EVALSHA_RO for a replica.
+
+        Returns:
+            tuple: The list of HGetWithMeta responses, and a dict of the GetStruct
+                   responses by their index in pairs.
+        """
+        pipeline = client.pipeline(transaction=False)
+        for table, key in pairs:
+            pipeline.execute_command(command, self._script_sha('HGetWithMeta'), '1', table, key)
+        try:
+            responses = pipeline.execute()
+        except NoScriptError:
+            self._get_scripts('HGetWithMeta')
+            for table, key in pairs:
+                pipeline.execute_command(command, self._script_sha('HGetWithMeta'), '1', table, key)
+            responses = pipeline.execute()
+
+        structs = [i for i, lua_data in enumerate(responses)
+                   if lua_data is not None and lua_data[0] is not None and _is_struct_response(lua_data)]
+        if len(structs) == 0:
+            return responses, {}
+
+        for i in structs:
+            pipeline.execute_command(command, self._script_sha('GetStruct'), '1', join(*pairs[i]))
+        try:
+            struct_data = pipeline.execute()
+        except NoScriptError:
+            self._get_scripts('GetStruct')
+            for i in structs:
+                pipeline.execute_command(command, self._script_sha('GetStruct'), '1', join(*pairs[i]))
+            struct_data = pipeline.execute()
+        return responses, dict(zip(structs, struct_data))
+
+    @_with_deadline
+    def smax_share(self, table, key, value, push_meta=False, maintain_type=False, smax_type=None, *,
+                   timeout=None):
         """
         Send data to redis using the smax macro HSetWithMeta to include
         metadata.  The metadata is typeName, dataDimension(s), dataDate,
@@ -394,10 +966,30 @@ class SmaxRedisClient(SmaxClient):
                                   cast to that type if possible when sharing.
             smax_type (str): Force casting to smax_type before sharing. Overrides
                              maintain type.
+            timeout (float): Time limit in seconds, including retries, instead
+                             of the client's default.
+
+        With an outage buffer, a share that fails because Redis is unreachable
+        is buffered instead of raising SmaxConnectionError, and None is
+        returned. The shares made while earlier ones are still buffered are
+        buffered too, after their replay is tried. Optional metadata is not
+        buffered, and maintain_type only applies if the type can be pulled.
 
         Returns:
             return value from redis-py's evalsha() function.
         """
+        if self._outage_buffer is None:
+            return self._share(table, key, value, push_meta=push_meta, maintain_type=maintain_type,
+                               smax_type=smax_type)
+
+        return self._share_or_buffer(lambda: self._share(table, key, value, push_meta=push_meta,
+                                                         maintain_type=maintain_type, smax_type=smax_type),
+                                     {(table, key): value}, smax_type=smax_type)
+
+    def _share(self, table, key, value, push_meta=False, maintain_type=False, smax_type=None):
+        """
+        Private method sharing a value or struct for smax_share().
+        """
         # If this is not a dict, then convert data to smax format and send.
         if not isinstance(value, dict):
             if maintain_type and not smax_type:
@@ -447,22 +1039,38 @@ class SmaxRedisClient(SmaxClient):
         """
 
         try:
-            result = self._client.evalsha(self._setSHA, '1', table,
+            result = self._evalsha('HSetWithMeta', '1', table,
                                           self._hostname, key, data_string,
                                           type_name, size)
             self._logger.info(f"Successfully shared to {table}:{key}")
             return result
         except NoScriptError:
-            self._get_scripts()
-            result = self._client.evalsha(self._setSHA, '1', table,
+            self._get_scripts('HSetWithMeta')
+            result = self._evalsha('HSetWithMeta', '1', table,
                                               self._hostname, key, data_string,
                                               type_name, size)
             self._logger.info(f"Successfully shared to {table}:{key}")
             return result
         except (ConnectionError, TimeoutError) as e:
-            self._logger.error("Redis seems down, unable to call the _setSHA LUA script.")
+            self._logger.error("Redis seems down, unable to call the HSetWithMeta LUA script.")
             raise SmaxConnectionError(e.args)
 
+    def _get_pipeline(self):
+        """
+        Get the pipeline belonging to the calling thread, creating it on first
+        use. A redis-py pipeline buffers commands until execute() is called, so
+        sharing one between threads would interleave their commands.
+
+        Returns:
+            Pipeline: redis-py pipeline object for the current thread.
+        """
+        pipeline = getattr(self._local, "pipeline", None)
+        if pipeline is None:
+            pipeline = self._client.pipeline()
+            self._local.pipeline = pipeline
+            self._logger.debug(f"Created pipeline for thread {threading.current_thread().name}")
+        return pipeline
+
     def _pipeline_evalsha_set(self, table, key, commands):
         """
         In order to execute multiple LUA scripts atomically, it has to use the
@@ -480,39 +1088,220 @@ class SmaxRedisClient(SmaxClient):
         Returns:
             return value from redis-py's pipeline.execute() function.
         """
-        # Append the optional 'T' value to the end of the last entry in the command dict.
-        #
-        # Dict keys are (as of Py 3.7) sorted by the order they are added to the dict,
-        # so this command should be the last one accessed in the for loop below.
-        commands[list(commands.keys())[-1]].append('T')
-
         self._logger.debug(commands)
+        struct_commands = _struct_commands(table, commands)
 
         try:
-            if self._pipeline is None:
-                self._pipeline = self._client.pipeline()
-            for k in commands.keys():
-                t, ke = normalize_pair(table, k)
-                self._logger.debug(f"munged table name {t}\n munged key name {ke}")
-                try:
-                    self._logger.debug(f"evalsha arguments: {t}, {ke}, {commands[k]}")
-                    self._pipeline.evalsha(self._multi_setSHA, '1',
-                                       f"{t}:{ke}",
-                                       self._hostname,
-                                       *commands[k])
-                except NoScriptError:
-                    self._get_scripts()
-                    self._pipeline.evalsha(self._multi_setSHA, '1',
-                                       join(t, ke),
-                                       self._hostname,
-                                       *commands[k])
-            result = self._pipeline.execute()
+            pipeline = self._get_pipeline()
+            try:
+                self._queue_share_commands(pipeline, struct_commands)
+                result = pipeline.execute()
+            except NoScriptError:
+                self._get_scripts('HMSetWithMeta')
+                self._queue_share_commands(pipeline, struct_commands)
+                result = pipeline.execute()
             self._logger.info(f"Successfully executed pipeline share to {table}:{key}:{list(commands.keys())}")
             return result
         except (ConnectionError, TimeoutError) as e:
             self._logger.error("Unable to call HMSetWithMeta LUA script.")
             raise SmaxConnectionError(e.args)
 
+    def _queue_share_commands(self, pipeline, commands):
+        """
+        Private function that adds HSetWithMeta and HMSetWithMeta calls to a
+        pipeline.
+
+        Args:
+            pipeline (Pipeline): redis-py pipeline to add the calls to.
+            commands (list): (script, id, args) tuples from _share_commands()
+                             or _struct_commands().
+        """
+        for script, id, args in commands:
+            self._logger.debug(f"evalsha arguments: {script}, {id}, {args}")
+            pipeline.evalsha(self._script_sha(script), '1', id, self._hostname, *args)
+
+    @_with_deadline
+    def smax_share_batch(self, values, smax_type=None, *, timeout=None):
+        """
+        Share several SMA-X values with a single round trip to Redis. All the
+        HSetWithMeta and HMSetWithMeta calls are sent in one MULTI/EXEC
+        pipeline, so the batch is applied atomically.
+
+        Args:
+            values (dict): SMA-X names, either as full "table:key" strings or as
+                           (table, key) tuples, mapped to the values to share.
+                           Values may be (nested) dicts.
+            smax_type (str): Force casting of the single (non-dict) values to
+                             smax_type before sharing.
+            timeout (float): Time limit in seconds, including retries, instead
+                             of the client's default.
+
+        With an outage buffer, the values are buffered instead of raising
+        SmaxConnectionError if Redis is unreachable, as for smax_share().
+
+        Returns:
+            return value from redis-py's pipeline.execute() function.
+        """
+        if self._outage_buffer is None:
+            return self._share_batch(values, smax_type=smax_type)
+
+        return self._share_or_buffer(lambda: self._share_batch(values, smax_type=smax_type),
+                                     values, smax_type=smax_type)
+
+    def _share_batch(self, values, smax_type=None):
+        """
+        Private method sharing the values for smax_share_batch().
+        """
+        commands = []
+        for name, value in values.items():
+            table, key = normalize_pair(*name) if isinstance(name, tuple) else normalize_pair(name)
+            commands.extend(_share_commands(table, key, value, smax_type=smax_type))
+        if len(commands) == 0:
+            return []
+
+        try:
+            pipeline = self._get_pipeline()
+            try:
+                self._queue_share_commands(pipeline, commands)
+                result = pipeline.execute()
+            except NoScriptError:
+                self._get_scripts('HSetWithMeta', 'HMSetWithMeta')
+                self._queue_share_commands(pipeline, commands)
+                result = pipeline.execute()
+            self._logger.info(f"Successfully shared batch of {len(values)} values")
+            return result
+        except (ConnectionError, TimeoutError) as e:
+            self._logger.error("Unable to share batch of values.")
+            raise SmaxConnectionError(e.args)
+
+    def _share_or_buffer(self, share, values, smax_type=None):
+        """
+        Private method making a share with the outage buffer, for smax_share()
+        and smax_share_batch(). The share is buffered, rather than made, while
+        earlier shares are buffered or being replayed (by another thread), so
+        that it does not overtake them, and if Redis cannot be reached within
+        the buffer's timeout. A share sent to Redis, whose reply did not
+        arrive within the deadline of the call, may have been made, so it
+        raises SmaxConnectionError rather than being buffered and made again.
+
+        Args:
+            share (func): Function making the share, raising
+                          SmaxConnectionError if Redis is unreachable.
+            values (dict): Values shared, by (table, key) or full name, to
+                           buffer instead.
+            smax_type (str): Type to cast the single (non-dict) values to.
+        """
+        if not self._outage_buffer.pending() or self.smax_replay_buffer():
+            try:
+                with deadline(self._outage_buffer.timeout, connect_only=True):
+                    return share()
+            except SmaxConnectionError as e:
+                if _reply_timed_out(e):
+                    raise
+        result = self._buffer_shares(values, smax_type=smax_type)
+        # A replay in another thread may have finished before the share was
+        # buffered, in which case it is replayed here.
+        self.smax_replay_buffer()
+        return result
+
+    def _buffer_shares(self, values, smax_type=None):
+        """
+        Private method adding shares to the outage buffer.
+
+        Args:
+            values (dict): Values to share, by (table, key) or full name.
+            smax_type (str): Type to cast the single (non-dict) values to.
+
+        Raises:
+            SmaxConnectionError: If the buffer is full and its policy is "error".
+        """
+        for name, value in values.items():
+            table, key = normalize_pair(*name) if isinstance(name, tuple) else normalize_pair(name)
+            if not self._outage_buffer.add(join(table, key), _share_commands(table, key, value, smax_type)):
+                raise SmaxConnectionError(f"Redis is down and the outage buffer is full, "
+                                          f"unable to share {join(table, key)}")
+            self._logger.debug(f"Buffered share of {join(table, key)}")
+        return None
+
+    @_with_deadline
+    def smax_replay_buffer(self, force=False, batch_size=500, *, timeout=None):
+        """
+        Replay the shares buffered while Redis was unreachable, oldest first,
+        in MULTI/EXEC pipelines of batch_size names. This is called by the
+        shares themselves while there are buffered shares, at most every
+        second (the buffer's retry_interval), but can be called at any time,
+        e.g. before a producer exits.
+
+        The replayed values get the time of the replay as their SMA-X date.
+        Only one thread replays at a time: the others return False, and the
+        shares they buffer meanwhile are replayed by the thread replaying.
+        Each pipeline gives up reaching Redis after the buffer's timeout, and
+        is then put back in the buffer. A pipeline sent whose reply does not
+        arrive within the deadline of the call may have been made, so it is
+        dropped rather than replayed again.
+
+        Args:
+            force (bool): Try replaying even if the last attempt was less than
+                          retry_interval ago.
+            batch_size (int): Names replayed in each pipeline.
+            timeout (float): Time limit in seconds, including retries, instead
+                             of the client's default.
+
+        Returns:
+            bool: True if the buffer is empty, False if some shares are still
+                  buffered because Redis is still unreachable.
+        """
+        if self._outage_buffer is None:
+            return True
+        while True:
+            if not force and not self._outage_buffer.replay_due():
+                return not self._outage_buffer.pending()
+            if not self._replay_lock.acquire(blocking=False):
+                return False
+            try:
+                replayed = self._replay_buffer(batch_size)
+            finally:
+                self._replay_lock.release()
+            # Shares buffered by other threads after the last batch was taken
+            # are replayed too.
+            if not replayed or len(self._outage_buffer) == 0:
+                return replayed
+
+    def _replay_buffer(self, batch_size):
+        """
+        Private method replaying the outage buffer for smax_replay_buffer(),
+        with the replay lock held.
+
+        Returns:
+            bool: True if the buffer was emptied.
+        """
+        while True:
+            items = self._outage_buffer.take(batch_size)
+            if len(items) == 0:
+                return True
+            commands = [command for name, name_commands in items for command in name_commands]
+            try:
+                with deadline(self._outage_buffer.timeout, connect_only=True):
+                    pipeline = self._get_pipeline()
+                    try:
+                        self._queue_share_commands(pipeline, commands)
+                        pipeline.execute()
+                    except NoScriptError:
+                        self._get_scripts('HSetWithMeta', 'HMSetWithMeta')
+                        self._queue_share_commands(pipeline, commands)
+                        pipeline.execute()
+            except (ConnectionError, TimeoutError) as e:
+                if _reply_timed_out(e):
+                    self._outage_buffer.replay_unknown(items)
+                    self._logger.error(f"No reply to the replay of {len(items)} buffered shares, "
+                                       f"which may or may not have been made: {e!r}")
+                    return False
+                self._outage_buffer.replay_failed(items)
+                self._logger.warning(f"Redis still down, {len(self._outage_buffer)} shares buffered: {e!r}")
+                return False
+            self._outage_buffer.replayed_ok(items)
+            self._logger.info(f"Replayed {len(items)} buffered shares")
+
     def smax_lazy_pull(self, table, key, value):
         raise NotImplementedError("Available in C API, not in python")
 
@@ -523,12 +1312,18 @@ class SmaxRedisClient(SmaxClient):
         """A minimalist error handler required by call_with_retry in smax_subscribe"""
         self._logger.error(f"Redis connection issue {repr(error)}")
 
-    def smax_subscribe(self, pattern, callback=None, pubsub_sleep=pubsub_sleep):
+    def smax_subscribe(self, pattern, callback=None, pubsub_sleep=pubsub_sleep, incremental=False,
+                       lag_threshold=None, lag_policy="coalesce", deadband=None, relative_deadband=None,
+                       group_structs=False):
         """
         Subscribe to a redis field or group of fields. You can type the full
         name of the field you'd like to subscribe too, or use a wildcard "*"
         character as a suffix to specify a pattern. Use a callback for asynchronous
         processing of notifications, or use one of the smax_wait_on functions.
+        The subscriptions without a callback are waited on with the
+        smax_wait_on functions, from any thread. Each thread reads them from a
+        pub/sub connection of its own, subscribed when the thread first waits,
+        so that threads waiting concurrently each get every notification.
         
         Internal to the HSET* and HMSET*, notifications for pub/sub are
         generated with the prefix `smax:`. This needs to be added/removed within
@@ -542,58 +1337,237 @@ class SmaxRedisClient(SmaxClient):
                              The message in your callback will be an SmaData
                              object, or a nested dictionary for a struct.
             pubsub_sleep (float): Sleep time within each loop of the pubsub
-                                  event handling thread
+                                  event handling thread, with pubsub_polling
+            incremental (bool): For a pattern subscription to a struct, keep
+                                the last pulled struct, and on each
+                                notification pull only the leaf or table that
+                                was notified, patching it into the cached
+                                struct (see SmaxStructCache). The callback is
+                                then called with the whole struct and the list
+                                of the paths that changed in it, relative to
+                                the struct, and only if something changed.
+            lag_threshold (float): Lag in seconds, from the SMA-X timestamp of
+                                   a value to its callback, above which the
+                                   lag_policy is applied to the notifications
+                                   queued for the callback workers.
+            lag_policy (str): "drop_oldest", "coalesce" or "block", see
+                              SmaxSubscriptionMonitor. "block" stalls the
+                              pub/sub thread, and cannot be used with
+                              shared_pubsub.
+            deadband (float): Only call the callback with a numeric value,
+                              or array, that differs from the last one it
+                              was called with by more than deadband, in
+                              any element (see SmaxDeadband). With
+                              incremental, only the paths that moved by more
+                              than the deadband are reported as changed.
+            relative_deadband (float): Deadband relative to the magnitude of
+                                       the last value the callback was called
+                                       with, e.g. 0.01 for 1%, added to the
+                                       absolute deadband.
+            group_structs (bool): For a pattern subscription with a callback,
+                                  gather the notifications of the tables of
+                                  each struct share, and pull and call the
+                                  callback once the share is complete,
+                                  rather than for each table (see
+                                  SmaxStructGrouper). With incremental, the
+                                  tables of the share are pulled together,
+                                  with a single call of the callback.
+
+        All the callback subscriptions of the client are served by a single
+        pubsub thread, which calls the callbacks of each notification in turn,
+        or hands them to the worker pool with callback_workers. A pattern can
+        have several callbacks, unsubscribed with smax_unsubscribe(pattern,
+        callback). The number of notifications received, processed, dropped
+        and queued, the lag, the values suppressed by the deadband, and the
+        events of grouped struct shares, of each callback subscription are
+        reported by smax_stats().
         """
-        def parent_callback(message):
-            msg_pattern = message["pattern"]
-            if msg_pattern is not None:
-                path = message["pattern"].decode("utf-8")[:-1]
-            else:
-                path = message["channel"].decode("utf-8")
+        self._restore_after_fork()
 
-            table, key = normalize_pair(path[len(pubsub_prefix)+1:])
-            self._logger.debug(f"Callback notification received:{message}")
+        def pull_and_callback(table, key):
             data = self.smax_pull(table, key)
             self._logger.debug(f"Callback notification received:{type(data)} {data}")
             self._logger.debug(f".data: {data.data}")
             self._logger.debug(f"metadata {data.asdict()}")
+            if getattr(data, "timestamp", None) is not None:
+                monitor.delivered(data.timestamp)
+            self._check_sequences(data)
+            if band is not None and not band.exceeds(data):
+                return
             callback(data)
-            
-        def exception_handler(ex, pubsub, thread):
-            """Silently close threads if connection fails - other code will catch the missing
-            connection"""
-            self._logger.info("Pubsub lost connection")
-            pubsub.connection.retry.call_with_retry(pubsub.ping, self.fail)
-            pubsub.on_connect(pubsub.connection)
-            self._logger.info("Pubsub reconnected")
-
-        if callback is not None and self._callback_pubsub is None:
-            self._callback_pubsub = self._client.pubsub(ignore_subscribe_messages=False)
-            self._logger.debug("Created redis pubsub object for callbacks")
-
-        elif callback is None and self._pubsub is None:
-            self._pubsub = self._client.pubsub(ignore_subscribe_messages=False)
-            self._logger.debug("Created redis pubsub object")
-
-        if pattern.endswith("*"):
-            if callback is None:
-                self._pubsub.psubscribe(f"{pubsub_prefix}:{pattern}")
-                self._logger.info(f"Subscribed to {pattern}")
+
+        def update_and_callback(table, key):
+            # Called one at a time, even from several callback workers, as
+            # the struct is updated in place.
+            with cache.lock:
+                if grouper is not None:
+                    # The tables of the shares delivered since the last update.
+                    with pending_lock:
+                        names = list(pending)
+                        pending.clear()
+                    update = cache.update_many(names)
+                else:
+                    update = cache.update(join(table, key))
+                if update is not None:
+                    tree, changed = update
+                    # The lag is that of the newest value delivered.
+                    timestamps = [leaf.timestamp for path in changed for leaf in _leaves(cache.node(path))
+                                  if getattr(leaf, "timestamp", None) is not None]
+                    if len(timestamps) > 0:
+                        monitor.delivered(max(timestamps))
+                    for path in changed:
+                        self._check_sequences(cache.node(path))
+                    if band is not None:
+                        changed = [path for path in changed if band.exceeds(cache.node(path))]
+                    if len(changed) > 0:
+                        callback(tree, changed)
+
+        def handle(function, table, key, serial):
+            if not monitor.start((table, key), serial):
+                return
+            try:
+                function(table, key)
+            finally:
+                monitor.done((table, key))
+
+        def parent_callback(message):
+            self._logger.debug(f"Callback notification received:{message}")
+            if grouper is not None:
+                grouper.notify(channel_name(message["channel"], pubsub_prefix), message["data"])
+                return
+            # The names of the channels are decoded once, in channel_pair().
+            if message["pattern"] is not None and not incremental:
+                table, key = pattern_pair
             else:
-                self._callback_pubsub.psubscribe(**{f"{pubsub_prefix}:{pattern}": parent_callback})
-                self._callback_pubsub.run_in_thread(sleep_time=pubsub_sleep, daemon=True, exception_handler=exception_handler)
-                self._logger.info(f"Subscribed to {pattern} with a callback")
-        else:
+                table, key = channel_pair(message["channel"], pubsub_prefix)
+            dispatch(table, key)
+
+        def deliver_group(names):
+            if self._monitors.get((pattern, callback)) is not monitor:
+                # Unsubscribed since.
+                return
+            if incremental:
+                with pending_lock:
+                    pending.update(dict.fromkeys(names))
+            dispatch(*pattern_pair)
+
+        def dispatch(table, key):
+            serial = monitor.admit((table, key))
+            if serial is None:
+                return
+            function = update_and_callback if incremental else pull_and_callback
+            if self._callback_workers is not None:
+                if not self._callback_workers.submit((callback, table, key), handle, function, table, key, serial,
+                                                     discard=functools.partial(monitor.discard, (table, key))):
+                    monitor.discard((table, key))
+            else:
+                handle(function, table, key, serial)
+
+        if lag_threshold is not None and (callback is None or self._callback_workers is None):
+            raise ValueError("A lag_threshold needs a callback, and callback_workers to queue its notifications")
+        if lag_threshold is not None and lag_policy == "block" and self._config.shared_pubsub:
+            raise ValueError("The 'block' lag_policy cannot be used with shared_pubsub, as it would stall the "
+                             "pub/sub thread of the other clients")
+        band = None
+        if deadband is not None or relative_deadband is not None:
             if callback is None:
-                self._pubsub.subscribe(f"{pubsub_prefix}:{pattern}")
-                self._logger.info(f"Subscribed to {pattern}")
+                raise ValueError("A deadband needs a callback")
+            band = SmaxDeadband(deadband, relative_deadband, logger=self._logger)
+        if group_structs and (callback is None or not pattern.endswith("*")):
+            raise ValueError(f"Grouping struct shares needs a callback, and a pattern ending with '*', "
+                             f"not {pattern!r}")
+        grouper = None
+        pending = {}
+        pending_lock = threading.Lock()
+        if callback is not None:
+            monitor = SmaxSubscriptionMonitor(pattern, lag_threshold=lag_threshold, policy=lag_policy,
+                                              logger=self._logger)
+
+        # A pattern subscription pulls the parent struct of the pattern.
+        pattern_pair = tuple(normalize_pair(pattern[:-1])) if pattern.endswith("*") else None
+        if incremental:
+            cache = self._struct_cache(pattern, callback)
+
+        with self._lock:
+            self._subscriptions[(pattern, callback)] = dict(pubsub_sleep=pubsub_sleep, incremental=incremental,
+                                                            lag_threshold=lag_threshold, lag_policy=lag_policy,
+                                                            deadband=deadband, relative_deadband=relative_deadband,
+                                                            group_structs=group_structs)
+
+            if callback is not None:
+                self._monitors[(pattern, callback)] = monitor
+                if band is not None:
+                    self._deadbands[(pattern, callback)] = band
+                else:
+                    self._deadbands.pop((pattern, callback), None)
+                callback_pubsub = self._get_callback_pubsub(pubsub_sleep)
+                if group_structs:
+                    grouper = SmaxStructGrouper(deliver_group, callback_pubsub.call_later, logger=self._logger)
+                    self._groupers[(pattern, callback)] = grouper
+                else:
+                    self._groupers.pop((pattern, callback), None)
+
             else:
-                self._callback_pubsub.subscribe(**{f"{pubsub_prefix}:{pattern}": parent_callback})
-                self._callback_pubsub.run_in_thread(sleep_time=pubsub_sleep, daemon=True, exception_handler=exception_handler)
-                self._logger.info(f"Subscribed to {pattern} with a callback")
-                
+                self._wait_version += 1
+                self._wait_pubsub(create=True)
+                self._logger.info(f"Subscribed to {pattern}")
+                return
+
+        # Outside the lock, which the callbacks running in the pubsub thread
+        # may need while this waits for that thread to subscribe.
+        callback_pubsub.subscribe(f"{pubsub_prefix}:{pattern}", callback, parent_callback,
+                                  pattern=pattern.endswith("*"), sleep_time=pubsub_sleep)
+        self._logger.info(f"Subscribed to {pattern} with a callback")
 
-    def smax_unsubscribe(self, pattern=None):
+    def _struct_cache(self, pattern, callback=None):
+        """
+        Private method returning the cached struct of an incremental
+        subscription, creating it on first use.
+        """
+        root = pattern[:-1].rstrip(":")
+        if not pattern.endswith("*") or root == "" or any(c in root for c in "*?["):
+            raise ValueError(f"Incremental subscriptions need a struct name followed by '*', not {pattern!r}")
+        with self._lock:
+            cache = self._struct_caches.get((pattern, callback))
+            if cache is None:
+                cache = self._struct_caches[(pattern, callback)] = SmaxStructCache(self, root, logger=self._logger)
+            return cache
+
+    @_with_deadline
+    def _table_fields(self, name, *, timeout=None):
+        """
+        Private method returning the names of the fields of an SMA-X table,
+        read like the pulls: from a replica if there are any, through the
+        auto-pipeline if it is enabled, and within the client's deadline.
+        """
+        replica = self._replicas.select() if self._replicas is not None else None
+        try:
+            return [f.decode("utf-8") for f in self._execute_read(replica, 'HKEYS', name)]
+        except (ConnectionError, TimeoutError) as e:
+            raise SmaxConnectionError(f"Unable to list the fields of {name}") from e
+
+    def _get_callback_pubsub(self, sleep_time=pubsub_sleep):
+        """
+        Private method returning the pubsub dispatcher of the callback
+        subscriptions and streams, creating it on first use.
+        """
+        self._restore_after_fork()
+        with self._lock:
+            if self._callback_pubsub is None and self._config.shared_pubsub:
+                self._callback_pubsub = SmaxPubSubHub(self._redis_ip, self._redis_port, self._redis_db,
+                                                      sleep_time=sleep_time, polling=self._config.pubsub_polling,
+                                                      coalesce=self._config.coalesce_notifications,
+                                                      logger=self._logger)
+                self._logger.debug("Joined shared pubsub dispatcher for callbacks")
+            elif self._callback_pubsub is None:
+                self._callback_pubsub = SmaxPubSubDispatcher(self._client, sleep_time=sleep_time,
+                                                             polling=self._config.pubsub_polling,
+                                                             coalesce=self._config.coalesce_notifications,
+                                                             logger=self._logger)
+                self._logger.debug("Created pubsub dispatcher for callbacks")
+            return self._callback_pubsub
+
+    def smax_unsubscribe(self, pattern=None, callback=None):
         """
         Unsubscribe from all subscribed channels, or pass a pattern argument
         to unsubscribe from specific channels.
@@ -601,20 +1575,108 @@ class SmaxRedisClient(SmaxClient):
             pattern (str): Either full name of smax field, or use a wildcard '*'
                            at the end of the pattern to be notified for anything
                            underneath.
+            callback (func): Unsubscribe this callback from pattern (or from
+                             all patterns if None), rather than the
+                             subscriptions without a callback.
         """
-        if self._pubsub is not None:
+        self._restore_after_fork()
+        if callback is not None:
+            with self._lock:
+                for k in [k for k in self._subscriptions if k[1] is callback and pattern in (None, k[0])]:
+                    del self._subscriptions[k]
+                    self._struct_caches.pop(k, None)
+                    self._monitors.pop(k, None)
+                    self._deadbands.pop(k, None)
+                    self._groupers.pop(k, None)
+                callback_pubsub = self._callback_pubsub
+            if callback_pubsub is not None:
+                callback_pubsub.unsubscribe(None if pattern is None else f"{pubsub_prefix}:{pattern}", callback)
+            self._logger.info(f"Unsubscribed {callback} from {pattern or 'all tables'}")
+            return
+
+        # The pubsub objects of the other threads unsubscribe on their next
+        # wait.
+        with self._lock:
             if pattern is None:
-                self._pubsub.punsubscribe()
-                self._pubsub.unsubscribe()
+                self._subscriptions = {k: v for k, v in self._subscriptions.items() if k[1] is not None}
+                self._struct_caches = {k: v for k, v in self._struct_caches.items() if k[1] is not None}
                 self._logger.info("Unsubscribed from all tables")
-            elif pattern.endswith("*"):
-                self._pubsub.punsubscribe(f"{pubsub_prefix}:{pattern}")
-                self._logger.info(f"Unsubscribed from {pattern}")
             else:
-                self._pubsub.unsubscribe(f"{pubsub_prefix}:{pattern}")
+                self._subscriptions.pop((pattern, None), None)
+                self._struct_caches.pop((pattern, None), None)
                 self._logger.info(f"Unsubscribed from {pattern}")
+            self._wait_version += 1
+            self._wait_pubsub()
+
+    def _wait_pubsub(self, create=False):
+        """
+        Private method returning the pubsub object of the calling thread, read
+        by its smax_wait_on functions, subscribed to the subscriptions without
+        a callback of the client. A redis-py pubsub object reads the messages
+        of its connection in whichever thread asks for them, so threads
+        waiting concurrently each get their own, rather than take each
+        other's messages. The subscriptions are shared by all the threads:
+        the pubsub object of a thread is created, and subscribed to those
+        made, or unsubscribed from those removed, by other threads, when it
+        next waits.
+
+        Args:
+            create (bool): Create the pubsub object even if the client has no
+                           subscriptions without a callback.
+
+        Returns:
+            PubSub: The thread's pubsub object, or None if it has none.
+        """
+        self._restore_after_fork()
+        pubsub = getattr(self._local, "pubsub", None)
+        if pubsub is not None and self._local.wait_version == self._wait_version:
+            return pubsub
+        with self._lock:
+            if pubsub is None:
+                if not create and not self._has_wait_subscriptions():
+                    return None
+                pubsub = self._client.pubsub(ignore_subscribe_messages=False)
+                self._local.pubsub = pubsub
+                self._local.wait_patterns = set()
+                self._wait_pubsubs.add(pubsub)
+                self._logger.debug(f"Created redis pubsub object for thread {threading.current_thread().name}")
+
+            patterns = {pattern for pattern, callback in self._subscriptions if callback is None}
+            for pattern in self._local.wait_patterns - patterns:
+                if pattern.endswith("*"):
+                    pubsub.punsubscribe(f"{pubsub_prefix}:{pattern}")
+                else:
+                    pubsub.unsubscribe(f"{pubsub_prefix}:{pattern}")
+            for pattern in patterns - self._local.wait_patterns:
+                if pattern.endswith("*"):
+                    pubsub.psubscribe(f"{pubsub_prefix}:{pattern}")
+                else:
+                    pubsub.subscribe(f"{pubsub_prefix}:{pattern}")
+            self._local.wait_patterns = patterns
+            self._local.wait_version = self._wait_version
+        return pubsub
 
-    def _redis_listen(self, pattern=None, timeout=None, notification_only=False):
+    def _has_wait_subscriptions(self):
+        """
+        Private method checking whether the client has subscriptions without a
+        callback, made by any thread, for the smax_wait_on functions.
+        """
+        return any(callback is None for _, callback in self._subscriptions)
+
+    def _subscribed_pubsub(self):
+        """
+        Private method returning the pubsub object of the calling thread, for
+        the smax_wait_on functions.
+
+        Raises:
+            RuntimeError: if the client has no subscriptions without a callback.
+        """
+        pubsub = self._wait_pubsub()
+        if pubsub is None or len(self._local.wait_patterns) == 0:
+            raise RuntimeError("No subscriptions to wait on, call smax_subscribe() without a callback first")
+        return pubsub
+
+    def _redis_listen(self, pattern=None, timeout=None, notification_only=False, incremental=False):
         """
         Private function to help implement the "wait" functions in this API.
         In the redis-py library, the listen() function is a blocking call, so
@@ -628,61 +1690,78 @@ class SmaxRedisClient(SmaxClient):
             pattern (str): SMAX table/key pattern to listen on.
             timeout (float): Value in seconds to wait before raising timeout exception.
             notification_only (bool): If True, only returns the notification from redis.
+            incremental (bool): Patch the notified part of the struct into the
+                                cached struct of pattern, and return both.
 
         Returns:
-            Either a (list) notification, or the actual pulled data.
+            Either a (list) notification, or the actual pulled data, or the
+            (struct, changed paths) with incremental.
         """
 
         # Throw away any blank messages or of type 'subscribe'
         found_real_message = False
         message = None
-        channel = None
+        name = None
+        matches = None if pattern is None else compile_patterns(pattern).matches
 
+        pubsub = self._subscribed_pubsub()
+        # Messages that do not match do not restart the timeout.
+        wait_end = None if timeout is None else time.monotonic() + timeout
         while not found_real_message:
             if timeout is None:
                 self._logger.debug(f"Waiting for message matching {pattern} with .listen()")
-                for message in self._pubsub.listen():
+                for message in pubsub.listen():
                     break
             else:
-                self._logger.debug(f"Waiting for message matching {pattern} with .get_message() with timeout {timeout}")
-                message = self._pubsub.get_message(timeout=timeout)
+                remaining = max(wait_end - time.monotonic(), 0)
+                self._logger.debug(f"Waiting for message matching {pattern} with .get_message() with timeout {remaining}")
+                message = pubsub.get_message(timeout=remaining)
                 
             self._logger.debug(f"Redis message received:{message}")
             if message is None:
                 raise TimeoutError("Timed out waiting for redis message.")
             elif message["type"] == "message" or message["type"] == "pmessage":
-                channel = message["channel"].decode("utf-8")
-                if channel.startswith(f"{pubsub_prefix}:"):
+                name = channel_name(message["channel"], pubsub_prefix)
+                if name is not None:
                     if pattern is None:
                         found_real_message = True
-                    elif fnmatch(channel[len(pubsub_prefix)+1:], pattern):
+                    elif matches(name):
                         found_real_message = True
 
+                    if found_real_message and incremental and not notification_only:
+                        # Wait on, if the notification changed nothing in the struct.
+                        cache = self._struct_cache(pattern)
+                        update = cache.update(name)
+                        found_real_message = update is not None
+                        if found_real_message:
+                            for path in update[1]:
+                                self._check_sequences(cache.node(path))
+
         if notification_only:
             # Strip the "smax:" prefix off of the channel.
-            channel = message["channel"].decode("utf-8")
-            if channel.startswith(pubsub_prefix):
-                message["channel"] = channel[len(pubsub_prefix)+1:]
-            else:
-                message["channel"] = channel
+            message["channel"] = name
 
             # Decode the other fields.
             message["data"] = message["data"].decode("utf-8")
             self._logger.debug(f"Got notification: message = {message}")
             return message
+        elif incremental:
+            return update
         else:
             if pattern is None:
                 # Pull the exact table that sent the notification.
-                table, key = normalize_pair(channel[len(pubsub_prefix)+1:])
+                table, key = channel_pair(message["channel"], pubsub_prefix)
             else:
                 # Pull the parent struct or "pattern" that was subscribed to.
                 # (pattern is not prefixed with `smax:`)
                 table, key = normalize_pair(pattern)
                 key = key.strip('*')
             self._logger.debug(f"Got table = {table}, key = {key}")
-            return self.smax_pull(table, key)
+            data = self.smax_pull(table, key)
+            self._check_sequences(data)
+            return data
 
-    def smax_wait_on_subscribed(self, pattern, timeout=None, notification_only=False):
+    def smax_wait_on_subscribed(self, pattern, timeout=None, notification_only=False, incremental=False):
         """
         If you use smax_subscribe without a callback, you can use this function
         to specify with channel to listen to, and block until a message is received.
@@ -690,12 +1769,16 @@ class SmaxRedisClient(SmaxClient):
             pattern (str): SMAX table/key pattern to listen on.
             timeout (int): Value in seconds to wait before raising timeout exception.
             notification_only (bool): If True, only returns the notification from redis.
+            incremental (bool): For a struct pattern, keep the last pulled
+                                struct and pull only the notified part of it,
+                                as with smax_subscribe(incremental=True).
 
         Returns:
-            Either a (list) notification, or the actual pulled data.
+            Either a (list) notification, or the actual pulled data, or the
+            (struct, changed paths) with incremental.
         """
         return self._redis_listen(pattern=pattern, timeout=timeout,
-                                  notification_only=notification_only)
+                                  notification_only=notification_only, incremental=incremental)
 
     def smax_wait_on_any_subscribed(self, timeout=None, notification_only=False):
         """
@@ -711,6 +1794,108 @@ class SmaxRedisClient(SmaxClient):
         return self._redis_listen(timeout=timeout,
                                   notification_only=notification_only)
 
+    def smax_stream(self, patterns, pull=True, batch=1, timeout=None, max_backlog=10000,
+                    backlog_policy="drop_oldest"):
+        """
+        Iterate over the updates of the SMA-X names matching patterns, as an
+        alternative to smax_subscribe and the smax_wait_on functions. See
+        SmaxStream.
+
+            with smax_client.smax_stream("weather:*", batch=50) as stream:
+                for name, value in stream:
+                    ...
+
+        Args:
+            patterns (str or list): SMA-X names, or patterns with a '*' suffix.
+            pull (bool): Yield the pulled values rather than the notifications.
+            batch (int): Maximum number of pending notifications whose values
+                         are pulled in one round trip.
+            timeout (float): End the iteration when no notification arrives
+                             for timeout seconds, or None to wait forever.
+            max_backlog (int): Maximum number of notifications queued for the
+                               stream.
+            backlog_policy (str): "drop_oldest" or "drop_newest", the queued
+                                  or the new notification to drop when the
+                                  backlog is full.
+
+        Returns:
+            SmaxStream: Iterator, and async iterator, of (name, value) pairs.
+        """
+        # Imported here, as it is only needed for streams.
+        from .smax_stream import SmaxStream
+        return SmaxStream(self, patterns, pubsub_prefix, pull=pull, batch=batch, timeout=timeout,
+                          max_backlog=max_backlog, policy=backlog_policy, logger=self._logger)
+
+    def smax_wait_on_many(self, max_items=100, window=0.05, timeout=None, pattern=None,
+                          notification_only=False):
+        """
+        If you use smax_subscribe without a callback, you can use this function
+        to collect the updates of a burst at once. It blocks until a
+        notification is received, then collects the notifications received up
+        to window seconds after it, or until max_items different SMA-X names
+        were notified, and pulls all the notified names with a single
+        smax_pull_batch() round trip.
+
+        As with the other smax_wait_on functions, the notifications of names
+        that do not match pattern are read and discarded.
+
+        Args:
+            max_items (int): Maximum number of names to collect.
+            window (float): Seconds to collect notifications after the first.
+            timeout (float): Value in seconds to wait for the first matching
+                             notification before raising timeout exception.
+            pattern (str or list): Only collect the notifications of names
+                                   matching this SMA-X pattern, or any of
+                                   these patterns.
+            notification_only (bool): If True, return the notifications rather
+                                      than pull the values.
+
+        Returns:
+            dict: Pulled values, or the latest notification, of each notified
+                  SMA-X name, by name, in the order they were first notified.
+        """
+        notifications = {}
+        window_end = None
+        if pattern is not None:
+            matches = compile_patterns(pattern if isinstance(pattern, str) else tuple(pattern)).matches
+        pubsub = self._subscribed_pubsub()
+        wait_end = None if timeout is None else time.monotonic() + timeout
+        while len(notifications) < max_items:
+            if window_end is None:
+                if timeout is None:
+                    message = next(pubsub.listen())
+                else:
+                    message = pubsub.get_message(timeout=max(wait_end - time.monotonic(), 0))
+                    if message is None:
+                        raise TimeoutError("Timed out waiting for redis message.")
+            else:
+                remaining = window_end - time.monotonic()
+                if remaining <= 0:
+                    break
+                message = pubsub.get_message(timeout=remaining)
+                if message is None:
+                    break
+
+            if message["type"] not in ("message", "pmessage"):
+                continue
+            name = channel_name(message["channel"], pubsub_prefix)
+            if name is None or (pattern is not None and not matches(name)):
+                continue
+
+            if window_end is None:
+                window_end = time.monotonic() + window
+            message["channel"] = name
+            message["data"] = message["data"].decode("utf-8")
+            notifications[name] = message
+
+        self._logger.debug(f"Collected notifications of {len(notifications)} names")
+        if notification_only:
+            return notifications
+        values = self.smax_pull_batch(list(notifications))
+        for value in values:
+            self._check_sequences(value)
+        return dict(zip(notifications, values))
+
     def smax_purge(self, table, key=None):
         """Purges a table or key from Redis.  Use with ultimate caution.
 
@@ -731,13 +1916,13 @@ class SmaxRedisClient(SmaxClient):
             
         self._logger.warning(f"Purging all keys matching {pattern}")
             
-        return self._client.evalsha(self._purgeSHA, '0', pattern)
+        return self._evalsha('Purge', '0', pattern)
     
     def smax_purge_volatile(self):
         """Purges all volatile tables and keys from Redis.  Use with ultimate caution.
         """
         self._logger.warning(f"Purging all volatile keys")
-        self._client.evalsha(self._purge_volatileSHA, '0')
+        self._evalsha('PurgeVolatile', '0')
         
     def smax_dsm_get_table(self, target, key, host=None):
         """Get the SMA-X name that maps to a DSM target, key, and (optionally) host.
@@ -752,7 +1937,7 @@ class SmaxRedisClient(SmaxClient):
         """
         if host is None:
             host = target
-        return self._client.evalsha(self._dsm_get_tableSHA, host, target, key)
+        return self._evalsha('DSMGetTable', host, target, key)
     
     def smax_list_newer_than(self, dt):
         """List all SMA-X keys newer than the datetime object.
@@ -769,7 +1954,7 @@ class SmaxRedisClient(SmaxClient):
             
         timestamp = dt.timestamp()
         
-        keypairs = self._client.evalsha(self._list_newer_thanSHA, timestamp)
+        keypairs = self._evalsha('ListNewerThan', timestamp)
     
         result  = []
         for kp in keypairs:
@@ -793,7 +1978,7 @@ class SmaxRedisClient(SmaxClient):
             
         timestamp = dt.timestamp()
         
-        keypairs = self._client.evalsha(self._list_older_thanSHA, timestamp)
+        keypairs = self._evalsha('ListOlderThan', timestamp)
     
         result  = []
         for kp in keypairs:
@@ -812,7 +1997,7 @@ class SmaxRedisClient(SmaxClient):
         Returns:
             list[(str, smax.SmaxData)]: list of pairs of SMA-X fields and values higher than value
         """
-        fields = self._client.evalsha(self._list_higher_thanSHA, table, value)
+        fields = self._evalsha('ListHigherThan', table, value)
     
         result  = []
         for f in fields:
@@ -829,7 +2014,7 @@ class SmaxRedisClient(SmaxClient):
         
         Returns:
             list(str): list of all fields equal to zero."""
-        return self._client.evalsha(self._list_zeroesSHA, key)
+        return self._evalsha('ListZeroes', key)
 
     def smax_set_description(self, table, description):
         """
@@ -902,6 +2087,197 @@ class SmaxRedisClient(SmaxClient):
             self._logger.error("Redis seems down, unable to call hget.")
             raise SmaxConnectionError(e.args)
 
+def _check_lua_pull_response(lua_data, table, key, logger=logger):
+    """
+    Private function that raises SmaxKeyError if the response from the
+    HGetWithMeta LUA script does not hold a value for table:key.
+    """
+    if lua_data is None:
+        logger.warning(f"Failed to pull valid data for {join(table, key)}")
+        raise SmaxKeyError(f"Unknown SMA-X error pulling {join(table, key)}")
+
+    if lua_data[0] is None:
+        logger.error(f"Could not find {join(table, key)} in Redis")
+        raise SmaxKeyError(f"Could not find {join(table, key)} in Redis")
+
+    logger.info(f"Successfully pulled {join(table, key)}")
+
+
+def _is_struct_response(lua_data):
+    """Private function, True if an HGetWithMeta response refers to a struct."""
+    return lua_data[1].decode("utf-8") == "struct"
+
+
+def _parse_lua_pull_response(lua_data, smaxname, raw=False, logger=logger):
+    """
+    Private function to parse the response from calling the HGetWithMeta LUA
+    script.
+    Args:
+        lua_data (list): value, vtype, dim, timestamp, origin, serial
+        smaxname (str): Full name of the SMAX table and key
+        raw (bool): Return the byte string from Redis as an SmaxBytes object.
+        logger (Logger): Logger of the calling client.
+
+    Returns:
+        Smax<var>: Populated Smax<var> dataclass object.
+    """
+
+    # Extract the type out of the meta data, and map string to real type object.
+    type_name = lua_data[1].decode("utf-8")
+    logger.debug(f"_parse_lua_pull_response() got type {type_name}")
+
+    if raw:
+        data_type = SmaxBytes
+    elif type_name in _SMAX_TYPE_MAP:
+        data_type = _SMAX_TYPE_MAP[type_name]
+    else:
+        logger.warning(f"I can't deal with data of type {type_name}, defaulting to 'string'")
+        type_name = "string"
+        data_type = SmaxStr
+
+    # Extract data, origin and sequence from meta data.
+    data_date = datetime.fromtimestamp(float(lua_data[3]), timezone.utc)
+    origin = lua_data[4].decode("utf-8")
+    sequence = int(lua_data[5])
+    
+    # Extract dimension information from meta data.
+    data_dim = tuple(int(s) for s in lua_data[2].decode("utf-8").split())
+    # If only one dimension convert to a single value (rather than list)
+    if len(data_dim) == 1:
+        data_dim = data_dim[0]
+
+    # If there is only a single value, cast to the appropriate type and return.
+    if raw:
+        data = data_type(lua_data[0], type=type_name, dim=data_dim, timestamp=data_date, \
+                        origin=origin, seq=sequence, smaxname=smaxname)
+    elif data_dim == 1:
+        if type_name == 'string':
+            strdata = lua_data[0].decode("utf-8")
+            data = data_type(strdata, type=type_name, dim=data_dim, timestamp=data_date, \
+                            origin=origin, seq=sequence, smaxname=smaxname)
+        else:
+            # Use the builtin base type's conversion from string to that type
+            data = data_type(lua_data[0], type=type_name, dim=data_dim, timestamp=data_date, origin=origin, seq=sequence, smaxname=smaxname)
+
+    # This is some kind of array.
+    else:
+        # If this is a list of strings, just clean up string and return.
+        if type_name == 'string':
+            data = lua_data[0].decode("utf-8").split("\r")
+            # Remove the leading and trailing \' in each string in the list.
+            data = [s.strip("\'") for s in data]
+            data = SmaxStrArray(data, type=type_name, dim=data_dim, timestamp=data_date, \
+                    origin=origin, seq=sequence, smaxname=smaxname)
+        else:
+            data = lua_data[0].decode("utf-8").split(" ")
+            # Use numpy for all other numerical types
+            data = SmaxArray(data, type=type_name, dim=data_dim, \
+                    timestamp=data_date, origin=origin, seq=sequence, smaxname=smaxname)
+
+    logger.debug(f"_parse_lua_pull: returning {data}, {data.metadata}")
+    return data
+
+
+def _parse_lua_struct_response(lua_data, lua_struct, table, key, logger=logger):
+    """
+    Private function to parse the response from the GetStruct LUA script into
+    a nested SmaxStruct.
+    Args:
+        lua_data (list): HGetWithMeta response for the struct itself.
+        lua_struct (list): GetStruct response for table:key.
+        table (str): SMAX table name
+        key (str): SMAX key name
+        logger (Logger): Logger of the calling client.
+
+    Returns:
+        SmaxStruct: nested dictionary with a Smax<type> object at each leaf.
+    """
+    lua_dim = int(lua_data[2])  # assuming that structs can't be multidimensional arrays
+    lua_date = datetime.fromtimestamp(float(lua_data[3]), timezone.utc)
+    if lua_data[4]:
+        lua_origin = lua_data[4].decode("utf-8")
+    else:
+        lua_origin = ""
+    if lua_data[5]:
+        lua_sequence = int(lua_data[5])
+    else:
+        lua_sequence = -1
+
+    # The struct will be parsed into a nested python dictionary.
+    tree = SmaxStruct({}, dim=lua_dim, timestamp=lua_date, origin=lua_origin, seq=lua_sequence, smaxname=f"{table}:{key}")
+    
+    for struct_name_index, struct_name in enumerate(lua_struct[0]):
+        t = tree
+        names = struct_name.decode("utf-8").replace(f"{table}:", "", 1).split(':')
+
+        for table_name_index, table_name in enumerate(names):
+            offset = struct_name_index + struct_name_index + 1
+            smaxname = join(struct_name.decode("utf-8"), table_name)
+                    
+            # Grow a new hierarchical level with a blank dictionary.
+            t = t.setdefault(table_name, SmaxStruct({}, dim=lua_dim, timestamp=lua_date, \
+                origin=lua_origin, seq=lua_sequence, smaxname=smaxname))
+
+            # If this is the last name in the path, add actual data.
+            if table_name_index == len(names) - 1:
+
+                # Create offset indices for more readable code.
+                offset2 = struct_name_index + struct_name_index + 2
+
+                # Process leaf node like it is a normal smax_pull.
+                for leaf_index, leaf in enumerate(lua_struct[offset]):
+
+                    # If the leaf says its a struct, ignore it.
+                    lua_type = lua_struct[offset2][1][leaf_index]
+                    if lua_type.decode("utf-8") == "struct":
+                        continue
+
+                    # Extract data and metadata to pass into parser.
+                    leaf_data = lua_struct[offset2][0][leaf_index]
+                    leaf_dim = lua_struct[offset2][2][leaf_index]
+                    leaf_date = lua_struct[offset2][3][leaf_index]
+                    leaf_origin = lua_struct[offset2][4][leaf_index]
+                    leaf_sequence = lua_struct[offset2][5][leaf_index]
+
+                    # Parser will return an SmaxData object.
+                    logger.debug(f"struct_name: {struct_name.decode('utf-8')}")
+                    smaxname = struct_name.decode("utf-8") + ":" + leaf.decode("utf-8")
+                    smax_data_object = _parse_lua_pull_response(
+                        [leaf_data, lua_type, leaf_dim, leaf_date,
+                         leaf_origin, leaf_sequence], smaxname, logger=logger)
+
+                    # Add SmaxData object into the nested dictionary.
+                    t.setdefault(lua_struct[offset][leaf_index].decode("utf-8"),
+                                 smax_data_object)
+    
+    return tree
+
+
+def _parse_lua_batch_responses(pairs, responses, struct_responses, raw=False, logger=logger):
+    """
+    Private function to parse the pipelined responses of a batch pull.
+    Args:
+        pairs (list): normalized (table, key) pairs that were pulled.
+        responses (list): HGetWithMeta responses, one per pair.
+        struct_responses (dict): GetStruct responses, indexed by the position
+                                 of the struct in pairs.
+        raw (bool): Return the byte strings from Redis as SmaxBytes objects.
+        logger (Logger): Logger of the calling client.
+
+    Returns:
+        list: Smax<type> objects or SmaxStructs, in the same order as pairs.
+    """
+    result = []
+    for i, ((table, key), lua_data) in enumerate(zip(pairs, responses)):
+        _check_lua_pull_response(lua_data, table, key, logger=logger)
+        if i in struct_responses:
+            result.append(_parse_lua_struct_response(lua_data, struct_responses[i], table, key,
+                                                     logger=logger))
+        else:
+            result.append(_parse_lua_pull_response(lua_data, f"{table}:{key}", raw=raw, logger=logger))
+    return result
+
+
 def _to_smax_format(value, smax_type=None):
     """
     Private function that converts a given data value to the string format
@@ -1086,6 +2462,18 @@ def _recurse_nested_dict(dictionary):
             yield key, value
 
 
+def _struct_leaves(tree):
+    """
+    Private function to recursively traverse a pulled SmaxStruct, yielding
+    the Smax<type> object at each leaf node.
+    """
+    for value in tree.values():
+        if isinstance(value, Mapping):
+            yield from _struct_leaves(value)
+        else:
+            yield value
+
+
 def _get_struct_fields(leaves):
     """
     Private function to generate the set of all SMA-X fields required to describe the
@@ -1143,6 +2531,46 @@ def _get_struct_tables(table, key, fields):
     return tables
 
 
+def _struct_commands(table, tables):
+    """
+    Private function to generate the HMSetWithMeta calls for a struct from the
+    tables generated by _get_struct_tables().  The optional 'T' value is
+    appended to the last call, which then notifies the parent structs.
+    Args:
+        table (str)   : The top level hash table name for the nested struct.
+        tables (dict) : Arguments to HMSetWithMeta for each table to update.
+
+    Returns:
+        list of ("HMSetWithMeta", id, args) for each table.
+    """
+    commands = []
+    for k, args in tables.items():
+        t, ke = normalize_pair(table, k)
+        commands.append(("HMSetWithMeta", f"{t}:{ke}", list(args)))
+    commands[-1][2].append('T')
+    return commands
+
+
+def _share_commands(table, key, value, smax_type=None):
+    """
+    Private function to generate the LUA script calls that share a value.
+    Args:
+        table (str)   : SMAX table name
+        key (str)     : SMAX key name
+        value         : data to store, takes supported types, including (nested) dicts.
+        smax_type (str): SMA-X type to cast a single value to.
+
+    Returns:
+        list of (script, id, args), where script is "HSetWithMeta" for a single
+        value or "HMSetWithMeta" for each table of a struct.
+    """
+    if not isinstance(value, dict):
+        converted_data, type_name, size = _to_smax_format(value, smax_type=smax_type)
+        return [("HSetWithMeta", table, [key, converted_data, type_name, size])]
+    fields = _get_struct_fields(_recurse_nested_dict(value))
+    return _struct_commands(table, _get_struct_tables(table, key, fields))
+
+
 def _flatten_container(value):
     """Flatten a container of (potentially inhomogenous) containers to a single array
     
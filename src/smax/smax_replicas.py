@@ -0,0 +1,158 @@
+import itertools
+import logging
+import threading
+import time
+
+from redis import Redis
+from redis.exceptions import ConnectionError, TimeoutError, NoScriptError, ReadOnlyError, ResponseError
+
+from .smax_connection_pool import create_connection_pool, _server_address
+
+logger = logging.getLogger(__name__)
+
+
+def _is_replica_failure(error):
+    """
+    Private function telling whether the error of a read from a replica means
+    that the replica cannot serve reads, so that they go to the primary: it
+    could not be reached, is read-only for the command, or lacks EVALSHA_RO or
+    a script. Other errors, e.g. those of the script itself, would be the same
+    on the primary.
+    """
+    if isinstance(error, (ConnectionError, TimeoutError, NoScriptError, ReadOnlyError)):
+        return True
+    return isinstance(error, ResponseError) and str(error).lower().startswith(("unknown command", "readonly"))
+
+
+class SmaxReplica:
+    def __init__(self, redis_ip, redis_port, redis_db, retries=1):
+        """
+        A read-only replica of the SMA-X Redis server, with its own connection
+        pool.
+
+        Args:
+            redis_ip (str): IP address of the replica.
+            redis_port (int): Port of the replica.
+            redis_db (int): Database index to connect to.
+            retries (int): Connection retries before a read is sent to the
+                           primary instead.
+        """
+        self.redis_ip = redis_ip
+        self.redis_port = redis_port
+        self.client = Redis(connection_pool=create_connection_pool(redis_ip, redis_port, redis_db,
+                                                                   retries=retries))
+        # Scripts are called with EVALSHA_RO, unless the server does not know it
+        # (before Redis 7).
+        self.evalsha_command = 'EVALSHA_RO'
+        self.down_until = 0.0
+
+        # Counters for smax_stats()
+        self.reads = 0
+        self.failures = 0
+
+    def __str__(self):
+        return f"{self.redis_ip}:{self.redis_port}"
+
+    def available(self):
+        """
+        Returns:
+            bool: False while the replica is not used after a failed read.
+        """
+        return self.down_until <= time.monotonic()
+
+    def evalsha(self, sha, *args):
+        """
+        Call a read-only LUA script on the replica.
+
+        Args:
+            sha (bytes): SHA of the script.
+            *args: number of keys, keys and arguments to the script.
+
+        Returns:
+            return value from the LUA script.
+        """
+        result = self.client.execute_command(self.evalsha_command, sha, *args)
+        self.reads += 1
+        return result
+
+
+class SmaxReplicaSet:
+    def __init__(self, replicas, redis_port, redis_db, retry_interval=5.0, logger=logger):
+        """
+        The read replicas of a SMA-X server, used in turn for pulls.
+
+        A replica that fails a read is not used again for retry_interval
+        seconds, during which reads go to the other replicas, or to the
+        primary server if none is left.
+
+        Args:
+            replicas (list): Replicas as "host", "host:port" or (host, port).
+            redis_port (int): Port of the replicas given without one.
+            redis_db (int): Database index to connect to.
+            retry_interval (float): Seconds before a failed replica is used again.
+        """
+        self._replicas = []
+        for replica in replicas:
+            self._replicas.append(SmaxReplica(*_server_address(replica, redis_port), redis_db))
+
+        self._retry_interval = retry_interval
+        self._logger = logger
+        self._counter = itertools.count()
+        self._lock = threading.Lock()
+
+        # Reads sent to the primary because no replica was available or the
+        # replica failed.
+        self.fallbacks = 0
+
+    def select(self):
+        """
+        Select the replica for the next read, taking the replicas in turn.
+
+        Returns:
+            SmaxReplica: The next available replica, or None if they are all
+                         down and the read should go to the primary server.
+        """
+        start = next(self._counter)
+        for i in range(len(self._replicas)):
+            replica = self._replicas[(start + i) % len(self._replicas)]
+            if replica.available():
+                return replica
+        with self._lock:
+            self.fallbacks += 1
+        return None
+
+    def failed(self, replica, error):
+        """
+        Record a failed read from a replica, which is then sent to the primary.
+
+        Args:
+            replica (SmaxReplica): The replica that failed.
+            error (Exception): The error raised by the read.
+        """
+        with self._lock:
+            self.fallbacks += 1
+            if replica.evalsha_command == 'EVALSHA_RO' and "unknown command" in str(error).lower():
+                self._logger.info(f"Replica {replica} does not support EVALSHA_RO, using EVALSHA")
+                replica.evalsha_command = 'EVALSHA'
+                return
+            replica.failures += 1
+            replica.down_until = time.monotonic() + self._retry_interval
+        self._logger.warning(f"Read from replica {replica} failed with {error!r}, "
+                             f"using the primary for {self._retry_interval} s")
+
+    def disconnect(self):
+        """Close the connections to all the replicas."""
+        for replica in self._replicas:
+            replica.client.connection_pool.disconnect()
+
+    def stats(self):
+        """
+        Returns:
+            dict: reads and failures of each replica, and the number of reads
+                  sent to the primary instead.
+        """
+        return {"replicas": {str(r): {"reads": r.reads,
+                                      "failures": r.failures,
+                                      "available": r.available()}
+                             for r in self._replicas},
+                "fallbacks": self.fallbacks}
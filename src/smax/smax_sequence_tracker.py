@@ -0,0 +1,111 @@
+import logging
+import threading
+
+from .smax_client import SmaxStruct, smax_unavailable
+
+logger = logging.getLogger(__name__)
+
+
+class SmaxSequenceTracker:
+    def __init__(self, on_gap=None, logger=logger):
+        """
+        Tracks the last seq seen of each SMA-X name delivered to subscribers,
+        to count the updates they missed.
+
+        The seq of a value counts the shares of its name, so a value whose seq
+        is more than one above the last one seen for its name means that
+        updates were missed, e.g. because their notifications were coalesced
+        or dropped, or because the name was shared again before it was pulled.
+        The same seq again is the same value delivered again, e.g. the
+        unchanged leaves of a struct, and a lower seq a name that was
+        recreated, neither of which is a gap. The leaves of structs are
+        tracked by their own names.
+
+        Args:
+            on_gap (func): Function called with the name, the last seq seen
+                           and the new seq of each gap, in the thread that
+                           received the value.
+        """
+        self._on_gap = on_gap
+        self._logger = logger
+
+        # [last seq seen, updates missed] of each name.
+        self._names = {}
+        self._lock = threading.Lock()
+
+        # Counters for smax_stats()
+        self.checked = 0
+        self.gaps = 0
+        self.missed = 0
+        self.resets = 0
+
+    def check(self, value):
+        """
+        Check the seq of a delivered value, or of the leaves of a struct.
+
+        Args:
+            value (Smax<type> or SmaxStruct): Value delivered to a subscriber.
+
+        Returns:
+            int: Number of updates missed before this value.
+        """
+        gaps = []
+        with self._lock:
+            for leaf in _leaves(value):
+                seq = getattr(leaf, "seq", None)
+                name = getattr(leaf, "smaxname", None)
+                if seq is None or seq < 0 or name is None:
+                    continue
+                self.checked += 1
+                last = self._names.get(name)
+                if last is None:
+                    self._names[name] = [seq, 0]
+                    continue
+                if seq > last[0] + 1:
+                    gaps.append((name, last[0], seq))
+                    last[1] += seq - last[0] - 1
+                    self.gaps += 1
+                    self.missed += seq - last[0] - 1
+                elif seq < last[0]:
+                    self.resets += 1
+                last[0] = seq
+
+        for name, last, seq in gaps:
+            self._logger.debug(f"Missed {seq - last - 1} updates of {name}")
+            if self._on_gap is not None:
+                try:
+                    self._on_gap(name, last, seq)
+                except Exception as e:
+                    self._logger.error(f"Sequence gap hook failed with {e!r}")
+        return sum(seq - last - 1 for name, last, seq in gaps)
+
+    def missed_updates(self):
+        """
+        Returns:
+            dict: Number of updates missed of each name that missed some.
+        """
+        with self._lock:
+            return {name: missed for name, (seq, missed) in self._names.items() if missed > 0}
+
+    def stats(self):
+        """
+        Returns:
+            dict: numbers of names tracked, values checked, gaps, updates
+                  missed, and names recreated.
+        """
+        return {"names": len(self._names),
+                "checked": self.checked,
+                "gaps": self.gaps,
+                "missed": self.missed,
+                "resets": self.resets}
+
+
+def _leaves(value):
+    """Private generator of the leaves of a value, or of the value itself."""
+    if value is smax_unavailable:
+        return
+    if not isinstance(value, SmaxStruct):
+        yield value
+        return
+    for v in value.values():
+        yield from _leaves(v)
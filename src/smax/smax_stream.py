@@ -0,0 +1,286 @@
+import logging
+import threading
+from collections import deque
+
+from .smax_channel_matcher import channel_name, channel_pair
+from .smax_client import SmaxKeyError
+
+logger = logging.getLogger(__name__)
+
+# Returned by _next() to end the iteration.
+_closed = object()
+
+# What to do with a notification when the backlog is full.
+_policies = ("drop_oldest", "drop_newest")
+
+
+class SmaxStream:
+    def __init__(self, client, patterns, prefix, pull=True, batch=1, timeout=None, max_backlog=10000,
+                 policy="drop_oldest", logger=logger):
+        """
+        An iterator over the updates of SMA-X names matching some patterns,
+        created by SmaxRedisClient.smax_stream().
+
+        The stream subscribes to the patterns on the client's pubsub
+        dispatcher thread, which queues the notifications of the stream
+        without matching or decoding them. Iterating pulls the notified values
+        (or not, without pull) in the iterating thread, and yields
+        (name, value) pairs. With batch > 1, the notifications already queued
+        are pulled together, up to batch names, in one round trip. Names
+        that no longer exist when they are pulled are skipped.
+
+        The queue of notifications is bounded by max_backlog, so that a
+        consumer falling behind does not grow it without limit, nor hold up
+        the dispatcher thread. When it is full, the oldest or the new
+        notification is dropped, as given by policy.
+
+        The stream is also an async iterator, waiting for notifications on the
+        event loop, and pulling them in a worker thread, and a context manager
+        which closes it. Several threads or tasks may iterate over the same
+        stream, each update being yielded to one of them. An async iteration
+        cancelled while pulling puts its notifications back in the queue.
+
+        Args:
+            client (SmaxRedisClient): Client to subscribe and pull with.
+            patterns (str or list): SMA-X names or patterns, with a '*' suffix.
+            prefix (str): Prefix of the SMA-X pub/sub channels.
+            pull (bool): Yield the pulled values rather than the notifications.
+            batch (int): Maximum number of names pulled in one round trip.
+            timeout (float): End the iteration when no notification arrives
+                             for timeout seconds, or None to wait forever.
+            max_backlog (int): Maximum number of queued notifications.
+            policy (str): "drop_oldest" or "drop_newest", the queued or the
+                          new notification to drop when the queue is full.
+        """
+        if policy not in _policies:
+            raise ValueError(f"Unknown stream backlog policy {policy!r}, expected one of {_policies}")
+        if isinstance(patterns, str):
+            patterns = [patterns]
+        self._client = client
+        self._channels = [(f"{prefix}:{pattern}", pattern.endswith("*")) for pattern in patterns]
+        self._prefix = prefix
+        self._pull = pull
+        self._batch = batch
+        self._timeout = timeout
+        self._max_backlog = max_backlog
+        self._policy = policy
+        self._logger = logger
+
+        # Notifications queued by the dispatcher thread, and updates pulled
+        # together, not yet yielded.
+        self._queue = deque()
+        self._ready = deque()
+        self._condition = threading.Condition()
+        self._closed = False
+
+        # (loop, asyncio.Event) of the async iterations waiting for notifications.
+        self._waiters = set()
+
+        # Counters for stats()
+        self.dropped = 0
+        self.missing = 0
+
+        self._pubsub = client._get_callback_pubsub()
+        for channel, pattern in self._channels:
+            self._pubsub.subscribe(channel, self, self._put, pattern=pattern)
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        update = self._next()
+        if update is _closed:
+            raise StopIteration
+        return update
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        import asyncio
+        while True:
+            try:
+                return self._ready.popleft()
+            except IndexError:
+                pass
+            messages = await self._take_async()
+            if messages is None:
+                raise StopAsyncIteration
+            if not self._pull:
+                self._ready.extend(self._updates(messages))
+                continue
+            try:
+                self._ready.extend(await asyncio.to_thread(self._updates, messages))
+            except asyncio.CancelledError:
+                self._requeue(messages)
+                raise
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def backlog(self):
+        """
+        Returns:
+            int: Number of updates received but not yet yielded.
+        """
+        return len(self._queue) + len(self._ready)
+
+    def stats(self):
+        """
+        Returns:
+            dict: numbers of updates not yet yielded, of notifications dropped
+                  from the full backlog, and of names skipped as missing.
+        """
+        return {"backlog": self.backlog(),
+                "dropped": self.dropped,
+                "missing": self.missing}
+
+    def close(self):
+        """
+        Unsubscribe the stream, and end its iteration, including one waiting
+        in another thread, after the updates already queued.
+        """
+        if self._closed:
+            return
+        for channel, pattern in self._channels:
+            self._pubsub.unsubscribe(channel, self)
+        with self._condition:
+            self._closed = True
+            self._condition.notify_all()
+            self._wake_waiters()
+
+    def _put(self, message):
+        """Private method queueing a notification, in the dispatcher thread."""
+        with self._condition:
+            if len(self._queue) >= self._max_backlog:
+                self.dropped += 1
+                if self._policy == "drop_newest":
+                    dropped = message
+                else:
+                    dropped = self._queue.popleft()
+                    self._queue.append(message)
+                self._logger.warning(f"Stream backlog full, dropped notification of {self._name(dropped)}")
+            else:
+                self._queue.append(message)
+            self._condition.notify()
+            self._wake_waiters()
+
+    def _wake_waiters(self):
+        """Private method waking up the waiting async iterations, holding the condition."""
+        for loop, wakeup in self._waiters:
+            try:
+                loop.call_soon_threadsafe(wakeup.set)
+            except RuntimeError:
+                # The event loop is closed.
+                pass
+
+    def _requeue(self, messages):
+        """Private method putting back taken notifications, at the front of the queue."""
+        with self._condition:
+            self._queue.extendleft(reversed(list(messages.values())))
+            self._condition.notify()
+            self._wake_waiters()
+
+    def _next(self):
+        """Private method returning the next (name, value), or _closed when done."""
+        while True:
+            # Another consumer may take the last ready update first.
+            try:
+                return self._ready.popleft()
+            except IndexError:
+                pass
+            messages = self._take()
+            if messages is None:
+                return _closed
+            self._ready.extend(self._updates(messages))
+
+    def _take(self):
+        """
+        Private method waiting for notifications, and returning up to batch of
+        them by name, or None at the end of the iteration.
+        """
+        with self._condition:
+            if not self._condition.wait_for(lambda: len(self._queue) > 0 or self._closed, self._timeout):
+                return None
+            return self._take_queued()
+
+    async def _take_async(self):
+        """
+        Private coroutine waiting for notifications on the event loop, without
+        holding a thread, and returning them as _take() does.
+        """
+        import asyncio
+        loop = asyncio.get_running_loop()
+        end = None if self._timeout is None else loop.time() + self._timeout
+        waiter = (loop, asyncio.Event())
+        try:
+            while True:
+                with self._condition:
+                    if len(self._queue) > 0 or self._closed:
+                        return self._take_queued()
+                    waiter[1].clear()
+                    self._waiters.add(waiter)
+                remaining = None if end is None else end - loop.time()
+                if remaining is not None and remaining <= 0:
+                    return None
+                try:
+                    await asyncio.wait_for(waiter[1].wait(), remaining)
+                except asyncio.TimeoutError:
+                    pass
+        finally:
+            with self._condition:
+                self._waiters.discard(waiter)
+
+    def _take_queued(self):
+        """
+        Private method returning up to batch of the queued notifications by
+        name, or None if there are none, holding the condition.
+        """
+        if len(self._queue) == 0:
+            return None
+        messages = {}
+        while len(self._queue) > 0 and len(messages) < self._batch:
+            message = self._queue.popleft()
+            messages[self._name(message)] = message
+        return messages
+
+    def _updates(self, messages):
+        """
+        Private method returning the (name, value) updates of notifications,
+        by name, without the names that no longer exist.
+        """
+        if not self._pull:
+            for name, message in messages.items():
+                message["channel"] = name
+                message["data"] = message["data"].decode("utf-8")
+            return list(messages.items())
+
+        if len(messages) > 1:
+            try:
+                updates = list(zip(messages, self._client.smax_pull_batch(list(messages))))
+            except SmaxKeyError:
+                # Pulled one by one, to skip the missing names.
+                updates = self._pull_each(messages)
+        else:
+            updates = self._pull_each(messages)
+        for name, value in updates:
+            self._client._check_sequences(value)
+        return updates
+
+    def _pull_each(self, messages):
+        """Private method pulling notified names one at a time, skipping the missing ones."""
+        updates = []
+        for name, message in messages.items():
+            try:
+                updates.append((name, self._client.smax_pull(*channel_pair(message["channel"], self._prefix))))
+            except SmaxKeyError:
+                self.missing += 1
+                self._logger.warning(f"Skipped update of {name}, which no longer exists")
+        return updates
+
+    def _name(self, message):
+        """Private method returning the SMA-X name of a notification."""
+        return channel_name(message["channel"], self._prefix)
@@ -0,0 +1,196 @@
+import logging
+import threading
+
+from .smax_client import SmaxStruct, normalize_pair, smax_unavailable
+
+logger = logging.getLogger(__name__)
+
+
+class SmaxStructCache:
+    def __init__(self, client, root, logger=logger):
+        """
+        The last pulled value of a struct, kept up to date from the
+        notifications of a pattern subscription to it, for the incremental
+        subscriptions of SmaxRedisClient.smax_subscribe().
+
+        The whole struct is only pulled with the first notification. After
+        that, the notification of a leaf pulls that leaf, and the notification
+        of a table pulls the leaves of that table alone, not of the tables
+        below it (which are notified for themselves), with a single
+        smax_pull_batch() round trip. The pulled values are patched into the
+        cached tree, in place.
+
+        Args:
+            client (SmaxRedisClient): Client to pull with.
+            root (str): SMA-X name of the struct.
+        """
+        self._client = client
+        self.root = root
+        self._logger = logger
+
+        self._tree = None
+        self._lock = threading.RLock()
+
+        # Counters for smax_stats()
+        self.full_pulls = 0
+        self.partial_pulls = 0
+        self.unchanged = 0
+
+    @property
+    def lock(self):
+        """Lock held while the tree is updated, and while it is delivered."""
+        return self._lock
+
+    def update(self, name):
+        """
+        Bring the cached struct up to date with the notification of an SMA-X
+        name.
+
+        Args:
+            name (str): Notified SMA-X name, of the struct or below it.
+
+        Returns:
+            tuple: The (tree, changed) of the struct, with tree as pulled by
+                   smax_pull() and patched since, and changed the list of the
+                   paths of the values that changed, relative to the struct
+                   (e.g. "dbe:temp", or "" for the whole struct), or None if
+                   no value changed, e.g. for the notification of a parent
+                   table once its children are up to date.
+        """
+        with self._lock:
+            if name == self.root:
+                path = []
+            elif name.startswith(self.root + ":"):
+                path = name[len(self.root) + 1:].split(":")
+            else:
+                # Matches the pattern without being part of the struct, e.g.
+                # test:swarm2 for test:swarm*.
+                return None
+
+            if self._tree is None:
+                return self._pull_all()
+
+            # The pulled tree has the struct under its own key, as pulled by
+            # smax_pull().
+            parent = self._tree
+            tree_path = [normalize_pair(self.root)[1]] + path
+            for p in tree_path[:-1]:
+                parent = parent.get(p)
+                if not isinstance(parent, SmaxStruct):
+                    # A new table with a new parent.
+                    return self._pull_all()
+            node = parent.get(tree_path[-1])
+
+            self.partial_pulls += 1
+            if isinstance(node, SmaxStruct):
+                changed = self._update_table(name, node, path)
+            else:
+                value = self._client.smax_pull(*normalize_pair(name))
+                changed = []
+                if _changed(node, value):
+                    parent[tree_path[-1]] = _unwrap(value, tree_path[-1])
+                    changed.append(":".join(path))
+
+            if len(changed) == 0:
+                self.unchanged += 1
+                return None
+            return self._tree, changed
+
+    def update_many(self, names):
+        """
+        Bring the cached struct up to date with the notifications of several
+        SMA-X names, e.g. of the tables of a struct share.
+
+        Returns:
+            tuple: The (tree, changed) of the struct, as update(), with the
+                   paths that changed for any of the names, or None if no
+                   value changed.
+        """
+        with self._lock:
+            changed = []
+            for name in names:
+                update = self.update(name)
+                if update is None:
+                    continue
+                changed.extend(path for path in update[1] if path not in changed)
+                if "" in changed:
+                    # Pulled whole.
+                    break
+            return None if len(changed) == 0 else (self._tree, changed)
+
+    def node(self, path):
+        """
+        Returns:
+            The value or table at a path relative to the struct, as in the
+            changed paths of update(), or None if it is not in the struct.
+        """
+        with self._lock:
+            node = None if self._tree is None else self._tree.get(normalize_pair(self.root)[1])
+            for p in path.split(":") if path else []:
+                if not isinstance(node, SmaxStruct):
+                    return None
+                node = node.get(p)
+            return node
+
+    def _pull_all(self):
+        """Private method pulling the whole struct."""
+        tree = self._client.smax_pull(*normalize_pair(self.root))
+        if tree is smax_unavailable:
+            return None
+        if not isinstance(tree, SmaxStruct):
+            raise TypeError(f"{self.root} is not a struct")
+        self._tree = tree
+        self.full_pulls += 1
+        return self._tree, [""]
+
+    def _update_table(self, name, table, path):
+        """
+        Private method pulling the leaves of a cached table, and the tables
+        new to it, and removing those it no longer has.
+
+        Returns:
+            list: The paths of the values that changed.
+        """
+        fields = self._client._table_fields(name)
+        pulls = [f for f in fields if not isinstance(table.get(f), SmaxStruct)]
+        values = self._client.smax_pull_batch([f"{name}:{f}" for f in pulls])
+
+        changed = []
+        for field, value in zip(pulls, values):
+            if _changed(table.get(field), value):
+                table[field] = _unwrap(value, field)
+                changed.append(":".join(path + [field]))
+        for field in set(table) - set(fields):
+            del table[field]
+            changed.append(":".join(path + [field]))
+        return changed
+
+    def stats(self):
+        """
+        Returns:
+            dict: numbers of pulls of the whole struct and of a part of it, and
+                  of notifications that changed nothing.
+        """
+        return {"full_pulls": self.full_pulls,
+                "partial_pulls": self.partial_pulls,
+                "unchanged": self.unchanged}
+
+
+def _unwrap(value, key):
+    """
+    Private function returning a pulled value, or the struct of a pulled
+    struct, which smax_pull() returns under its own key.
+    """
+    return value[key] if isinstance(value, SmaxStruct) else value
+
+
+def _changed(old, value):
+    """
+    Private function checking whether a pulled value differs from the cached
+    one, which it may not if it was already pulled with its table.
+    """
+    if value is smax_unavailable:
+        return False
+    if old is None or isinstance(value, SmaxStruct):
+        return True
+    return (old.timestamp, old.seq) != (value.timestamp, value.seq)
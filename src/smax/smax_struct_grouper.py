@@ -0,0 +1,104 @@
+import functools
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Seconds the notifications of a struct share are gathered for, at most,
+# when the notification completing it does not arrive.
+struct_group_timeout = 0.05
+
+
+class SmaxStructGrouper:
+    def __init__(self, deliver, call_later, timeout=struct_group_timeout, logger=logger):
+        """
+        Gathers the notifications that a pattern subscription receives for
+        the tables of each struct share into a single event, for
+        smax_subscribe().
+
+        A struct share calls HMSetWithMeta for each table of the struct, which
+        notifies its own table, and the last call, with the 'T' flag, then
+        notifies each of the parent tables in turn, in the same script. The
+        notifications of a share all have the origin of the share in their
+        message, so they are gathered by origin, until one of a parent of the
+        table notified just before, which completes the share. Its further
+        parents are then ignored. The notifications not followed by one of a
+        parent, e.g. those of scalar shares, or of a struct share whose
+        parents are not in the pattern, are delivered timeout seconds after
+        the first.
+
+        The grouper is only used by the dispatcher thread of the
+        subscription, which calls notify() and the functions scheduled with
+        call_later(), so it has no lock.
+
+        Args:
+            deliver (func): Function called with the list of the SMA-X names
+                            notified by each share (or other group), in order.
+            call_later (func): Function scheduling the call of a function
+                               after a delay in seconds, in the thread calling
+                               notify(), e.g. SmaxPubSubDispatcher.call_later().
+            timeout (float): Seconds after the first notification of a group
+                             at which it is delivered, if it was not completed.
+        """
+        self._deliver = deliver
+        self._call_later = call_later
+        self._timeout = timeout
+        self._logger = logger
+
+        # The names notified by the group being gathered for each origin, and
+        # the (last name notified, whether it completed a group) of each.
+        self._groups = {}
+        self._last = {}
+
+        # Counters for smax_stats()
+        self.notifications = 0
+        self.events = 0
+        self.timeouts = 0
+
+    def notify(self, name, origin):
+        """
+        Gather a notification.
+
+        Args:
+            name (str): Notified SMA-X name.
+            origin (bytes): Data of the notification message, the origin of
+                            the share.
+        """
+        self.notifications += 1
+        last, completed = self._last.get(origin, (None, False))
+        group = self._groups.get(origin)
+        if last is not None and last.startswith(name + ":") and (group is not None or completed):
+            # A parent notified by the last table of a struct share.
+            self._last[origin] = (name, True)
+            if group is not None:
+                del self._groups[origin]
+                if name not in group:
+                    group.append(name)
+                self.events += 1
+                self._deliver(group)
+            return
+
+        self._last[origin] = (name, False)
+        if group is None:
+            group = self._groups[origin] = []
+            self._call_later(self._timeout, functools.partial(self._expire, origin, group))
+        if name not in group:
+            group.append(name)
+
+    def _expire(self, origin, group):
+        """Private method delivering a group that was not completed in time."""
+        if self._groups.get(origin) is not group:
+            return
+        del self._groups[origin]
+        self.timeouts += 1
+        self.events += 1
+        self._deliver(group)
+
+    def stats(self):
+        """
+        Returns:
+            dict: numbers of notifications gathered, of events delivered, and
+                  of those delivered at the timeout.
+        """
+        return {"notifications": self.notifications,
+                "events": self.events,
+                "timeouts": self.timeouts}
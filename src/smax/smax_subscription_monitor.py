@@ -0,0 +1,173 @@
+import logging
+import threading
+import time
+from collections import Counter
+
+logger = logging.getLogger(__name__)
+
+# What to do with the notifications of a subscription while it lags.
+_policies = ("drop_oldest", "coalesce", "block")
+
+
+class SmaxSubscriptionMonitor:
+    def __init__(self, pattern, lag_threshold=None, policy="coalesce", logger=logger):
+        """
+        Metrics of a callback subscription, and the policy applied to its
+        notifications while it falls behind, for smax_subscribe().
+
+        The lag of a notification is the time from the SMA-X timestamp of the
+        pulled value to the call of the callback with it. The subscription is
+        lagging from a lag above lag_threshold until a lag below it. While
+        lagging, the notifications queued for the callback workers are handled
+        according to the policy:
+
+        "drop_oldest" drops the notifications of the subscription still queued
+        when a new one arrives, without pulling their values;
+        "coalesce" drops a new notification of a name that already has one
+        queued, whose pull will get the latest value anyway;
+        "block" makes the pub/sub thread wait until the queued notifications
+        were handled before queueing the new one, leaving the newer ones in
+        Redis.
+
+        Args:
+            pattern (str): Subscribed SMA-X name or pattern.
+            lag_threshold (float): Lag in seconds above which the policy is
+                                   applied, or None to only record metrics.
+            policy (str): "drop_oldest", "coalesce" or "block".
+        """
+        if policy not in _policies:
+            raise ValueError(f"Unknown lag policy {policy!r}, expected one of {_policies}")
+        self.pattern = pattern
+        self.lag_threshold = lag_threshold
+        self.policy = policy
+        self._logger = logger
+
+        # Names of the queued notifications, and the number of notifications
+        # received when the queued ones were last dropped.
+        self._queued = Counter()
+        self._depth = 0
+        self._drop_before = 0
+        self._condition = threading.Condition()
+        self.lagging = False
+
+        # Counters for smax_stats()
+        self.received = 0
+        self.processed = 0
+        self.dropped = 0
+        self.coalesced = 0
+        self.max_queue_depth = 0
+        self.lag = None
+        self.max_lag = 0.0
+        self._total_lag = 0.0
+        self._lags = 0
+
+    def admit(self, name):
+        """
+        Record a notification received by the pub/sub thread, and apply the
+        policy to it if the subscription lags.
+
+        Args:
+            name (str): Notified SMA-X name.
+
+        Returns:
+            int: Serial number of the notification, to pass to start(), or
+                 None if it was dropped.
+        """
+        with self._condition:
+            self.received += 1
+            serial = self.received
+            if self.lagging:
+                if self.policy == "coalesce" and self._queued[name] > 0:
+                    self.coalesced += 1
+                    return None
+                if self.policy == "drop_oldest":
+                    self._drop_before = serial
+                elif self.policy == "block":
+                    while self.lagging and self._depth > 0:
+                        self._condition.wait(0.1)
+            self._queued[name] += 1
+            self._depth += 1
+            self.max_queue_depth = max(self.max_queue_depth, self._depth)
+            return serial
+
+    def discard(self, name, coalesced=False):
+        """
+        Record a queued notification dropped, or coalesced with a newer one,
+        by the callback workers.
+        """
+        with self._condition:
+            if coalesced:
+                self.coalesced += 1
+            else:
+                self.dropped += 1
+            self._done(name)
+
+    def start(self, name, serial):
+        """
+        Take a queued notification to handle.
+
+        Returns:
+            bool: False if it is dropped, by the drop_oldest policy.
+        """
+        with self._condition:
+            if serial >= self._drop_before:
+                return True
+            self.dropped += 1
+            self._done(name)
+            return False
+
+    def delivered(self, timestamp):
+        """
+        Record the lag of a value about to be delivered to the callback.
+
+        Args:
+            timestamp (datetime): SMA-X timestamp of the value.
+        """
+        lag = time.time() - timestamp.timestamp()
+        with self._condition:
+            self.lag = lag
+            self.max_lag = max(self.max_lag, lag)
+            self._total_lag += lag
+            self._lags += 1
+            if self.lag_threshold is not None and (lag > self.lag_threshold) != self.lagging:
+                self.lagging = not self.lagging
+                if self.lagging:
+                    self._logger.warning(f"Subscription to {self.pattern} lags by {lag:.3f} s, "
+                                         f"applying the {self.policy} policy")
+                else:
+                    self._logger.info(f"Subscription to {self.pattern} caught up")
+                self._condition.notify_all()
+
+    def done(self, name):
+        """Record a handled notification."""
+        with self._condition:
+            self.processed += 1
+            self._done(name)
+
+    def _done(self, name):
+        """Private method removing a queued notification. Called with the lock held."""
+        self._queued[name] -= 1
+        if self._queued[name] <= 0:
+            del self._queued[name]
+        self._depth -= 1
+        self._condition.notify_all()
+
+    def stats(self):
+        """
+        Returns:
+            dict: numbers of notifications received, processed, dropped and
+                  coalesced, current and largest number queued, and the
+                  latest, mean and maximum lag in seconds.
+        """
+        with self._condition:
+            return {"pattern": self.pattern,
+                    "received": self.received,
+                    "processed": self.processed,
+                    "dropped": self.dropped,
+                    "coalesced": self.coalesced,
+                    "queue_depth": self._depth,
+                    "max_queue_depth": self.max_queue_depth,
+                    "lagging": self.lagging,
+                    "lag": self.lag,
+                    "mean_lag": self._total_lag / self._lags if self._lags else None,
+                    "max_lag": self.max_lag}
@@ -0,0 +1,70 @@
+"""Concurrent pulls over a single event loop with AsyncSmaxRedisClient.
+
+Compares pulling N keys with the blocking SmaxRedisClient one at a time, with
+the blocking client run in a thread pool executor (the usual workaround in
+asyncio services), and with AsyncSmaxRedisClient using asyncio.gather() or a
+single smax_pull_batch().
+
+    python async_concurrent_pulls.py [--host localhost] [--keys 200]
+"""
+import argparse
+import asyncio
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from smax import SmaxRedisClient, AsyncSmaxRedisClient
+
+table = "benchmark:async_concurrent_pulls"
+
+
+def report(name, n_keys, elapsed):
+    print(f"{name:<28} {elapsed*1e3:>10.1f} ms {n_keys/elapsed:>12.0f} pulls/s")
+
+
+async def run_async(args, smax_client):
+    keys = [f"key{i}" for i in range(args.keys)]
+
+    loop = asyncio.get_running_loop()
+    with ThreadPoolExecutor(max_workers=args.workers) as executor:
+        await asyncio.gather(*[loop.run_in_executor(executor, smax_client.smax_pull, table, k) for k in keys])
+
+        start = time.perf_counter()
+        await asyncio.gather(*[loop.run_in_executor(executor, smax_client.smax_pull, table, k) for k in keys])
+        report(f"sync in {args.workers} threads", args.keys, time.perf_counter() - start)
+
+    async with AsyncSmaxRedisClient(args.host) as async_client:
+        # Warm up, so that the connection pool is filled before timing
+        await asyncio.gather(*[async_client.smax_pull(table, k) for k in keys])
+
+        start = time.perf_counter()
+        await asyncio.gather(*[async_client.smax_pull(table, k) for k in keys])
+        report("async gather", args.keys, time.perf_counter() - start)
+
+        start = time.perf_counter()
+        await async_client.smax_pull_batch([(table, k) for k in keys])
+        report("async batch", args.keys, time.perf_counter() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--host", default="localhost")
+    parser.add_argument("--keys", type=int, default=200)
+    parser.add_argument("--workers", type=int, default=16, help="Thread pool size for the executor case")
+    args = parser.parse_args()
+
+    smax_client = SmaxRedisClient(args.host)
+    smax_client.smax_share_batch({(table, f"key{i}"): float(i) for i in range(args.keys)})
+
+    start = time.perf_counter()
+    for i in range(args.keys):
+        smax_client.smax_pull(table, f"key{i}")
+    report("sync sequential", args.keys, time.perf_counter() - start)
+
+    asyncio.run(run_async(args, smax_client))
+
+    smax_client.smax_purge(table + "*")
+    smax_client.smax_disconnect()
+
+
+if __name__ == "__main__":
+    main()
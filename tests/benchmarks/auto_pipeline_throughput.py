@@ -0,0 +1,53 @@
+"""Pull throughput from many threads with and without auto-pipelining.
+
+Without auto-pipelining each smax_pull() is its own round trip on a pooled
+connection. With auto_pipeline=True, calls made concurrently from all the
+threads are coalesced into shared pipeline writes.
+
+    python auto_pipeline_throughput.py [--host localhost] [--threads 50] [--pulls 100]
+"""
+import argparse
+import threading
+import time
+
+from smax import SmaxRedisClient
+
+table = "benchmark:auto_pipeline_throughput"
+
+
+def run(smax_client, n_threads, n_pulls):
+    def worker(i):
+        for j in range(n_pulls):
+            smax_client.smax_pull(table, f"key{i}")
+
+    threads = [threading.Thread(target=worker, args=(i,)) for i in range(n_threads)]
+    start = time.perf_counter()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return n_threads * n_pulls / (time.perf_counter() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--host", default="localhost")
+    parser.add_argument("--threads", type=int, default=50)
+    parser.add_argument("--pulls", type=int, default=100, help="Pulls per thread")
+    parser.add_argument("--window", type=float, default=0.0, help="auto_pipeline_window in seconds")
+    args = parser.parse_args()
+
+    with SmaxRedisClient(args.host) as smax_client:
+        smax_client.smax_share_batch({(table, f"key{i}"): float(i) for i in range(args.threads)})
+        print(f"plain:         {run(smax_client, args.threads, args.pulls):>10.0f} pulls/s")
+
+    with SmaxRedisClient(args.host, auto_pipeline=True, auto_pipeline_window=args.window) as smax_client:
+        rate = run(smax_client, args.threads, args.pulls)
+        stats = smax_client.smax_stats()["auto_pipeline"]
+        print(f"auto-pipeline: {rate:>10.0f} pulls/s, "
+              f"{stats['commands'] / stats['batches']:.1f} commands per write on average")
+        smax_client.smax_purge(table + "*")
+
+
+if __name__ == "__main__":
+    main()
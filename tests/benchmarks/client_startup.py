@@ -0,0 +1,74 @@
+"""Startup latency of SmaxRedisClient: construction plus the first pull.
+
+Times the first client of a fresh process (which loads the script SHAs with a
+single HGETALL) against later clients in the same process (which reuse the
+process-wide SHA cache), and the end-to-end time of short-lived programs that
+start Python, import smax, and pull one value.
+
+    python client_startup.py [--host localhost] [--runs 20]
+"""
+import argparse
+import statistics
+import subprocess
+import sys
+import time
+
+from smax import SmaxRedisClient
+
+table = "benchmark:client_startup"
+
+program = f"""
+import time
+start = time.perf_counter()
+from smax import SmaxRedisClient
+s = SmaxRedisClient({{host!r}})
+s.smax_pull({table!r}, "key")
+print(time.perf_counter() - start)
+"""
+
+
+def summary(name, times):
+    times = sorted(times)
+    print(f"{name:<40} median {statistics.median(times)*1e3:8.2f} ms   "
+          f"min {times[0]*1e3:8.2f} ms   max {times[-1]*1e3:8.2f} ms")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--host", default="localhost")
+    parser.add_argument("--runs", type=int, default=20)
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    smax_client = SmaxRedisClient(args.host)
+    construct = time.perf_counter() - start
+    smax_client.smax_share(table, "key", 1.0)
+    first = time.perf_counter() - start
+    print(f"first client in process: construct {construct*1e3:.2f} ms, construct + first call {first*1e3:.2f} ms")
+
+    times = []
+    for i in range(args.runs):
+        start = time.perf_counter()
+        s = SmaxRedisClient(args.host)
+        s.smax_pull(table, "key")
+        times.append(time.perf_counter() - start)
+        s.smax_disconnect()
+    summary("later clients, construct + pull", times)
+
+    times = []
+    wall = []
+    for i in range(args.runs):
+        start = time.perf_counter()
+        out = subprocess.run([sys.executable, "-c", program.format(host=args.host)],
+                             capture_output=True, text=True, check=True)
+        wall.append(time.perf_counter() - start)
+        times.append(float(out.stdout.split()[-1]))
+    summary("new process, import + construct + pull", times)
+    summary("new process, total wall clock", wall)
+
+    smax_client.smax_purge(table + "*")
+    smax_client.smax_disconnect()
+
+
+if __name__ == "__main__":
+    main()
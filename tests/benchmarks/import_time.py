@@ -0,0 +1,69 @@
+"""Import and construction time of the smax package, in fresh processes.
+
+Times `import smax`, the first use of SmaxRedisClient (which imports numpy and
+redis), and constructing a client, each in a new Python process as a CLI
+invocation or cron job would. Construction makes no network traffic, so no
+server is needed. With --importtime, the slowest imports of the last run are
+listed too.
+
+    python import_time.py [--runs 20] [--importtime]
+"""
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+
+program = """
+import time
+start = time.perf_counter()
+import smax
+imported = time.perf_counter()
+smax.SmaxRedisClient
+loaded = time.perf_counter()
+smax.SmaxRedisClient("localhost", program_name="benchmark")
+constructed = time.perf_counter()
+print(imported - start, loaded - imported, constructed - loaded)
+"""
+
+
+def summary(name, times):
+    times = sorted(times)
+    print(f"{name:<40} median {statistics.median(times)*1e3:8.2f} ms   "
+          f"min {times[0]*1e3:8.2f} ms   max {times[-1]*1e3:8.2f} ms")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--runs", type=int, default=20)
+    parser.add_argument("--importtime", action="store_true",
+                        help="List the slowest imports, from python -X importtime")
+    args = parser.parse_args()
+
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(sys.path))
+    results = []
+    for i in range(args.runs):
+        ps = subprocess.run([sys.executable, "-c", program], capture_output=True,
+                            text=True, check=True, env=env)
+        results.append([float(t) for t in ps.stdout.split()])
+
+    imported, loaded, constructed = zip(*results)
+    summary("import smax", imported)
+    summary("first use of SmaxRedisClient", loaded)
+    summary("SmaxRedisClient()", constructed)
+
+    if args.importtime:
+        ps = subprocess.run([sys.executable, "-X", "importtime", "-c", program],
+                            capture_output=True, text=True, check=True, env=env)
+        lines = [line for line in ps.stderr.splitlines() if line.startswith("import time:") and "|" in line]
+        timed = []
+        for line in lines[1:]:
+            self_us, cumulative_us, name = line[len("import time:"):].split("|")
+            timed.append((int(cumulative_us), name.rstrip()))
+        print("\nSlowest imports (cumulative):")
+        for cumulative_us, name in sorted(timed, reverse=True)[:15]:
+            print(f"{cumulative_us/1e3:10.2f} ms  {name}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,223 @@
+"""End-to-end notification latency, between producer and consumer processes.
+
+A producer process shares timestamped values at a fixed rate, and a consumer
+process receives them, either with a callback subscription (publish to
+callback) or with smax_wait_on_subscribed() (publish to wait). The latency of
+each value is the wall-clock time from just before its smax_share() in the
+producer to its delivery in the consumer, which includes the notification and
+the pull of the value. This is run for scalars, arrays and structs, at each
+rate, and reports the latency percentiles of the values received, the
+throughput, and the memory of the consumer over time.
+
+The latency of a value is measured at its first delivery: the struct shares
+notify each table of the struct, and later deliveries of a value, or values
+superseded before they were pulled, are counted but not measured.
+
+By default this uses the SMA-X server on --host and --port. With
+--start-server it starts a redis-server on --port instead, and loads the
+SMA-X LUA scripts of --lua-dir (e.g. the lua directory of smax-server) into
+it, as smax-server's install does.
+
+    python notification_latency.py [--host localhost] [--port 6379]
+        [--start-server --lua-dir ../smax-server/lua]
+        [--kinds scalar,array,struct] [--modes callback,wait] [--rates 100,1000]
+        [--duration 5] [--array-size 1000] [--struct-tables 8] [--csv memory.csv]
+"""
+import argparse
+import csv
+import multiprocessing
+import os
+import pathlib
+import subprocess
+import time
+
+import numpy as np
+import psutil
+from redis import TimeoutError
+
+from smax import SmaxRedisClient
+
+table = "benchmark:notification_latency"
+
+
+def make_value(kind, sent, array_size, struct_tables):
+    """Value of a kind, carrying the time it was sent."""
+    if kind == "scalar":
+        return sent
+    if kind == "array":
+        array = np.zeros(array_size)
+        array[0] = sent
+        return array
+    struct = {"sent": sent}
+    for i in range(struct_tables):
+        struct[f"roach2-{i:02d}"] = {"temp": float(i), "firmware": "1.0", "status": i}
+    return struct
+
+
+def sent_time(kind, value):
+    """Time a received value was sent."""
+    if kind == "scalar":
+        return float(value)
+    if kind == "array":
+        return float(value[0])
+    return float(value[kind]["sent"])
+
+
+def produce(host, port, kind, rate, duration, array_size, struct_tables, results):
+    with SmaxRedisClient(host, port) as smax_client:
+        n = 0
+        start = time.monotonic()
+        while True:
+            now = time.monotonic()
+            if now >= start + duration:
+                break
+            next_time = start + n / rate
+            if now < next_time:
+                time.sleep(next_time - now)
+            smax_client.smax_share(table, kind, make_value(kind, time.time(), array_size, struct_tables))
+            n += 1
+        results.put((n, time.monotonic() - start))
+
+
+def consume(host, port, kind, mode, ready, done, results):
+    latencies = []
+    seen = set()
+    deliveries = [0]
+    memory = []
+    process = psutil.Process(os.getpid())
+    start = time.monotonic()
+
+    def record(value):
+        now = time.time()
+        deliveries[0] += 1
+        sent = sent_time(kind, value)
+        if sent not in seen:
+            seen.add(sent)
+            latencies.append(now - sent)
+
+    def sample_memory():
+        memory.append((time.monotonic() - start, process.memory_info().rss / 1024 ** 2))
+
+    name = f"{table}:{kind}*" if kind == "struct" else f"{table}:{kind}"
+    with SmaxRedisClient(host, port) as smax_client:
+        if mode == "callback":
+            smax_client.smax_subscribe(name, callback=record)
+        else:
+            smax_client.smax_subscribe(name)
+        time.sleep(0.1)
+        ready.set()
+
+        # Keep receiving for a second after the producer is done.
+        end = None
+        next_sample = time.monotonic()
+        while end is None or time.monotonic() < end:
+            if end is None and done.is_set():
+                end = time.monotonic() + 1.0
+            if time.monotonic() >= next_sample:
+                sample_memory()
+                next_sample += 1.0
+            if mode == "callback":
+                time.sleep(0.05)
+            else:
+                try:
+                    record(smax_client.smax_wait_on_subscribed(name, timeout=0.05))
+                except TimeoutError:
+                    pass
+        sample_memory()
+        smax_client.smax_unsubscribe()
+
+    results.put((latencies, deliveries[0], memory))
+
+
+def run(args, kind, mode, rate):
+    context = multiprocessing.get_context("spawn")
+    ready, done = context.Event(), context.Event()
+    consumer_results, producer_results = context.Queue(), context.Queue()
+
+    consumer = context.Process(target=consume, args=(args.host, args.port, kind, mode, ready, done,
+                                                     consumer_results))
+    consumer.start()
+    ready.wait()
+    producer = context.Process(target=produce, args=(args.host, args.port, kind, rate, args.duration,
+                                                     args.array_size, args.struct_tables, producer_results))
+    producer.start()
+    sent, elapsed = producer_results.get()
+    producer.join()
+    done.set()
+    latencies, deliveries, memory = consumer_results.get()
+    consumer.join()
+    return sent, elapsed, np.array(latencies), deliveries, memory
+
+
+def start_server(port, lua_dir):
+    """Start a redis-server on port, with the SMA-X scripts of lua_dir."""
+    import redis
+    server = subprocess.Popen(["redis-server", "--port", str(port), "--save", "", "--appendonly", "no"],
+                              stdout=subprocess.DEVNULL)
+    r = redis.Redis("localhost", port)
+    for i in range(50):
+        try:
+            r.ping()
+            break
+        except redis.ConnectionError:
+            time.sleep(0.1)
+    for script in sorted(pathlib.Path(lua_dir).glob("*.lua")):
+        r.hset("scripts", script.stem, r.script_load(script.read_text()))
+    r.close()
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="localhost")
+    parser.add_argument("--port", type=int, default=6379)
+    parser.add_argument("--start-server", action="store_true", help="Start a redis-server on --port")
+    parser.add_argument("--lua-dir", help="Directory of the SMA-X LUA scripts, with --start-server")
+    parser.add_argument("--kinds", default="scalar,array,struct")
+    parser.add_argument("--modes", default="callback,wait")
+    parser.add_argument("--rates", default="100,1000", help="Shares per second")
+    parser.add_argument("--duration", type=float, default=5.0, help="Seconds to share for, at each rate")
+    parser.add_argument("--array-size", type=int, default=1000)
+    parser.add_argument("--struct-tables", type=int, default=8)
+    parser.add_argument("--csv", help="File to write the memory of the consumer over time to")
+    args = parser.parse_args()
+
+    server = None
+    if args.start_server:
+        if args.lua_dir is None:
+            parser.error("--start-server needs the SMA-X scripts of --lua-dir")
+        args.host = "localhost"
+        server = start_server(args.port, args.lua_dir)
+
+    rows = []
+    try:
+        print(f"{'kind':<7} {'mode':<9} {'rate/s':>7} {'sent/s':>8} {'recv/s':>8} {'missed':>6} {'extra':>6} "
+              f"{'p50 ms':>8} {'p90 ms':>8} {'p99 ms':>8} {'p99.9 ms':>9} {'max ms':>8} {'RSS MB':>14}")
+        for kind in args.kinds.split(","):
+            for mode in args.modes.split(","):
+                for rate in [float(r) for r in args.rates.split(",")]:
+                    sent, elapsed, latencies, deliveries, memory = run(args, kind, mode, rate)
+                    received = len(latencies)
+                    p50, p90, p99, p999 = (np.percentile(latencies, [50, 90, 99, 99.9]) * 1e3
+                                           if received else [np.nan] * 4)
+                    worst = latencies.max() * 1e3 if received else np.nan
+                    print(f"{kind:<7} {mode:<9} {rate:>7.0f} {sent / elapsed:>8.0f} {received / elapsed:>8.0f} "
+                          f"{sent - received:>6} {deliveries - received:>6} {p50:>8.3f} {p90:>8.3f} {p99:>8.3f} "
+                          f"{p999:>9.3f} {worst:>8.3f} {memory[0][1]:>6.1f} -> {memory[-1][1]:>5.1f}")
+                    rows.extend([kind, mode, rate, t, rss] for t, rss in memory)
+    finally:
+        with SmaxRedisClient(args.host, args.port) as smax_client:
+            smax_client.smax_purge(table + "*")
+        if server is not None:
+            server.terminate()
+            server.wait()
+
+    if args.csv is not None:
+        with open(args.csv, "w", newline="") as csvfile:
+            csv_writer = csv.writer(csvfile)
+            csv_writer.writerow(["Kind", "Mode", "Rate", "Seconds", "Memory_MB"])
+            csv_writer.writerows(rows)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,65 @@
+"""Callback notification latency and idle CPU, blocking vs polling pub/sub.
+
+By default the pub/sub dispatcher thread blocks on its socket until a
+notification arrives. With pubsub_polling=True it instead waits for
+notifications pubsub_sleep (10 ms) at a time, as the callback threads used to.
+For each mode this shares timestamped values, and measures the time from each
+share to its callback, which includes the pull of the value. It then measures
+the CPU time the process uses while idle with subscriptions.
+
+    python pubsub_latency.py [--host localhost] [--shares 500] [--idle 5]
+"""
+import argparse
+import statistics
+import threading
+import time
+
+from smax import SmaxRedisClient
+
+table = "benchmark:pubsub_latency"
+
+
+def run(host, polling, n_shares, idle):
+    latencies = []
+    received = threading.Semaphore(0)
+
+    def callback(data):
+        latencies.append(time.perf_counter() - float(data))
+        received.release()
+
+    with SmaxRedisClient(host, pubsub_polling=polling) as subscriber, SmaxRedisClient(host) as producer:
+        subscriber.smax_subscribe(f"{table}:value", callback=callback)
+        time.sleep(0.1)
+        for i in range(n_shares):
+            producer.smax_share(table, "value", time.perf_counter())
+            received.acquire(timeout=1.0)
+            # Let the dispatcher go idle between notifications
+            time.sleep(0.002)
+
+        cpu = time.process_time()
+        time.sleep(idle)
+        idle_cpu = (time.process_time() - cpu) / idle
+
+    latencies = sorted(latencies)
+    return (statistics.median(latencies), latencies[int(0.99 * (len(latencies) - 1))], latencies[-1],
+            idle_cpu)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--host", default="localhost")
+    parser.add_argument("--shares", type=int, default=500)
+    parser.add_argument("--idle", type=float, default=5.0, help="Seconds to measure idle CPU")
+    args = parser.parse_args()
+
+    for name, polling in [("blocking", False), ("polling", True)]:
+        median, p99, worst, idle_cpu = run(args.host, polling, args.shares, args.idle)
+        print(f"{name:<10} latency median {median*1e3:7.3f} ms   p99 {p99*1e3:7.3f} ms   "
+              f"max {worst*1e3:7.3f} ms   idle CPU {idle_cpu*100:6.3f} %")
+
+    with SmaxRedisClient(args.host) as smax_client:
+        smax_client.smax_purge(table + "*")
+
+
+if __name__ == "__main__":
+    main()
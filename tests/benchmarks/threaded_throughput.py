@@ -0,0 +1,61 @@
+"""Throughput of a single SmaxRedisClient shared between threads.
+
+Compares the client used directly from N threads against the same client
+wrapped in a global lock, which was the only safe way to share it before
+pipelines were made per-thread.
+
+    python threaded_throughput.py [--host localhost] [--ops 2000]
+"""
+import argparse
+import threading
+import time
+
+from smax import SmaxRedisClient
+
+table = "benchmark:threaded_throughput"
+
+
+def run(smax_client, n_threads, n_ops, lock=None):
+    def worker(i):
+        struct = {"a": i, "b": 1.0, "c": "string"}
+        for j in range(n_ops):
+            if lock is not None:
+                with lock:
+                    smax_client.smax_share(f"{table}:t{i}", "struct", struct)
+                    smax_client.smax_pull(f"{table}:t{i}", "struct")
+            else:
+                smax_client.smax_share(f"{table}:t{i}", "struct", struct)
+                smax_client.smax_pull(f"{table}:t{i}", "struct")
+
+    threads = [threading.Thread(target=worker, args=(i,)) for i in range(n_threads)]
+    start = time.perf_counter()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    elapsed = time.perf_counter() - start
+    # Each op is one share and one pull
+    return 2 * n_threads * n_ops / elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--host", default="localhost")
+    parser.add_argument("--ops", type=int, default=2000, help="Total share/pull pairs per run")
+    args = parser.parse_args()
+
+    smax_client = SmaxRedisClient(args.host)
+
+    print(f"{'threads':>8} {'locked ops/s':>14} {'unlocked ops/s':>16}")
+    for n_threads in (1, 2, 4, 8, 16, 32):
+        n_ops = max(args.ops // n_threads, 1)
+        locked = run(smax_client, n_threads, n_ops, lock=threading.Lock())
+        unlocked = run(smax_client, n_threads, n_ops)
+        print(f"{n_threads:>8} {locked:>14.0f} {unlocked:>16.0f}")
+
+    smax_client.smax_purge(table + "*")
+    smax_client.smax_disconnect()
+
+
+if __name__ == "__main__":
+    main()
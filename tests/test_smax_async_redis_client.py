@@ -0,0 +1,183 @@
+import asyncio
+import logging
+import socket
+import time
+
+import numpy as np
+import pytest
+from redis import TimeoutError
+
+from smax import AsyncSmaxRedisClient, SmaxRedisClient, SmaxKeyError, SmaxConnectionError, join
+
+smax_redis_ip = "127.0.0.1"
+
+logger = logging.getLogger()
+logger.setLevel(logging.DEBUG)
+
+test_table = 'pytest_smax_async'
+
+
+def run(coroutine):
+    return asyncio.run(coroutine)
+
+
+def test_async_roundtrip():
+    table = join(test_table, "test_async_roundtrip")
+
+    async def roundtrip():
+        async with AsyncSmaxRedisClient(smax_redis_ip) as s:
+            await s.smax_share(table, "string", "just an async string")
+            await s.smax_share(table, "array", [1.0, 2.0, 3.0])
+            return await s.smax_pull(table, "string"), await s.smax_pull(table, "array")
+
+    string, array = run(roundtrip())
+    assert string == "just an async string"
+    assert string.type == "string"
+    assert string.smaxname == f"{table}:string"
+    assert np.array_equal(array.data, [1.0, 2.0, 3.0])
+    assert array.type == "float64"
+
+
+def test_async_struct():
+    table = join(test_table, "test_async_struct")
+    struct = {"roach2-01": {"temp": 42, "firmware": 1.5}, "roach2-02": {"temp": 24, "firmware": 2.5}}
+
+    async def roundtrip():
+        async with AsyncSmaxRedisClient(smax_redis_ip) as s:
+            await s.smax_share(f"{table}:swarm", "dbe", struct)
+            return await s.smax_pull(f"{table}:swarm", "dbe")
+
+    result = run(roundtrip())
+    assert result["dbe"]["roach2-01"]["temp"] == 42
+    assert result["dbe"]["roach2-02"]["firmware"] == 2.5
+    assert result["dbe"]["roach2-02"]["firmware"].smaxname == f"{table}:swarm:dbe:roach2-02:firmware"
+
+
+def test_async_matches_sync():
+    table = join(test_table, "test_async_matches_sync")
+    with SmaxRedisClient(smax_redis_ip) as s:
+        s.smax_share(table, "int", np.int16(7))
+        s.smax_share(table, "strings", ["a", "b"])
+        expected = [s.smax_pull(table, "int"), s.smax_pull(table, "strings")]
+
+    async def pull():
+        async with AsyncSmaxRedisClient(smax_redis_ip) as s:
+            return [await s.smax_pull(table, "int"), await s.smax_pull(table, "strings")]
+
+    result = run(pull())
+    for r, e in zip(result, expected):
+        assert r == e
+        assert r.type == e.type
+        assert r.dim == e.dim
+        assert r.seq == e.seq
+
+
+def test_async_batch():
+    table = join(test_table, "test_async_batch")
+    values = {f"{table}:value{i}": i for i in range(10)}
+    values[f"{table}:struct"] = {"a": 1, "b": {"c": "nested"}}
+
+    async def roundtrip():
+        async with AsyncSmaxRedisClient(smax_redis_ip) as s:
+            await s.smax_share_batch(values)
+            return await s.smax_pull_batch(list(values.keys()))
+
+    result = run(roundtrip())
+    assert [int(r) for r in result[:10]] == list(range(10))
+    assert result[10]["struct"]["a"] == 1
+    assert result[10]["struct"]["b"]["c"] == "nested"
+
+
+def test_async_batch_loads_scripts():
+    table = join(test_table, "test_async_batch_loads_scripts")
+
+    async def roundtrip():
+        async with AsyncSmaxRedisClient(smax_redis_ip) as s:
+            # Scripts missing from the cache are loaded before the pipeline.
+            s._scripts.pop("HSetWithMeta", None)
+            s._scripts.pop("HGetWithMeta", None)
+            await s.smax_share_batch({f"{table}:value": 1})
+            result = await s.smax_pull_batch([f"{table}:value"])
+            with pytest.raises(SmaxKeyError):
+                await s._execute_pipeline([("NoSuchScript", '0')])
+            return result
+
+    assert int(run(roundtrip())[0]) == 1
+
+
+def test_async_concurrent_pulls():
+    table = join(test_table, "test_async_concurrent_pulls")
+    with SmaxRedisClient(smax_redis_ip) as s:
+        for i in range(20):
+            s.smax_share(table, f"value{i}", i)
+
+    async def pull():
+        async with AsyncSmaxRedisClient(smax_redis_ip) as s:
+            return await asyncio.gather(*[s.smax_pull(table, f"value{i}") for i in range(20)])
+
+    assert [int(r) for r in run(pull())] == list(range(20))
+
+
+def test_async_missing_key():
+    async def pull():
+        async with AsyncSmaxRedisClient(smax_redis_ip) as s:
+            await s.smax_pull(test_table, "this_key_does_not_exist")
+
+    with pytest.raises(SmaxKeyError):
+        run(pull())
+
+
+def test_async_subscribe():
+    table = join(test_table, "test_async_subscribe")
+
+    async def subscribe():
+        async with AsyncSmaxRedisClient(smax_redis_ip) as s:
+            await s.smax_subscribe(f"{table}:*")
+            received = []
+
+            async def consume():
+                async for value in s.smax_iter_subscribed():
+                    received.append(value)
+                    if len(received) == 2:
+                        break
+
+            consumer = asyncio.create_task(consume())
+            await asyncio.sleep(0.1)
+            await s.smax_share(table, "first", 1)
+            await s.smax_share(table, "second", 2)
+            await asyncio.wait_for(consumer, 3.0)
+
+            with pytest.raises(TimeoutError):
+                await s.smax_wait_on_any_subscribed(timeout=0.2)
+            return received
+
+    received = run(subscribe())
+    assert [r.smaxname for r in received] == [f"{table}:first", f"{table}:second"]
+    assert [int(r) for r in received] == [1, 2]
+
+
+def test_async_deadline():
+    # A server that accepts connections but never replies: calls end at their
+    # deadline, rather than after the retries.
+    listener = socket.create_server((smax_redis_ip, 0))
+    port = listener.getsockname()[1]
+
+    async def connect():
+        async with AsyncSmaxRedisClient(smax_redis_ip, port, timeout=0.5):
+            pass
+
+    async def pull():
+        s = AsyncSmaxRedisClient(smax_redis_ip, port)
+        # Scripts already loaded, so that connecting makes no request.
+        s._scripts["HGetWithMeta"] = "0" * 40
+        async with s:
+            await s.smax_pull(test_table, "test_async_deadline", timeout=0.5)
+
+    try:
+        for coroutine in (connect, pull):
+            start = time.monotonic()
+            with pytest.raises(SmaxConnectionError):
+                run(coroutine())
+            assert time.monotonic() - start < 2.0
+    finally:
+        listener.close()
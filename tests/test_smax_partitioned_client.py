@@ -0,0 +1,149 @@
+import logging
+import queue
+import threading
+
+import pytest
+from redis import TimeoutError
+
+from smax import SmaxPartitionedClient, join
+
+smax_redis_ip = "127.0.0.1"
+
+logger = logging.getLogger()
+logger.setLevel(logging.DEBUG)
+
+test_table = 'pytest_smax'
+
+# Both "servers" are the same test server under different names, so that the
+# routing can be tested with a single redis-server.
+servers = [f"{smax_redis_ip}:6379", ("localhost", 6379)]
+
+
+@pytest.fixture
+def smax_client():
+    with SmaxPartitionedClient(servers, logger=logger) as client:
+        yield client
+
+
+def test_server_routing():
+    with SmaxPartitionedClient(servers, table_map={"mapped": "localhost"}) as s:
+        assert set(s.smax_stats()) == {f"{smax_redis_ip}:6379", "localhost:6379"}
+        assert s.smax_server("mapped") == "localhost:6379"
+        assert s.smax_server("mapped:table", "key") == "localhost:6379"
+
+        # All the names of a top-level table are on the same server
+        for i in range(20):
+            top = f"table{i}"
+            server = s.smax_server(top)
+            assert s.smax_server(f"{top}:a:b", "c") == server
+            assert s.smax_server("", top) == server
+
+        # Both servers get some of the tables
+        assert len({s.smax_server(f"table{i}") for i in range(100)}) == 2
+
+    # The hash is stable, so all clients agree on the servers of tables
+    with SmaxPartitionedClient(list(reversed(servers))) as s2, SmaxPartitionedClient(servers) as s3:
+        assert [s2.smax_server(f"table{i}") for i in range(100)] == \
+               [s3.smax_server(f"table{i}") for i in range(100)]
+
+
+def test_partitioned_share_pull(smax_client):
+    table = join(test_table, "test_partitioned_share_pull")
+    smax_client.smax_share(table, "value", 42)
+    smax_client.smax_share(table, "struct", {"a": 1, "b": {"c": "three"}})
+
+    assert smax_client.smax_pull(table, "value") == 42
+    assert smax_client.smax_pull(table, "struct")["struct"]["b"]["c"] == "three"
+
+
+def test_partitioned_batch(smax_client):
+    tables = [join(f"pytest_partitioned{i}", "test_partitioned_batch") for i in range(10)]
+    results = smax_client.smax_share_batch({(table, "value"): i for i, table in enumerate(tables)})
+    # Split over both servers
+    assert len(results) == 2
+
+    values = smax_client.smax_pull_batch([(table, "value") for table in tables])
+    assert [int(v) for v in values] == list(range(10))
+
+
+def test_partitioned_subscribe(smax_client):
+    table = join(test_table, "test_partitioned_subscribe")
+    smax_client.smax_subscribe(f"{table}:*")
+    smax_client.smax_share(table, "value", 1)
+    result = smax_client.smax_wait_on_any_subscribed(timeout=3.0, notification_only=True)
+    assert result["channel"] == f"{table}:value"
+
+    # Patterns with a wildcard top-level table are subscribed on all servers
+    smax_client.smax_unsubscribe()
+    smax_client.smax_subscribe("pytest_partitioned*")
+    assert all(client._has_wait_subscriptions() for client in smax_client._shards.values())
+    smax_client.smax_share("pytest_partitioned7", "test_partitioned_subscribe", 7)
+    result = smax_client.smax_wait_on_subscribed("pytest_partitioned*", timeout=3.0, notification_only=True)
+    assert result["channel"] == "pytest_partitioned7:test_partitioned_subscribe"
+
+    # With nothing subscribed, waiting fails at once rather than forever.
+    smax_client.smax_unsubscribe()
+    with pytest.raises(RuntimeError, match="smax_subscribe"):
+        smax_client.smax_wait_on_any_subscribed()
+
+
+def test_partitioned_purge(smax_client):
+    tables = [join(f"pytest_partitioned{i}", "test_partitioned_purge") for i in range(4)]
+    for table in tables:
+        smax_client.smax_share(table, "value", 1)
+    # Both "servers" are the same, so the first purges all the keys, and the
+    # second none.
+    assert [shard.smax_purge("pytest_partitioned*:test_partitioned_purge")
+            for shard in smax_client._shards.values()] == [4, 0]
+
+    # Fanned out to both servers, which find the keys once between them
+    for table in tables:
+        smax_client.smax_share(table, "value", 1)
+    assert smax_client.smax_purge("pytest_partitioned*:test_partitioned_purge") == 4
+
+
+def test_partitioned_wait_many_servers(smax_client):
+    # The connections to both servers are watched at once.
+    smax_client.smax_subscribe("pytest_partitioned*")
+    assert all(client._has_wait_subscriptions() for client in smax_client._shards.values())
+    for i in range(10):
+        table = join(f"pytest_partitioned{i}", "test_partitioned_wait_many_servers")
+        smax_client.smax_share(table, "value", i)
+        # Both "servers" are the same, so the pattern is notified on both.
+        for server in range(2):
+            result = smax_client.smax_wait_on_any_subscribed(timeout=3.0, notification_only=True)
+            assert result["channel"] == f"{table}:value"
+    with pytest.raises(TimeoutError):
+        smax_client.smax_wait_on_any_subscribed(timeout=0.1)
+
+
+def test_partitioned_wait_other_thread(smax_client):
+    # Subscriptions made in one thread are waited on from another.
+    smax_client.smax_subscribe("pytest_partitioned*")
+    table = join("pytest_partitioned3", "test_partitioned_wait_other_thread")
+    results = queue.Queue()
+
+    def waiter():
+        try:
+            for server in range(2):
+                results.put(smax_client.smax_wait_on_any_subscribed(timeout=3.0, notification_only=True))
+        except Exception as e:
+            results.put(e)
+
+    thread = threading.Thread(target=waiter)
+    thread.start()
+    # The waiting thread subscribes its own pub/sub connections when it first waits.
+    while thread.is_alive() and results.empty():
+        smax_client.smax_share(table, "value", 1)
+        thread.join(timeout=0.2)
+    thread.join()
+    result = results.get()
+    assert not isinstance(result, Exception)
+    assert result["channel"] == f"{table}:value"
+
+
+def test_partitioned_metadata(smax_client):
+    table = join(test_table, "test_partitioned_metadata")
+    smax_client.smax_share(table, "value", 1)
+    smax_client.smax_set_coordinate_system(f"{table}:value", "FK5")
+    assert smax_client.smax_get_coordinate_system(f"{table}:value") == "FK5"
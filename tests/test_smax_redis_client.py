@@ -5,12 +5,26 @@ import logging
 
 import psutil
 import os
+import pickle
+from fnmatch import fnmatchcase
+import queue
+import shutil
 import subprocess
+import sys
+import time
+import multiprocessing
 import numpy as np
 import pytest
 from redis import TimeoutError
+from redis.exceptions import ResponseError, ConnectionError as RedisConnectionError
 
-from smax import SmaxRedisClient, _TYPE_MAP, _REVERSE_TYPE_MAP, print_smax, join
+from smax import SmaxRedisClient, SmaxClientConfig, SmaxKeyError, SmaxConnectionError, smax_unavailable, _TYPE_MAP, _REVERSE_TYPE_MAP, print_smax, join
+from smax import smax_redis_client
+from smax.smax_callback_dispatcher import SmaxCallbackDispatcher
+from smax.smax_auto_pipeline import SmaxAutoPipeline
+from smax.smax_connection_pool import create_connection_pool, deadline, SmaxReplyTimeout
+from smax.smax_pubsub_hub import SmaxPubSubHub
+from smax.smax_channel_matcher import SmaxChannelMatcher, channel_name, channel_pair
 
 smax_redis_ip = "127.0.0.1"
 
@@ -19,6 +33,15 @@ logger.setLevel(logging.DEBUG)
 
 logger.debug("In test_smax_redis_client.py")
 
+
+def wait_until(condition, timeout=5.0):
+    """Wait for a condition of the threads of the clients, failing at the timeout."""
+    end = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < end, "Timed out waiting for the condition"
+        sleep(0.01)
+
+
 @pytest.fixture
 def smax_client():
     logger.debug("In test_smax_redis_client.py:smax_client test fixture")
@@ -605,6 +628,108 @@ def test_pubsub_pattern_callback(smax_client):
     assert actual["value"] == expected_value
 
 
+def test_pubsub_incremental(smax_client):
+    table = join(test_table, "test_pubsub_incremental")
+    struct = {"dbe": {"roach2-01": {"temp": 1.0, "firmware": "a"},
+                      "roach2-02": {"temp": 2.0, "firmware": "b"}},
+              "mode": 0}
+    smax_client.smax_purge(f"{table}*")
+    smax_client.smax_share(table, "swarm", struct)
+
+    updates = queue.SimpleQueue()
+
+    def callback(tree, changed):
+        updates.put((tree["swarm"]["dbe"]["roach2-01"]["temp"], tree["swarm"]["dbe"]["roach2-02"]["temp"],
+                     tree["swarm"]["mode"], sorted(changed)))
+
+    with pytest.raises(ValueError):
+        smax_client.smax_subscribe(f"{table}:*:swarm*", callback=callback, incremental=True)
+
+    smax_client.smax_subscribe(f"{table}:swarm*", callback=callback, incremental=True)
+    smax_client.smax_subscribe(f"{table}:swarm*", incremental=True)
+    sleep(0.1)
+
+    with SmaxRedisClient("localhost") as smax_producer:
+        # The first notification pulls the whole struct
+        smax_producer.smax_share(f"{table}:swarm:dbe:roach2-01", "temp", 3.0)
+        assert updates.get(timeout=1.0) == (3.0, 2.0, 0, [""])
+        tree, changed = smax_client.smax_wait_on_subscribed(f"{table}:swarm*", timeout=1.0, incremental=True)
+        assert changed == [""]
+
+        # Then only the notified leaves and tables
+        smax_producer.smax_share(f"{table}:swarm:dbe:roach2-02", "temp", 4.0)
+        assert updates.get(timeout=1.0) == (3.0, 4.0, 0, ["dbe:roach2-02:temp"])
+        smax_producer.smax_share(f"{table}:swarm:dbe", "roach2-01", {"temp": 5.0, "firmware": "a"})
+        assert updates.get(timeout=1.0) == (5.0, 4.0, 0, ["dbe:roach2-01:firmware", "dbe:roach2-01:temp"])
+        smax_producer.smax_share(f"{table}:swarm", "mode", 1)
+        assert updates.get(timeout=1.0) == (5.0, 4.0, 1, ["mode"])
+
+        # New tables are added
+        smax_producer.smax_share(f"{table}:swarm:dbe", "roach2-03", {"temp": 6.0})
+        assert updates.get(timeout=1.0)[3] == ["dbe:roach2-03"]
+
+        tree, changed = smax_client.smax_wait_on_subscribed(f"{table}:swarm*", timeout=1.0, incremental=True)
+        assert changed == ["dbe:roach2-02:temp"]
+
+    # The notifications of the parent tables changed nothing
+    sleep(0.2)
+    assert updates.empty()
+    stats = smax_client.smax_stats()["incremental"]
+    assert stats["subscriptions"] == 2
+    assert stats["full_pulls"] == 2
+    assert stats["unchanged"] > 0
+
+
+@pytest.mark.parametrize("incremental", [False, True])
+def test_pubsub_group_structs(incremental):
+    table = join(test_table, f"test_pubsub_group_structs_{incremental}")
+    struct = {"dbe": {"roach2-01": {"temp": 1.0}, "roach2-02": {"temp": 2.0}}, "mode": 0}
+    updates = queue.SimpleQueue()
+    notifications = []
+
+    def callback(tree, changed=None):
+        updates.put((tree["swarm"]["dbe"]["roach2-01"]["temp"], tree["swarm"]["mode"], changed))
+
+    with SmaxRedisClient("localhost") as s, SmaxRedisClient("localhost") as producer:
+        producer.smax_purge(f"{table}*")
+        producer.smax_share(table, "swarm", struct)
+        s.smax_subscribe(f"{table}:swarm*", callback=callback, incremental=incremental, group_structs=True)
+        s.smax_subscribe(f"{table}:swarm*", callback=notifications.append)
+        sleep(0.1)
+
+        # One event for the four tables and the two parents notified by a share
+        struct["dbe"]["roach2-01"]["temp"] = 3.0
+        struct["mode"] = 1
+        producer.smax_share(table, "swarm", struct)
+        temp, mode, changed = updates.get(timeout=1.0)
+        assert (temp, mode) == (3.0, 1)
+        if incremental:
+            assert changed == [""]
+        struct["dbe"]["roach2-01"]["temp"] = 4.0
+        producer.smax_share(table, "swarm", struct)
+        temp, mode, changed = updates.get(timeout=1.0)
+        assert temp == 4.0
+        if incremental:
+            # All the leaves were shared again, in a single call
+            assert sorted(changed) == ["dbe:roach2-01:temp", "dbe:roach2-02:temp", "mode"]
+
+        # Scalar shares are delivered after the timeout
+        producer.smax_share(f"{table}:swarm", "mode", 2)
+        assert updates.get(timeout=1.0)[1] == 2
+        sleep(0.2)
+        assert updates.empty()
+        assert len(notifications) == 13
+
+        stats = {(st["pattern"], "events" in st): st for st in s.smax_stats()["subscriptions"]}
+        stats = stats[(f"{table}:swarm*", True)]
+        assert stats["notifications"] == 13
+        assert stats["events"] == 3
+        assert stats["timeouts"] == 1
+
+        with pytest.raises(ValueError):
+            s.smax_subscribe(f"{table}:swarm", callback=callback, group_structs=True)
+
+
 def test_pubsub_callback(smax_client):
     expected_value = np.int32(42)
 
@@ -700,6 +825,583 @@ def test_mixed_pubsub_callback(smax_client):
     assert actual1["value1"] == expected_value1
 
 
+def test_pubsub_dispatcher_thread():
+    table = join(test_table, "test_pubsub_dispatcher_thread")
+    received = {}
+
+    def callback(data):
+        received.setdefault(data.smaxname, []).append(int(data))
+
+    def second_callback(data):
+        received.setdefault("second", []).append(int(data))
+
+    before = set(threading.enumerate())
+    with SmaxRedisClient("localhost") as s:
+        for i in range(20):
+            s.smax_subscribe(f"{table}:key{i}", callback=callback)
+        s.smax_subscribe(f"{table}:key0", callback=second_callback)
+        threads = [t for t in threading.enumerate() if t.name == "smax-pubsub" and t not in before]
+        assert len(threads) == 1
+        assert s.smax_stats()["pubsub"]["channels"] == 20
+
+        for i in range(20):
+            s.smax_share(table, f"key{i}", i)
+        sleep(0.5)
+        assert received[f"{table}:key19"] == [19]
+        assert received[f"{table}:key0"] == [0]
+        assert received["second"] == [0]
+
+        # Unsubscribing a callback leaves the others
+        s.smax_unsubscribe(f"{table}:key0", callback=callback)
+        s.smax_unsubscribe(f"{table}:key1", callback=callback)
+        assert s.smax_stats()["pubsub"]["channels"] == 19
+        s.smax_share(table, "key0", 100)
+        s.smax_share(table, "key1", 100)
+        s.smax_share(table, "key2", 100)
+        sleep(0.5)
+        assert received[f"{table}:key0"] == [0]
+        assert received[f"{table}:key1"] == [1]
+        assert received[f"{table}:key2"] == [2, 100]
+        assert received["second"] == [0, 100]
+
+        # Subscribing again at runtime
+        s.smax_subscribe(f"{table}:key1", callback=callback)
+        s.smax_share(table, "key1", 101)
+        sleep(0.5)
+        assert received[f"{table}:key1"] == [1, 101]
+
+    assert not threads[0].is_alive()
+
+
+def test_shared_pubsub():
+    table = join(test_table, "test_shared_pubsub")
+    received = {"a": [], "b": [], "c": []}
+
+    def callback_a(data):
+        received["a"].append(int(data))
+
+    before = set(threading.enumerate())
+    a = SmaxRedisClient(smax_redis_ip, shared_pubsub=True)
+    b = SmaxRedisClient(smax_redis_ip, shared_pubsub=True)
+    with SmaxRedisClient(smax_redis_ip, shared_pubsub=True) as c:
+        a.smax_subscribe(f"{table}:value", callback=callback_a)
+        b.smax_subscribe(f"{table}:value", callback=lambda data: received["b"].append(int(data)))
+        c.smax_subscribe(f"{table}:*", callback=lambda data: received["c"].append(int(data["test_shared_pubsub"]["value"])))
+        threads = [t for t in threading.enumerate() if t.name == "smax-pubsub" and t not in before]
+        assert len(threads) == 1
+        stats = a.smax_stats()["pubsub"]
+        assert stats["channels"] == 1
+        assert stats["shared"] == 3
+
+        c.smax_share(table, "value", 1)
+        wait_until(lambda: received == {"a": [1], "b": [1], "c": [1]})
+        # One message per subscribed channel and pattern, for all the clients
+        assert c.smax_stats()["pubsub"]["messages"] == 2
+
+        # Unsubscribing, or disconnecting, a client leaves the others subscribed
+        a.smax_unsubscribe(f"{table}:value", callback=callback_a)
+        b.smax_disconnect()
+        c.smax_share(table, "value", 2)
+        wait_until(lambda: received["c"] == [1, 2])
+        assert received == {"a": [1], "b": [1], "c": [1, 2]}
+        assert c.smax_stats()["pubsub"]["shared"] == 2
+        a.smax_disconnect()
+        assert threads[0].is_alive()
+
+    # Closed with the last client
+    threads[0].join(5.0)
+    assert not threads[0].is_alive()
+
+    # A polling dispatcher waits for the shortest sleep_time of its hubs
+    a = SmaxPubSubHub(smax_redis_ip, 6379, 0, sleep_time=0.05, polling=True)
+    b = SmaxPubSubHub(smax_redis_ip, 6379, 0, sleep_time=0.01, polling=True)
+    assert a._dispatcher is b._dispatcher
+    a.subscribe(f"smax:{table}:value", "a", lambda message: None)
+    assert a._dispatcher._sleep_time == 0.05
+    b.subscribe(f"smax:{table}:value", "b", lambda message: None)
+    assert a._dispatcher._sleep_time == 0.01
+    a.close()
+    b.close()
+
+
+@pytest.mark.parametrize("pubsub_polling", [False, True])
+def test_pubsub_blocking(pubsub_polling):
+    table = join(test_table, "test_pubsub_blocking")
+    received = threading.Event()
+
+    with SmaxRedisClient("localhost", pubsub_polling=pubsub_polling) as s:
+        s.smax_subscribe(f"{table}:value", callback=lambda data: received.set())
+
+        # Count the wakeups of the dispatcher thread while idle
+        pubsub = s._callback_pubsub._pubsub
+        get_message = pubsub.get_message
+        calls = []
+        pubsub.get_message = lambda *args, **kwargs: calls.append(1) or get_message(*args, **kwargs)
+        sleep(0.3)
+        if pubsub_polling:
+            assert len(calls) > 10
+        else:
+            assert len(calls) <= 2
+
+        s.smax_share(table, "value", 1)
+        assert received.wait(1.0)
+
+
+def test_coalesce_notifications():
+    table = join(test_table, "test_coalesce_notifications")
+    received = []
+
+    def slow_callback(data):
+        received.append(int(data))
+        sleep(0.1)
+
+    with SmaxRedisClient("localhost", coalesce_notifications=True) as s:
+        s.smax_subscribe(f"{table}:value", callback=slow_callback)
+        sleep(0.1)
+        for i in range(20):
+            s.smax_share(table, "value", i)
+        for i in range(300):
+            if received and received[-1] == 19:
+                break
+            sleep(0.01)
+
+        # The callback kept up with the newest value, skipping the others
+        assert received[-1] == 19
+        assert len(received) < 10
+        assert received == sorted(received)
+        stats = s.smax_stats()["pubsub"]
+        assert stats["coalesced"] > 0
+        assert stats["messages"] + stats["coalesced"] == 20
+
+
+def test_callback_workers():
+    table = join(test_table, "test_callback_workers")
+    slow_started = threading.Event()
+    slow_done = threading.Event()
+    fast_done = threading.Event()
+    ordered = []
+
+    def slow_callback(data):
+        slow_started.set()
+        sleep(1)
+        slow_done.set()
+
+    def ordered_callback(data):
+        ordered.append(int(data))
+        sleep(0.01)
+
+    with SmaxRedisClient("localhost", callback_workers=2) as s:
+        s.smax_subscribe(f"{table}:slow", callback=slow_callback)
+        s.smax_subscribe(f"{table}:fast", callback=lambda data: fast_done.set())
+        sleep(.1)
+
+        # A slow callback does not hold up the others
+        s.smax_share(table, "slow", 1)
+        assert slow_started.wait(3.0)
+        s.smax_share(table, "fast", 1)
+        assert fast_done.wait(0.5)
+        assert not slow_done.is_set()
+        assert slow_done.wait(3.0)
+        assert s.smax_stats()["callbacks"]["max_run_time"] >= 1.0
+
+    with SmaxRedisClient("localhost", callback_workers=2) as s:
+        s.smax_subscribe(f"{table}:ordered", callback=ordered_callback)
+        sleep(.1)
+
+        # The notifications of a name are handled in order, possibly coalesced
+        for i in range(20):
+            s.smax_share(table, "ordered", i)
+        for i in range(300):
+            if ordered and ordered[-1] == 19:
+                break
+            sleep(0.01)
+        assert ordered == sorted(ordered)
+        assert ordered[-1] == 19
+
+        stats = s.smax_stats()["callbacks"]
+        assert stats["completed"] + stats["coalesced"] + stats["queue_depth"] <= stats["dispatched"]
+        assert stats["errors"] == 0
+
+
+@pytest.mark.parametrize("policy, expected, dropped, coalesced", [
+    ("drop_newest", [1, 2], 2, 0),
+    ("drop_oldest", [3, 4], 2, 0),
+    ("coalesce", [3, 4], 1, 1),
+    ("block", [1, 2, 3, 4], 0, 0),
+])
+def test_callback_queue_policy(policy, expected, dropped, coalesced):
+    gate = threading.Event()
+    started = threading.Event()
+    calls = []
+
+    def blocked():
+        started.set()
+        gate.wait()
+
+    dispatcher = SmaxCallbackDispatcher(workers=1, max_queue=2, policy=policy)
+    dispatcher.submit("a", blocked)
+    assert started.wait(1.0)
+
+    # The worker is busy, so these queue up, two at most
+    def submit_all():
+        for key, value in [("b", 1), ("c", 2), ("b", 3), ("d", 4)]:
+            dispatcher.submit(key, calls.append, value)
+
+    producer = threading.Thread(target=submit_all)
+    producer.start()
+    producer.join(0.5)
+    assert producer.is_alive() == (policy == "block")
+
+    gate.set()
+    producer.join()
+    dispatcher.close()
+    assert calls == expected
+    stats = dispatcher.stats()
+    assert stats["dropped"] == dropped
+    assert stats["coalesced"] == coalesced
+    assert stats["max_queue_depth"] == 2
+
+
+@pytest.mark.parametrize("policy, processed, dropped, coalesced, max_queue_depth",
+                         [("drop_oldest", 3, 1, 0, 3), ("coalesce", 2, 0, 2, 2), ("block", 4, 0, 0, 2)])
+def test_subscription_lag(policy, processed, dropped, coalesced, max_queue_depth):
+    table = join(test_table, "test_subscription_lag")
+    calls = queue.Queue()
+    gate = threading.Semaphore(0)
+
+    def slow_callback(data):
+        calls.put(int(data))
+        gate.acquire()
+
+    def monitor():
+        return s.smax_stats()["subscriptions"][0]
+
+    with SmaxRedisClient(smax_redis_ip, callback_workers=1, callback_queue_policy="block") as s:
+        with pytest.raises(ValueError):
+            s.smax_subscribe(f"{table}:key", lag_threshold=0.02)
+        with pytest.raises(ValueError):
+            s.smax_subscribe(f"{table}:key", callback=slow_callback, lag_threshold=0.02, lag_policy="unknown")
+        # Load the scripts before subscribing, to deliver the first value on time
+        s.smax_share(table, "key", -1)
+        s.smax_pull(table, "key")
+        s.smax_subscribe(f"{table}:key", callback=slow_callback, lag_threshold=0.2, lag_policy=policy)
+
+        # The first value is delivered on time, and its callback holds the worker
+        s.smax_share(table, "key", 0)
+        assert calls.get(timeout=5.0) == 0
+        s.smax_share(table, "key", 1)
+        wait_until(lambda: monitor()["received"] == 2)
+        # ...so that the next one is delivered late, and the subscription lags
+        sleep(0.3)
+        gate.release()
+        assert calls.get(timeout=5.0) == 1
+        assert monitor()["lagging"]
+
+        # Notifications received while lagging, with a callback running
+        s.smax_share(table, "key", 2)
+        s.smax_share(table, "key", 3)
+        # The pub/sub thread of the block policy waits for the callback
+        wait_until(lambda: monitor()["received"] == (3 if policy == "block" else 4))
+        gate.release(10)
+        wait_until(lambda: monitor()["received"] == 4 and monitor()["queue_depth"] == 0)
+
+        m = monitor()
+    assert m["pattern"] == f"{table}:key"
+    assert (m["processed"], m["dropped"], m["coalesced"]) == (processed, dropped, coalesced)
+    assert m["max_queue_depth"] == max_queue_depth
+    assert m["max_lag"] > 0.3
+    assert calls.qsize() == processed - 2
+
+    with pytest.raises(ValueError):
+        SmaxRedisClient(smax_redis_ip, callback_workers=1, callback_queue_policy="block", shared_pubsub=True)
+    with SmaxRedisClient(smax_redis_ip, callback_workers=1, shared_pubsub=True) as s:
+        with pytest.raises(ValueError):
+            s.smax_subscribe(f"{table}:key", callback=slow_callback, lag_threshold=0.02, lag_policy="block")
+
+
+def test_subscription_lag_incremental():
+    table = join(test_table, "test_subscription_lag_incremental")
+    received = threading.Event()
+
+    with SmaxRedisClient(smax_redis_ip) as s:
+        s.smax_share(table, "struct", {"a": 1, "b": 2})
+        s.smax_subscribe(f"{table}:struct*", callback=lambda tree, changed: received.set(), incremental=True)
+        s.smax_share(table, "struct", {"a": 3, "b": 2})
+        assert received.wait(5.0)
+        m = s.smax_stats()["subscriptions"][0]
+    assert m["lag"] is not None
+    assert m["max_lag"] >= m["lag"]
+
+
+def test_sequence_gaps():
+    table = join(test_table, "test_sequence_gaps")
+    gaps = []
+
+    with SmaxRedisClient(smax_redis_ip, track_sequences=True,
+                         on_sequence_gap=lambda *gap: gaps.append(gap)) as s, \
+            SmaxRedisClient(smax_redis_ip) as producer:
+        s.smax_subscribe(f"{table}:key")
+        s.smax_subscribe(f"{table}:struct")
+        wait_until(lambda: producer._client.pubsub_numsub(f"smax:{table}:key", f"smax:{table}:struct") ==
+                   [(f"smax:{table}:key".encode(), 1), (f"smax:{table}:struct".encode(), 1)])
+
+        producer.smax_share(table, "key", 1)
+        first = s.smax_wait_on_subscribed(f"{table}:key", timeout=5.0)
+        assert s.smax_missed_updates() == {}
+
+        # Two updates shared before the next pull, so one is missed
+        producer.smax_share(table, "key", 2)
+        producer.smax_share(table, "key", 3)
+        value = s.smax_wait_on_subscribed(f"{table}:key", timeout=5.0)
+        assert value.seq == first.seq + 2
+        assert s.smax_missed_updates() == {f"{table}:key": 1}
+        assert gaps == [(f"{table}:key", first.seq, value.seq)]
+
+        # No gap for the value pulled again
+        s.smax_wait_on_subscribed(f"{table}:key", timeout=5.0)
+        assert len(gaps) == 1
+
+        # Leaves of structs
+        producer.smax_share(table, "struct", {"a": 1, "b": 2})
+        s.smax_wait_on_many(window=0.1, timeout=5.0, pattern=f"{table}:struct")
+        producer.smax_share(table, "struct", {"a": 1, "b": 2})
+        producer.smax_share(table, "struct", {"a": 1, "b": 2})
+        s.smax_wait_on_many(window=0.1, timeout=5.0, pattern=f"{table}:struct")
+        assert s.smax_missed_updates() == {f"{table}:key": 1, f"{table}:struct:a": 1, f"{table}:struct:b": 1}
+
+        stats = s.smax_stats()["sequences"]
+        assert stats["gaps"] == 3
+        assert stats["missed"] == 3
+
+    with SmaxRedisClient(smax_redis_ip) as s:
+        with pytest.raises(RuntimeError):
+            s.smax_missed_updates()
+
+
+def test_deadband(smax_client):
+    table = join(test_table, "test_deadband")
+    temps = []
+    arrays = []
+    modes = []
+
+    smax_client.smax_subscribe(f"{table}:temp", callback=lambda data: temps.append(float(data)), deadband=0.5)
+    smax_client.smax_subscribe(f"{table}:array", callback=lambda data: arrays.append(list(data)),
+                               relative_deadband=0.1)
+    smax_client.smax_subscribe(f"{table}:mode", callback=lambda data: modes.append(str(data)), deadband=1.0)
+    sleep(0.1)
+
+    # Each value is compared to the last one delivered, so drifts add up
+    for temp in [20.0, 20.2, 20.4, 20.6, 19.9, 21.0, 21.4]:
+        smax_client.smax_share(table, "temp", temp)
+        sleep(0.05)
+    for array in [[10.0, 100.0], [10.5, 105.0], [10.5, 115.0], [10.5, 115.0, 1.0]]:
+        smax_client.smax_share(table, "array", array)
+        sleep(0.05)
+    for mode in ["observe", "observe", "stow"]:
+        smax_client.smax_share(table, "mode", mode)
+        sleep(0.05)
+    sleep(0.2)
+
+    assert temps == [20.0, 20.6, 19.9, 21.0]
+    assert arrays == [[10.0, 100.0], [10.5, 115.0], [10.5, 115.0, 1.0]]
+    assert modes == ["observe", "stow"]
+    stats = {s["pattern"]: s for s in smax_client.smax_stats()["subscriptions"]}
+    assert stats[f"{table}:temp"]["checked"] == 7
+    assert stats[f"{table}:temp"]["suppressed"] == 3
+
+    with pytest.raises(ValueError):
+        smax_client.smax_subscribe(f"{table}:temp", deadband=0.5)
+    with pytest.raises(ValueError):
+        smax_client.smax_subscribe(f"{table}:temp", callback=print, deadband=-1)
+
+
+def test_wait_on_many(smax_client):
+    table = join(test_table, "test_wait_on_many")
+    smax_client.smax_subscribe(f"{table}:*")
+    sleep(.1)
+
+    with pytest.raises(TimeoutError):
+        smax_client.smax_wait_on_many(timeout=0.1)
+
+    with SmaxRedisClient("localhost") as producer:
+        for i in range(5):
+            producer.smax_share(table, f"key{i}", i)
+        producer.smax_share(table, "key0", 10)
+        producer.smax_share(table, "struct", {"a": 1})
+
+        updates = smax_client.smax_wait_on_many(window=0.2, timeout=1.0)
+        assert list(updates) == [f"{table}:key{i}" for i in range(5)] + [f"{table}:struct"]
+        assert updates[f"{table}:key0"] == 10
+        assert updates[f"{table}:key4"] == 4
+        assert updates[f"{table}:struct"]["struct"]["a"] == 1
+
+        # Limited number of names, and pattern
+        for i in range(5):
+            producer.smax_share(table, f"key{i}", i)
+        updates = smax_client.smax_wait_on_many(max_items=2, window=0.2, timeout=1.0)
+        assert list(updates) == [f"{table}:key0", f"{table}:key1"]
+        updates = smax_client.smax_wait_on_many(window=0.2, timeout=1.0, pattern=f"{table}:key[34]",
+                                                notification_only=True)
+        assert list(updates) == [f"{table}:key3", f"{table}:key4"]
+        assert updates[f"{table}:key3"]["channel"] == f"{table}:key3"
+
+        # Several patterns
+        for i in range(5):
+            producer.smax_share(table, f"key{i}", i)
+        updates = smax_client.smax_wait_on_many(window=0.2, timeout=1.0, pattern=[f"{table}:key1", f"{table}:key[34]"])
+        assert list(updates) == [f"{table}:key1", f"{table}:key3", f"{table}:key4"]
+
+        # Notifications that do not match the pattern do not restart the timeout.
+        stop = threading.Event()
+
+        def produce():
+            while not stop.wait(0.05):
+                producer.smax_share(table, "key0", 0)
+
+        thread = threading.Thread(target=produce)
+        thread.start()
+        try:
+            start = time.monotonic()
+            with pytest.raises(TimeoutError):
+                smax_client.smax_wait_on_many(timeout=0.3, pattern=f"{table}:key9")
+            with pytest.raises(TimeoutError):
+                smax_client.smax_wait_on_subscribed(f"{table}:key9", timeout=0.3)
+            assert time.monotonic() - start < 1.5
+        finally:
+            stop.set()
+            thread.join()
+
+    # Waiting without a subscription raises a clear error.
+    with SmaxRedisClient(smax_redis_ip) as s:
+        with pytest.raises(RuntimeError, match="smax_subscribe"):
+            s.smax_wait_on_many(timeout=0.1)
+        with pytest.raises(RuntimeError, match="smax_subscribe"):
+            s.smax_wait_on_any_subscribed(timeout=0.1)
+
+
+def test_channel_matcher():
+    patterns = ["weather:wind*", "weather:*:temp", "weather:rain", "*:status", "antenna:?:pos[xy]"]
+    matcher = SmaxChannelMatcher(patterns)
+    names = ["weather:wind", "weather:windspeed:avg", "weather:out:temp", "weather:rain", "weather:rainfall",
+             "antenna:1:status", "antenna:1:posx", "antenna:12:posx", "antenna:1:posz", "temp"]
+    for name in names:
+        assert sorted(matcher.match(name)) == sorted(p for p in patterns if fnmatchcase(name, p))
+        assert matcher.matches(name) == any(fnmatchcase(name, p) for p in patterns)
+
+    matcher.remove("weather:wind*")
+    matcher.remove("weather:rain")
+    assert not matcher.matches("weather:wind")
+    assert not matcher.matches("weather:rain")
+    assert matcher.match("weather:wind:status") == ["*:status"]
+
+    assert channel_name(b"smax:weather:wind", "smax") == "weather:wind"
+    assert channel_name(b"other:weather:wind", "smax") is None
+    assert channel_pair(b"smax:weather:wind:speed", "smax") == ("weather:wind", "speed")
+
+
+def test_stream():
+    table = join(test_table, "test_stream")
+    with SmaxRedisClient("localhost") as s:
+        with s.smax_stream([f"{table}:a*", f"{table}:b"], timeout=1.0) as stream:
+            sleep(0.1)
+            s.smax_share(table, "a1", 1)
+            s.smax_share(table, "b", "two")
+            s.smax_share(table, "c", 3)
+            assert next(stream) == (f"{table}:a1", 1)
+            assert next(stream) == (f"{table}:b", "two")
+            assert stream.backlog() == 0
+
+        # Closed, so the share is not seen and the iteration ends
+        s.smax_share(table, "a1", 4)
+        assert list(stream) == []
+
+        # Batched pulls, and notifications only
+        with s.smax_stream(f"{table}:*", batch=10, timeout=0.5) as stream:
+            sleep(0.1)
+            for i in range(5):
+                s.smax_share(table, f"a{i}", i)
+            sleep(0.2)
+            assert stream.backlog() == 5
+            assert list(stream) == [(f"{table}:a{i}", i) for i in range(5)]
+
+        with s.smax_stream(f"{table}:*", pull=False, timeout=0.5) as stream:
+            sleep(0.1)
+            s.smax_share(table, "a1", 1)
+            name, notification = next(stream)
+            assert name == f"{table}:a1"
+            assert notification["channel"] == name
+
+        # Closing from another thread ends a blocked iteration
+        stream = s.smax_stream(f"{table}:*")
+        threading.Timer(0.2, stream.close).start()
+        assert list(stream) == []
+
+        # A bounded backlog drops the oldest notifications, and names deleted
+        # before they are pulled are skipped.
+        with s.smax_stream(f"{table}:*", batch=10, timeout=0.5, max_backlog=3) as stream:
+            sleep(0.1)
+            for i in range(5):
+                s.smax_share(table, f"d{i}", i)
+            s._client.hdel(table, "d3")
+            for i in range(50):
+                if stream.backlog() == 3 and stream.stats()["dropped"] == 2:
+                    break
+                sleep(0.02)
+            assert list(stream) == [(f"{table}:d2", 2), (f"{table}:d4", 4)]
+            assert stream.stats() == {"backlog": 0, "dropped": 2, "missing": 1}
+
+        with pytest.raises(ValueError):
+            s.smax_stream(f"{table}:*", backlog_policy="block")
+
+
+def test_stream_async():
+    import asyncio
+    table = join(test_table, "test_stream_async")
+
+    async def consume(stream):
+        return [update async for update in stream]
+
+    with SmaxRedisClient("localhost") as s:
+        with s.smax_stream(f"{table}:*", timeout=0.5) as stream:
+            sleep(0.1)
+            s.smax_share(table, "a", 1)
+            s.smax_share(table, "b", 2)
+            assert asyncio.run(consume(stream)) == [(f"{table}:a", 1), (f"{table}:b", 2)]
+
+        # An iteration cancelled while waiting, or while pulling, loses no update.
+        with s.smax_stream(f"{table}:*", timeout=0.5) as stream:
+            sleep(0.1)
+            pull = stream._updates
+
+            def slow_pull(messages):
+                sleep(0.3)
+                return pull(messages)
+
+            async def cancelled():
+                with pytest.raises(asyncio.TimeoutError):
+                    await asyncio.wait_for(stream.__anext__(), 0.1)
+                s.smax_share(table, "c", 3)
+                stream._updates = slow_pull
+                with pytest.raises(asyncio.TimeoutError):
+                    await asyncio.wait_for(stream.__anext__(), 0.1)
+                stream._updates = pull
+                return await consume(stream)
+
+            assert asyncio.run(cancelled()) == [(f"{table}:c", 3)]
+
+        # Concurrent consumers each get some of the updates, once.
+        with s.smax_stream(f"{table}:*", timeout=0.5) as stream:
+            sleep(0.1)
+            for i in range(10):
+                s.smax_share(table, f"d{i}", i)
+
+            async def consumers():
+                return await asyncio.gather(consume(stream), consume(stream))
+
+            updates = [update for updates in asyncio.run(consumers()) for update in updates]
+            assert sorted(updates) == [(f"{table}:d{i}", i) for i in range(10)]
+
+
 def test_pull_struct(smax_client):
     expected_temp_value1 = np.array([42, 24], dtype=np.int32)
     expected_temp_value2 = np.array([24, 42], dtype=np.int32)
@@ -908,3 +1610,781 @@ def test_units_meta(smax_client):
     # Now pull just metadata.
     result = smax_client.smax_get_units(f"{table}:{key}")
     assert result == expected_value
+
+
+def test_threaded_share_pull(smax_client):
+    # Hammer a single client from many threads, mixing pipelined struct shares
+    # with scalar shares and pulls, and check that nothing gets interleaved.
+    table = join(test_table, "test_threaded_share_pull")
+    n_threads = 16
+    n_loops = 50
+    errors = []
+
+    def worker(i):
+        try:
+            for j in range(n_loops):
+                struct = {"a": i, "b": float(j), "c": f"thread{i}"}
+                smax_client.smax_share(f"{table}:struct{i}", "data", struct)
+                smax_client.smax_share(table, f"scalar{i}", j)
+
+                result = smax_client.smax_pull(f"{table}:struct{i}", "data")
+                assert result["data"]["a"] == i
+                assert result["data"]["b"] == float(j)
+                assert result["data"]["c"] == f"thread{i}"
+                assert smax_client.smax_pull(table, f"scalar{i}") == j
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=worker, args=(i,)) for i in range(n_threads)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    assert errors == []
+
+
+def test_threaded_wait(smax_client):
+    # Threads waiting concurrently each get the notifications of their own
+    # subscriptions.
+    table = join(test_table, "test_threaded_wait")
+    n_threads = 4
+    subscribed = threading.Barrier(n_threads + 1)
+    results = {}
+    errors = []
+
+    def worker(i):
+        try:
+            smax_client.smax_subscribe(f"{table}:key{i}")
+            subscribed.wait()
+            results[i] = [smax_client.smax_wait_on_subscribed(f"{table}:key{i}", timeout=3.0).smaxname
+                          for j in range(3)]
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=worker, args=(i,)) for i in range(n_threads)]
+    for t in threads:
+        t.start()
+    subscribed.wait()
+    for j in range(3):
+        for i in range(n_threads):
+            smax_client.smax_share(table, f"key{i}", 10 * i + j)
+    for t in threads:
+        t.join()
+
+    assert errors == []
+    # Each wait pulls the value current at the time, so only the names are
+    # compared.
+    assert results == {i: [f"{table}:key{i}"] * 3 for i in range(n_threads)}
+    assert [int(smax_client.smax_pull(table, f"key{i}")) for i in range(n_threads)] == \
+        [10 * i + 2 for i in range(n_threads)]
+    # The main thread has not waited, so has no pubsub object of its own
+    assert getattr(smax_client._local, "pubsub", None) is None
+    smax_client.smax_disconnect()
+
+
+def test_wait_other_thread(smax_client):
+    # Subscriptions made in one thread can be waited on in another.
+    table = join(test_table, "test_wait_other_thread")
+    results = queue.Queue()
+
+    def worker(pattern):
+        try:
+            results.put(smax_client.smax_wait_on_subscribed(pattern, timeout=5.0).smaxname)
+        except Exception as e:
+            results.put(e)
+
+    smax_client.smax_subscribe(f"{table}:key")
+    thread = threading.Thread(target=worker, args=(f"{table}:key",))
+    thread.start()
+    # The worker subscribes when it first waits
+    wait_until(lambda: smax_client._client.pubsub_numsub(f"smax:{table}:key")[0][1] == 2)
+    smax_client.smax_share(table, "key", 1)
+    thread.join()
+    assert results.get_nowait() == f"{table}:key"
+
+    # ...and unsubscribed from another thread
+    smax_client.smax_unsubscribe(f"{table}:key")
+    thread = threading.Thread(target=worker, args=(f"{table}:key",))
+    thread.start()
+    thread.join()
+    assert isinstance(results.get_nowait(), RuntimeError)
+    smax_client.smax_disconnect()
+
+
+def test_batch_share_pull(smax_client):
+    table = join(test_table, "test_batch_share_pull")
+    values = {f"{table}:value{i}": float(i) for i in range(10)}
+    values[(table, "strings")] = ["a", "b", "c"]
+    values[f"{table}:struct"] = {"a": 1, "b": {"c": "nested"}}
+
+    smax_client.smax_share_batch(values)
+    result = smax_client.smax_pull_batch(list(values.keys()))
+
+    assert [float(r) for r in result[:10]] == [float(i) for i in range(10)]
+    assert result[10] == ["a", "b", "c"]
+    assert result[10].smaxname == f"{table}:strings"
+    assert result[11]["struct"]["a"] == 1
+    assert result[11]["struct"]["b"]["c"] == "nested"
+    assert result[11]["struct"]["b"]["c"].smaxname == f"{table}:struct:b:c"
+
+
+def test_auto_pipeline():
+    table = join(test_table, "test_auto_pipeline")
+    n_threads = 50
+    n_loops = 20
+    errors = []
+
+    with SmaxRedisClient(smax_redis_ip, auto_pipeline=True) as s:
+        for i in range(n_threads):
+            s.smax_share(table, f"value{i}", i)
+
+        def worker(i):
+            try:
+                for j in range(n_loops):
+                    result = s.smax_pull(table, f"value{i}")
+                    assert result == i
+                    assert result.smaxname == f"{table}:value{i}"
+            except Exception as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=worker, args=(i,)) for i in range(n_threads)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        stats = s.smax_stats()["auto_pipeline"]
+
+        # Errors for single commands are raised in the calling thread only.
+        with pytest.raises(SmaxKeyError):
+            s.smax_pull(table, "this_key_does_not_exist")
+
+    assert errors == []
+    assert stats["commands"] >= n_threads * (n_loops + 1)
+    # Concurrent calls must have shared pipeline writes.
+    assert stats["batches"] < stats["commands"]
+
+
+class StalledPipeline:
+    """Pipeline stand-in whose writes wait for a release, then reply or fail."""
+    def __init__(self):
+        self.sent = []
+        self.release = queue.Queue()
+        self._commands = []
+
+    def pipeline(self, transaction=False):
+        return self
+
+    def execute_command(self, *args):
+        self._commands.append(args)
+
+    def execute(self, raise_on_error=False):
+        commands, self._commands = self._commands, []
+        self.sent.extend(commands)
+        error = self.release.get()
+        if error is not None:
+            raise error
+        return [args[0] for args in commands]
+
+
+def test_auto_pipeline_timeout():
+    client = StalledPipeline()
+    p = SmaxAutoPipeline(client)
+    results = queue.Queue()
+
+    def call(*args, **kwargs):
+        try:
+            results.put(p.execute_command(*args, **kwargs))
+        except Exception as e:
+            results.put(e)
+
+    first = threading.Thread(target=call, args=("first",), daemon=True)
+    first.start()
+    wait_until(lambda: client.sent == [("first",)])
+
+    # Timed out while queued: not sent, and skipped by the writer.
+    with pytest.raises(TimeoutError) as error:
+        p.execute_command("queued", timeout=0.2)
+    assert not isinstance(error.value, SmaxReplyTimeout)
+    client.release.put(None)
+    first.join()
+    assert results.get() == "first"
+
+    # Timed out once sent: it may have run.
+    with pytest.raises(SmaxReplyTimeout):
+        p.execute_command("sent", timeout=0.2)
+    client.release.put(None)
+    wait_until(lambda: p.stats()["batches"] == 2)
+    assert client.sent == [("first",), ("sent",)]
+
+    # After a failed write, closing fails the queued commands at once.
+    client.release.put(RedisConnectionError("down"))
+    with pytest.raises(RedisConnectionError):
+        p.execute_command("failed")
+    stalled = threading.Thread(target=call, args=("stalled",), daemon=True)
+    stalled.start()
+    wait_until(lambda: client.sent[-1] == ("stalled",))
+    queued = threading.Thread(target=call, args=("queued",), daemon=True)
+    queued.start()
+    wait_until(lambda: p.stats()["queued"] == 1)
+    closing = threading.Thread(target=p.close, daemon=True)
+    closing.start()
+    queued.join(timeout=5)
+    assert isinstance(results.get(timeout=5), RedisConnectionError)
+    client.release.put(None)
+    closing.join()
+    stalled.join()
+    assert results.get() == "stalled"
+    assert ("queued",) not in client.sent
+
+
+def test_lazy_connect():
+    # Nothing listens on port 1, but construction must not touch the network.
+    s = SmaxRedisClient(smax_redis_ip, redis_port=1, shared_pool=False)
+    stats = s.smax_stats()["connection_pool"]
+    assert stats["created"] == 0
+    assert s._scripts == {}
+    s.smax_disconnect()
+
+
+def test_lazy_import():
+    # Run in a fresh interpreter, as this one has imported everything already.
+    program = ("import sys, smax; "
+               "print(sorted(m for m in ('numpy', 'redis', 'psutil') if m in sys.modules)); "
+               "smax.SmaxRedisClient('127.0.0.1', redis_port=1, shared_pool=False); "
+               "print('psutil' in sys.modules)")
+    ps = subprocess.run([sys.executable, "-c", program], capture_output=True, text=True, check=True,
+                        env=dict(os.environ, PYTHONPATH=os.pathsep.join(sys.path)))
+    loaded, psutil_loaded = ps.stdout.splitlines()
+    assert loaded == "[]"
+    # The name of a python process is read from /proc on Linux
+    if sys.platform.startswith("linux"):
+        assert psutil_loaded == "False"
+
+
+def test_program_name():
+    table = join(test_table, "test_program_name")
+    with SmaxRedisClient(smax_redis_ip, program_name="pytest-program") as s:
+        assert s._hostname == f"{socket.gethostname()}:pytest-program"
+        s.smax_share(table, "pytest", 1)
+        assert s.smax_pull(table, "pytest").origin == f"{socket.gethostname()}:pytest-program"
+
+    with SmaxRedisClient(smax_redis_ip) as s:
+        assert s._hostname == f"{socket.gethostname()}:{psutil.Process(os.getpid()).name()}"
+
+
+def test_client_pickle():
+    s = SmaxRedisClient(smax_redis_ip, program_name="pytest-pickle", auto_pipeline=True)
+    config = s.smax_config()
+    assert config == pickle.loads(pickle.dumps(config))
+
+    s2 = pickle.loads(pickle.dumps(s))
+    assert s2 is not s
+    assert s2.smax_config() == config
+    assert s2._hostname == s._hostname
+    assert s2._auto_pipeline is not None
+    s.smax_disconnect()
+    s2.smax_disconnect()
+
+
+@pytest.mark.skipif(not hasattr(os, "fork"), reason="needs os.fork()")
+def test_fork():
+    table = join(test_table, "test_fork")
+    with SmaxRedisClient(smax_redis_ip) as s:
+        s.smax_share(table, "parent", 1)
+        assert s.smax_pull(table, "parent") == 1
+        s.smax_subscribe(f"{table}:child")
+        parent_pubsub = s._wait_pubsub()
+        callback_received = threading.Event()
+        s.smax_subscribe(f"{table}:callback", callback=lambda data: callback_received.set())
+
+        pid = os.fork()
+        if pid == 0:
+            # Child: report failures with the exit status
+            status = 1
+            try:
+                # The fork hook only resets state, the subscriptions are made
+                # again on the first use of the client.
+                assert s._callback_pubsub is None and s._subscriptions == {}
+                assert s.smax_pull(table, "parent") == 1
+                assert s._wait_pubsub() is not parent_pubsub
+                assert len(s._subscriptions) == 2
+                s.smax_share(table, "child", 2)
+                assert s.smax_wait_on_any_subscribed(timeout=3.0) == 2
+                # Callback threads run again in the child
+                s.smax_share(table, "callback", 3)
+                assert callback_received.wait(3.0)
+                status = 0
+            finally:
+                os._exit(status)
+
+        _, status = os.waitpid(pid, 0)
+        assert os.waitstatus_to_exitcode(status) == 0
+
+        # The parent's connections were not disturbed by the child
+        assert s.smax_wait_on_any_subscribed(timeout=3.0) == 2
+        assert s.smax_pull(table, "child") == 2
+
+
+def test_process_pool_pulls():
+    table = join(test_table, "test_process_pool_pulls")
+    with SmaxRedisClient(smax_redis_ip) as s:
+        for i in range(8):
+            s.smax_share(table, f"key{i}", i)
+
+        # Clients passed to spawned workers reconnect with the same settings.
+        with multiprocessing.get_context("spawn").Pool(2) as pool:
+            results = pool.starmap(SmaxRedisClient.smax_pull, [(s, table, f"key{i}") for i in range(8)])
+        assert [int(r) for r in results] == list(range(8))
+
+        if "fork" in multiprocessing.get_all_start_methods():
+            with multiprocessing.get_context("fork").Pool(2) as pool:
+                results = pool.starmap(SmaxRedisClient.smax_pull, [(s, table, f"key{i}") for i in range(8)])
+            assert [int(r) for r in results] == list(range(8))
+
+
+def test_read_replicas():
+    # The primary stands in for its replicas here, so the pulls see the shares.
+    table = join(test_table, "test_read_replicas")
+    with SmaxRedisClient(smax_redis_ip, replicas=[smax_redis_ip, ("localhost", 6379)]) as s:
+        s.smax_share(table, "pytest", 42)
+        s.smax_share(table, "struct", {"a": 1, "b": "two"})
+        for i in range(4):
+            assert s.smax_pull(table, "pytest") == 42
+        assert s.smax_pull(table, "struct")["struct"]["b"] == "two"
+        assert s.smax_pull_batch([(table, "pytest"), (table, "struct")])[0] == 42
+
+        stats = s.smax_stats()["replicas"]
+        reads = [r["reads"] for r in stats["replicas"].values()]
+        # Reads are spread over the replicas
+        assert all(n > 0 for n in reads)
+        # Servers without EVALSHA_RO take the first read of each replica to detect
+        assert sum(reads) + stats["fallbacks"] == 8
+        assert all(r["failures"] == 0 for r in stats["replicas"].values())
+
+        # A stale SHA is refreshed, and errors of the script itself are
+        # raised, without taking the replica out of use.
+        s._scripts["HGetWithMeta"] = b"0" * 40
+        assert s.smax_pull(table, "pytest") == 42
+        with pytest.raises(ResponseError):
+            s._evalsha_read(s._replicas.select(), 'HGetWithMeta', '2', table)
+        stats = s.smax_stats()["replicas"]
+        assert all(r["failures"] == 0 and r["available"] for r in stats["replicas"].values())
+
+
+def test_table_fields_read_path():
+    # The incremental subscriptions list the fields of tables like pulls.
+    table = join(test_table, "test_table_fields_read_path")
+    with SmaxRedisClient(smax_redis_ip, replicas=[smax_redis_ip], auto_pipeline=True) as s:
+        s.smax_share(table, "struct", {"a": 1, "b": {"c": 2}})
+        assert sorted(s._table_fields(f"{table}:struct")) == ["a", "b"]
+        assert s.smax_stats()["replicas"]["replicas"][smax_redis_ip + ":6379"]["reads"] == 1
+
+    with SmaxRedisClient(smax_redis_ip, auto_pipeline=True) as s:
+        assert sorted(s._table_fields(f"{table}:struct")) == ["a", "b"]
+        assert s.smax_stats()["auto_pipeline"]["commands"] == 1
+
+
+def test_read_replica_fallback():
+    # Nothing listens on port 1, so pulls fall back to the primary.
+    table = join(test_table, "test_read_replica_fallback")
+    with SmaxRedisClient(smax_redis_ip, replicas=[f"{smax_redis_ip}:1"], replica_retry_interval=60) as s:
+        s.smax_share(table, "pytest", 42)
+        assert s.smax_pull(table, "pytest") == 42
+        assert s.smax_pull(table, "pytest") == 42
+        assert s.smax_pull_batch([f"{table}:pytest"])[0] == 42
+
+        stats = s.smax_stats()["replicas"]
+        replica = stats["replicas"][f"{smax_redis_ip}:1"]
+        assert replica["failures"] == 1
+        assert not replica["available"]
+        assert stats["fallbacks"] == 3
+
+
+def test_deadline():
+    # Nothing listens on port 1: without a deadline, the calls would retry for minutes.
+    table = join(test_table, "test_deadline")
+    with SmaxRedisClient(smax_redis_ip, redis_port=1, shared_pool=False, timeout=0.5) as s:
+        start = time.monotonic()
+        with pytest.raises(SmaxConnectionError):
+            s.smax_pull(table, "pytest")
+        assert time.monotonic() - start < 2.0
+
+        start = time.monotonic()
+        with pytest.raises(SmaxConnectionError):
+            s.smax_share(table, "pytest", 1, timeout=0.2)
+        assert time.monotonic() - start < 1.0
+
+    with SmaxRedisClient(smax_redis_ip, redis_port=1, shared_pool=False, fail_fast=True, timeout=0.2) as s:
+        assert s.smax_pull(table, "pytest") is smax_unavailable
+        assert s.smax_pull_batch([(table, "pytest")]) == [smax_unavailable]
+
+
+def test_deadline_unresponsive_server():
+    # A server that accepts connections but never replies: the socket reads
+    # end at the deadline, rather than after the socket timeout.
+    listener = socket.create_server((smax_redis_ip, 0))
+    port = listener.getsockname()[1]
+    try:
+        with SmaxRedisClient(smax_redis_ip, port, shared_pool=False, timeout=0.5) as s:
+            start = time.monotonic()
+            with pytest.raises(SmaxConnectionError):
+                s.smax_pull(test_table, "test_deadline_unresponsive_server")
+            assert time.monotonic() - start < 2.0
+            # Without a deadline, replies are waited for without a socket
+            # timeout, which would send a slow script call again.
+            assert s._client.connection_pool.connection_kwargs["socket_timeout"] is None
+    finally:
+        listener.close()
+
+
+def test_deadline_blocking_pool():
+    # The wait for a free connection ends at the deadline, not the pool timeout.
+    pool = create_connection_pool(smax_redis_ip, 6379, 0, max_connections=1, blocking=True, timeout=10)
+    connection = pool.get_connection()
+    try:
+        start = time.monotonic()
+        with deadline(0.2):
+            with pytest.raises(RedisConnectionError):
+                pool.get_connection()
+        assert time.monotonic() - start < 2.0
+    finally:
+        pool.release(connection)
+        pool.disconnect()
+
+
+# Stand-in for the SMA-X HGetWithMeta script, on a server without the SMA-X scripts.
+hget_script = "return {redis.call('HGET', KEYS[1], ARGV[1]), 'int32', '1', '1700000000.000000', 'pytest', '1'}"
+
+
+@pytest.fixture
+def stoppable_server():
+    if shutil.which("redis-server") is None:
+        pytest.skip("needs redis-server")
+    port = 6391
+    server = subprocess.Popen(["redis-server", "--port", str(port), "--save", "", "--appendonly", "no"],
+                              stdout=subprocess.DEVNULL)
+    try:
+        import redis
+        r = redis.Redis(smax_redis_ip, port)
+        for i in range(50):
+            try:
+                r.ping()
+                break
+            except redis.ConnectionError:
+                time.sleep(0.1)
+        r.hset("scripts", "HGetWithMeta", r.script_load(hget_script))
+        r.close()
+        yield server, port
+    finally:
+        server.terminate()
+        server.wait()
+
+
+def test_deadline_server_stopped(stoppable_server):
+    server, port = stoppable_server
+    table = join(test_table, "test_deadline_server_stopped")
+    import redis
+    redis.Redis(smax_redis_ip, port).hset(table, "pytest", "42")
+
+    with SmaxRedisClient(smax_redis_ip, port, shared_pool=False, fail_fast=True, timeout=1.0) as cached, \
+            SmaxRedisClient(smax_redis_ip, port, shared_pool=False, timeout=1.0) as s:
+        assert cached.smax_pull(table, "pytest") == 42
+        assert s.smax_pull(table, "pytest") == 42
+
+        server.terminate()
+        server.wait()
+
+        start = time.monotonic()
+        assert cached.smax_pull(table, "pytest") == 42
+        assert cached.smax_pull(table, "other") is smax_unavailable
+        with pytest.raises(SmaxConnectionError):
+            s.smax_pull(table, "pytest")
+        assert time.monotonic() - start < 5.0
+
+
+class RedisProxy:
+    """TCP proxy to the test server, which can be stopped to simulate an outage."""
+    def __init__(self, port, target=(smax_redis_ip, 6379)):
+        self.port = port
+        self.target = target
+        self._sockets = []
+        self._listener = None
+
+    def start(self):
+        self._listener = socket.create_server((smax_redis_ip, self.port))
+        threading.Thread(target=self._accept, args=(self._listener,), daemon=True).start()
+
+    def stop(self):
+        for sock in [self._listener] + self._sockets:
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+            sock.close()
+        self._sockets = []
+
+    def _accept(self, listener):
+        while True:
+            try:
+                client, address = listener.accept()
+            except OSError:
+                return
+            upstream = socket.create_connection(self.target)
+            self._sockets += [client, upstream]
+            threading.Thread(target=self._pump, args=(client, upstream), daemon=True).start()
+            threading.Thread(target=self._pump, args=(upstream, client), daemon=True).start()
+
+    @staticmethod
+    def _pump(source, destination):
+        try:
+            while data := source.recv(65536):
+                destination.sendall(data)
+        except OSError:
+            pass
+
+
+@pytest.fixture
+def redis_proxy():
+    proxy = RedisProxy(6392)
+    proxy.start()
+    yield proxy
+    proxy.stop()
+
+
+@pytest.mark.parametrize("coalesce", [False, True])
+def test_pubsub_reconnect(redis_proxy, coalesce):
+    # The dispatcher thread survives the loss of its connection, and the
+    # callbacks are called again once it is back.
+    table = join(test_table, "test_pubsub_reconnect")
+    received = queue.Queue()
+
+    with SmaxRedisClient(smax_redis_ip, redis_proxy.port, shared_pool=False, coalesce_notifications=coalesce) as s, \
+            SmaxRedisClient(smax_redis_ip) as producer:
+        s.smax_subscribe(f"{table}:value", callback=lambda data: received.put(int(data)))
+        producer.smax_share(table, "value", 1)
+        assert received.get(timeout=5.0) == 1
+
+        redis_proxy.stop()
+        redis_proxy.start()
+
+        # Notifications are lost until the dispatcher has subscribed again.
+        def delivered():
+            producer.smax_share(table, "value", 2)
+            try:
+                return received.get(timeout=0.1) == 2
+            except queue.Empty:
+                return False
+        wait_until(delivered, timeout=10.0)
+
+        # The pong of the ping the dispatcher reconnects with is not
+        # dispatched as a notification.
+        s._callback_pubsub._pubsub.ping()
+        for i in (3, 4):
+            producer.smax_share(table, "value", i)
+            assert received.get(timeout=5.0) == i
+        assert s._callback_pubsub._thread.is_alive()
+        assert s.smax_stats()["pubsub"]["errors"] == 0
+
+
+def test_outage_buffer(redis_proxy):
+    table = join(test_table, "test_outage_buffer")
+    with SmaxRedisClient(smax_redis_ip, redis_proxy.port, shared_pool=False, timeout=0.5,
+                         outage_buffer=10) as s, SmaxRedisClient(smax_redis_ip) as reader:
+        s.smax_share(table, "before", 0)
+
+        redis_proxy.stop()
+        s.smax_share(table, "value", 1)
+        s.smax_share(table, "value", 2)
+        s.smax_share(table, "struct", {"a": 1, "b": {"c": "three"}})
+        s.smax_share_batch({(table, "batch1"): 1.5, (table, "batch2"): "two"})
+        stats = s.smax_stats()["outage_buffer"]
+        assert stats["keys"] == 4
+        assert stats["buffered"] == 5
+        assert stats["replaced"] == 1
+        assert stats["bytes"] > 0
+        assert not s.smax_replay_buffer(force=True)
+        assert s.smax_stats()["outage_buffer"]["replay_failures"] == 1
+
+        redis_proxy.start()
+        assert s.smax_replay_buffer(force=True)
+        stats = s.smax_stats()["outage_buffer"]
+        assert stats["keys"] == 0
+        assert stats["replayed"] == 4
+
+        assert reader.smax_pull(table, "value") == 2
+        assert reader.smax_pull(table, "struct")["struct"]["b"]["c"] == "three"
+        assert reader.smax_pull(table, "batch1") == 1.5
+        assert reader.smax_pull(table, "batch2") == "two"
+
+
+def test_outage_buffer_fail_fast(redis_proxy):
+    # Without a timeout, shares are buffered within the buffer's timeout
+    # rather than after the full backoff of the connection retries.
+    table = join(test_table, "test_outage_buffer_fail_fast")
+    with SmaxRedisClient(smax_redis_ip, redis_proxy.port, shared_pool=False, outage_buffer=10) as s, \
+            SmaxRedisClient(smax_redis_ip) as reader:
+        s.smax_share(table, "value", 0)
+
+        redis_proxy.stop()
+        start = time.monotonic()
+        assert s.smax_share(table, "value", 1) is None
+        assert not s.smax_replay_buffer(force=True)
+        assert time.monotonic() - start < 5.0
+
+        # A share made while another thread replays the buffer is buffered
+        # too, rather than overwritten by the replay of an older value.
+        redis_proxy.start()
+        with s._replay_lock:
+            items = s._outage_buffer.take(10)
+            assert s.smax_share(table, "value", 2) is None
+            assert reader.smax_pull(table, "value") == 0
+        s._outage_buffer.replay_failed(items)
+        assert s.smax_replay_buffer(force=True)
+        assert reader.smax_pull(table, "value") == 2
+        assert s.smax_share(table, "value", 3) is not None
+
+
+def test_outage_buffer_policies():
+    # Nothing listens on port 1, so every share is buffered.
+    table = join(test_table, "test_outage_buffer_policies")
+    options = dict(redis_port=1, shared_pool=False, timeout=0.2, outage_buffer=2)
+
+    with SmaxRedisClient(smax_redis_ip, **options) as s:
+        for i in range(4):
+            s.smax_share(table, f"key{i}", i)
+        stats = s.smax_stats()["outage_buffer"]
+        assert stats["keys"] == 2
+        assert stats["dropped"] == 2
+        assert [name for name, commands in s._outage_buffer.take(2)] == [f"{table}:key2", f"{table}:key3"]
+
+    with SmaxRedisClient(smax_redis_ip, outage_buffer_policy="drop_newest", **options) as s:
+        for i in range(4):
+            s.smax_share(table, f"key{i}", i)
+        assert s.smax_stats()["outage_buffer"]["dropped"] == 2
+        assert [name for name, commands in s._outage_buffer.take(2)] == [f"{table}:key0", f"{table}:key1"]
+
+    with SmaxRedisClient(smax_redis_ip, outage_buffer_policy="error", **options) as s:
+        s.smax_share(table, "key0", 0)
+        s.smax_share(table, "key1", 1)
+        with pytest.raises(SmaxConnectionError):
+            s.smax_share(table, "key2", 2)
+
+    with SmaxRedisClient(smax_redis_ip, outage_buffer_bytes=100, **dict(options, outage_buffer=100)) as s:
+        s.smax_share(table, "key0", "x" * 10)
+        s.smax_share(table, "key1", "x" * 10)
+        stats = s.smax_stats()["outage_buffer"]
+        assert stats["keys"] == 1
+        assert stats["bytes"] <= 100
+
+    with pytest.raises(ValueError):
+        SmaxRedisClient(smax_redis_ip, outage_buffer=1, outage_buffer_policy="unknown")
+
+    # A failed replay puts the shares back within the limits of the buffer,
+    # keeping those buffered in the meantime.
+    for policy, kept in [("drop_oldest", ["key1", "key2"]), ("drop_newest", ["key0", "key2"])]:
+        with SmaxRedisClient(smax_redis_ip, outage_buffer_policy=policy, **options) as s:
+            s.smax_share(table, "key0", 0)
+            s.smax_share(table, "key1", 1)
+            items = s._outage_buffer.take(2)
+            s.smax_share(table, "key2", 2)
+            s._outage_buffer.replay_failed(items)
+            assert s.smax_stats()["outage_buffer"]["dropped"] == 1
+            assert [name for name, commands in s._outage_buffer.take(2)] == [f"{table}:{key}" for key in kept]
+
+
+def test_outage_buffer_slow_share():
+    # A server that accepts connections but never replies: the share was sent,
+    # and may have been made, so it is not buffered to be made again.
+    table = join(test_table, "test_outage_buffer_slow_share")
+    listener = socket.create_server((smax_redis_ip, 0))
+    port = listener.getsockname()[1]
+    with SmaxRedisClient(smax_redis_ip) as s:
+        s._get_scripts()
+        scripts = dict(s._scripts)
+    try:
+        with SmaxRedisClient(smax_redis_ip, port, shared_pool=False, timeout=0.5, outage_buffer=10) as s:
+            s._scripts.update(scripts)
+            with pytest.raises(SmaxConnectionError):
+                s.smax_share(table, "value", 1)
+            assert s.smax_stats()["outage_buffer"]["keys"] == 0
+    finally:
+        listener.close()
+
+
+def test_shared_connection_pool():
+    table = join(test_table, "test_shared_connection_pool")
+    port = 6379
+    with SmaxRedisClient(smax_redis_ip, port) as s1, SmaxRedisClient(smax_redis_ip, port) as s2:
+        assert s1._client.connection_pool is s2._client.connection_pool
+
+        s1.smax_share(table, "pytest", "shared pool")
+        assert s2.smax_pull(table, "pytest") == "shared pool"
+
+        stats = s2.smax_stats()["connection_pool"]
+        assert stats["clients"] >= 2
+        assert stats["created"] >= 1
+        # Pub/sub connections of other clients in this process may be in use.
+        assert stats["in_use"] + stats["idle"] == stats["created"]
+
+        unshared = SmaxRedisClient(smax_redis_ip, port, shared_pool=False)
+        assert unshared._client.connection_pool is not s1._client.connection_pool
+        unshared.smax_disconnect()
+
+        # Disconnecting a client again leaves the pool of the others alone.
+        s3 = SmaxRedisClient(smax_redis_ip, port)
+        s3.smax_subscribe(f"{table}:pytest", callback=lambda data: None)
+        s3.smax_disconnect()
+        s3.smax_disconnect()
+        assert s3._subscriptions == {}
+        assert s3 not in smax_redis_client._clients
+        assert s2.smax_stats()["connection_pool"]["clients"] == stats["clients"]
+        assert s2.smax_pull(table, "pytest") == "shared pool"
+
+
+def test_blocking_connection_pool():
+    table = join(test_table, "test_blocking_connection_pool")
+    errors = []
+    with SmaxRedisClient(smax_redis_ip, shared_pool=False, max_connections=2,
+                         blocking_pool=True, pool_timeout=10) as s:
+        s.smax_share(table, "pytest", 42)
+
+        def worker():
+            try:
+                for i in range(10):
+                    assert s.smax_pull(table, "pytest") == 42
+            except Exception as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=worker) for i in range(8)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        stats = s.smax_stats()["connection_pool"]
+
+    assert errors == []
+    assert stats["created"] <= 2
+
+
+def test_script_cache(smax_client):
+    table = join(test_table, "test_script_cache")
+    smax_client.smax_share(table, "pytest", 1)
+
+    # Clients of the same server share the SHAs loaded by the first one.
+    with SmaxRedisClient(smax_redis_ip) as s:
+        assert s._scripts is smax_client._scripts
+        assert s._scripts["HGetWithMeta"] is not None
+
+        # A stale SHA is refreshed on NoScriptError, leaving the others alone.
+        set_sha = s._scripts["HSetWithMeta"]
+        s._scripts["HGetWithMeta"] = b"0" * 40
+        assert s.smax_pull(table, "pytest") == 1
+        assert s._scripts["HGetWithMeta"] != b"0" * 40
+        assert s._scripts["HSetWithMeta"] is set_sha
+
+        # A script missing from the server is reported, and not cached.
+        with pytest.raises(SmaxKeyError, match="NoSuchScript"):
+            s._script_sha("NoSuchScript")
+        assert "NoSuchScript" not in s._scripts